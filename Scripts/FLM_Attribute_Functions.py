@@ -28,18 +28,171 @@
 #
 # ---------------------------------------------------------------------------
 
+import numpy
+import shapely.geometry as shgeo
+from shapely.strtree import STRtree
+
 import arcpy
 import FLM_Common as flmc
 
+SPLIT_ENGINES = ["arcpy", "native"]
+
 
 def PathFile(path):
     return path[path.rfind("\\") + 1:]
 
 
-def FlmLineSplit(workspace, Input_Lines, SamplingType, Segment_Length, Tolerance_Radius):
+def queryTree(tree, geometry):
+    """
+    Indices of the geometries in an STRtree whose bounding box intersects geometry.
+    """
+    query = getattr(tree, "query_items", tree.query)  # Shapely 1.8 returns indices by query_items
+    return [int(i) for i in query(geometry)]
+
+
+def lineParts(Input_Lines):
+    """
+    Vertices of every part of every input line, as MultipartToSinglepart.
+        return: fields, list of (vertex array, attribute values of the line)
+    """
+    fields = [field.name for field in arcpy.ListFields(Input_Lines)
+              if field.type not in ["Geometry", "OID"] and field.editable]
+    parts = []
+    with arcpy.da.SearchCursor(Input_Lines, ["SHAPE@"] + fields) as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+
+            for part in row[0]:
+                vertices = numpy.array([[pnt.X, pnt.Y] for pnt in part if pnt])
+                if len(vertices) >= 2:
+                    parts.append((vertices, list(row[1:])))
+
+    return fields, parts
+
+
+def cutLine(vertices, measures):
+    """
+    Cut a line at measures along it, using the cumulative length at its vertices.
+        vertices: vertex array of shape (n, 2)
+        measures: distances from the start of the line, those outside the line are ignored
+        return: list of vertex arrays of the pieces in order
+    """
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(numpy.hypot(*numpy.diff(vertices, axis=0).T))))
+    measures = numpy.unique(numpy.asarray(measures, dtype=numpy.float64))
+    measures = measures[(measures > 0) & (measures < cumulative[-1])]
+    if len(measures) == 0:
+        return [vertices]
+
+    # Cut points interpolated along the line
+    cut_points = numpy.column_stack((numpy.interp(measures, cumulative, vertices[:, 0]),
+                                     numpy.interp(measures, cumulative, vertices[:, 1])))
+    starts = numpy.concatenate(([0.0], measures))
+    ends = numpy.concatenate((measures, [cumulative[-1]]))
+    first = numpy.searchsorted(cumulative, starts, side="right")
+    last = numpy.searchsorted(cumulative, ends, side="left")
+
+    pieces = []
+    for i in range(len(starts)):
+        start = vertices[0] if i == 0 else cut_points[i - 1]
+        end = vertices[-1] if i == len(starts) - 1 else cut_points[i]
+        pieces.append(numpy.vstack((start, vertices[first[i]:last[i]], end)))
+
+    return pieces
+
+
+def intersectionPoints(geometry):
+    """
+    Point coordinates of an intersection, the end points for overlapping lines.
+    """
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == "Point":
+        return [geometry.coords[0]]
+    if geometry.geom_type == "LineString":
+        return [geometry.coords[0], geometry.coords[-1]]
+
+    points = []
+    for item in geometry.geoms:
+        points += intersectionPoints(item)
+
+    return points
+
+
+def crossingMeasures(lines, tolerance):
+    """
+    Measures of the line crossings on every line.
+    Crossings are the intersections between different lines, and a line is cut at
+    every crossing within tolerance of it, as SplitLineAtPoint with a search radius.
+        lines: list of vertex arrays
+        return: list of measure arrays
+    """
+    geometries = [shgeo.LineString(vertices) for vertices in lines]
+    tree = STRtree(geometries)
+
+    points = []
+    for i, geometry in enumerate(geometries):
+        for j in queryTree(tree, geometry):
+            if j > i:
+                points += intersectionPoints(geometry.intersection(geometries[j]))
+
+    if not points:
+        return [numpy.empty(0) for _ in lines]
+
+    points = [shgeo.Point(point) for point in set(points)]
+    point_tree = STRtree(points)
+    measures = []
+    for geometry in geometries:
+        near = [points[k] for k in queryTree(point_tree, geometry.buffer(tolerance).envelope)]
+        measures.append(numpy.array([geometry.project(point) for point in near
+                                     if geometry.distance(point) <= tolerance]))
+
+    return measures
+
+
+def nativeLineSplit(Input_Lines, SamplingType, Segment_Length, Tolerance_Radius):
+    """
+    Split lines in memory over their coordinate arrays, without intermediate files.
+        return: memory feature class of the segments with the attributes of the input lines
+    """
+    fields, parts = lineParts(Input_Lines)
+    lines = [part[0] for part in parts]
+
+    if SamplingType == "ARBITRARY":
+        # Cuts every Segment_Length from the start, as points along lines without end points
+        measures = [numpy.arange(1, int(numpy.hypot(*numpy.diff(vertices, axis=0).T).sum() // Segment_Length) + 1)
+                    * Segment_Length for vertices in lines]
+    elif SamplingType == "LINE-CROSSINGS":
+        measures = crossingMeasures(lines, Tolerance_Radius)
+    else:  # "WHOLE-LINE"
+        measures = [[] for _ in lines]
+
+    FLA_Segmented_Lines = r"memory\FLA_Segmented_Lines"
+    spatial_reference = arcpy.Describe(Input_Lines).spatialReference
+    arcpy.CreateFeatureclass_management("memory", "FLA_Segmented_Lines", "POLYLINE", Input_Lines,
+                                        "DISABLED", "DISABLED", spatial_reference)
+    with arcpy.da.InsertCursor(FLA_Segmented_Lines, ["SHAPE@"] + fields) as cursor:
+        for (vertices, values), line_measures in zip(parts, measures):
+            for piece in cutLine(vertices, line_measures):
+                array = arcpy.Array([arcpy.Point(x, y) for x, y in piece])
+                cursor.insertRow([arcpy.Polyline(array, spatial_reference)] + values)
+
+    return FLA_Segmented_Lines
+
+
+def FlmLineSplit(workspace, Input_Lines, SamplingType, Segment_Length, Tolerance_Radius, engine="arcpy"):
+    """
+    Split input lines for attribution by SamplingType.
+        engine: "arcpy" splits with geoprocessing tools through shapefiles,
+                "native" splits in memory with nativeLineSplit
+    """
     if SamplingType == "IN-FEATURES":
         return Input_Lines
 
+    if engine == "native":
+        flmc.log("FlmLineSplit: Splitting lines in memory")
+        return nativeLineSplit(Input_Lines, SamplingType, float(Segment_Length), float(Tolerance_Radius))
+
     arcpy.env.workspace = workspace
     arcpy.env.overwriteOutput = True
 
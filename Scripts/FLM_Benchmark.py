@@ -0,0 +1,361 @@
+#
+#    Copyright (C) 2021  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_Benchmark.py
+# Script Author: Applied Geospatial Research Group
+# Date: 2026-Oct-18
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Reproducible throughput benchmark of the FLM tools. A synthetic
+# CHM with random canopy patches and cut lines of known width is generated
+# together with the matching seed lines, then canopyCost, centerline,
+# lineFootprint, dynamicLineFootprint and lineAttribute are run end to end.
+# Lines per second, peak memory and the seconds of every logged stage are
+# written to a JSON file, so results can be compared across releases.
+#
+# Usage:
+#   python FLM_Benchmark.py --rows 4000 --cols 4000 --lines 200 --output bench.json
+#
+# ---------------------------------------------------------------------------
+# System imports
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import threading
+
+import numpy as np
+
+# ArcGIS imports
+import arcpy
+
+# Local imports
+import FLM_Common as flmc
+import FLM_RasterFilters as flmrf
+import FLM_Tools
+
+TOOLS = ["canopyCost", "centerline", "lineFootprint", "dynamicLineFootprint", "lineAttribute"]
+X_MIN = 500000.0  # upper left corner of the synthetic rasters
+Y_MAX = 6000000.0
+SPATIAL_REFERENCE = 2956  # NAD 1983 (CSRS) UTM zone 12N
+CANOPY_COVER = 0.7  # fraction of the area covered by canopy patches
+PATCH_RADIUS = 10.0  # typical radius of canopy patches in map units
+DIGITISING_ERROR = 3.0  # maximum offset of seed line vertices from the cut lines
+MB = 1024.0 * 1024.0
+
+
+class MemorySampler(threading.Thread):
+    """
+    Peak resident memory of this process and its pool workers, sampled in the background.
+    Uses psutil when installed, otherwise the peak reported by the resource module where available.
+    """
+    def __init__(self, interval=0.2):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak = 0
+
+        try:
+            import psutil
+            self.process = psutil.Process()
+        except ImportError:
+            self.process = None
+
+    def sample(self):
+        if self.process is None:
+            return
+
+        try:
+            rss = self.process.memory_info().rss
+            for child in self.process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except Exception:
+                    pass  # worker exited
+            self.peak = max(self.peak, rss)
+        except Exception:
+            pass
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """
+        Stop sampling.
+            return: peak memory in MB, None when it can not be measured
+        """
+        self.stopped.set()
+        self.join()
+        self.sample()
+        if self.process is not None:
+            return self.peak / MB
+
+        try:
+            import resource
+            peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+            return peak / 1024.0  # kilobytes on Linux
+        except ImportError:
+            return None
+
+
+def syntheticLines(rows, cols, cell_size, num_lines, rng):
+    """
+    Random cut lines crossing the raster, each with two bends.
+        return: list of lines, each a list of (x, y) map coordinates
+    """
+    width = cols * cell_size
+    height = rows * cell_size
+    margin = 0.05 * min(width, height)
+
+    lines = []
+    for _ in range(num_lines):
+        if rng.random() < 0.5:  # west to east
+            start = (X_MIN + margin, Y_MAX - rng.uniform(margin, height - margin))
+            end = (X_MIN + width - margin, Y_MAX - rng.uniform(margin, height - margin))
+        else:  # north to south
+            start = (X_MIN + rng.uniform(margin, width - margin), Y_MAX - margin)
+            end = (X_MIN + rng.uniform(margin, width - margin), Y_MAX - height + margin)
+
+        line = [start]
+        for t in (1.0 / 3.0, 2.0 / 3.0):
+            x = start[0] + (end[0] - start[0]) * t + rng.uniform(-margin, margin) / 2.0
+            y = start[1] + (end[1] - start[1]) * t + rng.uniform(-margin, margin) / 2.0
+            line.append((min(max(x, X_MIN + margin), X_MIN + width - margin),
+                         min(max(y, Y_MAX - height + margin), Y_MAX - margin)))
+        line.append(end)
+        lines.append(line)
+
+    return lines
+
+
+def syntheticCHM(rows, cols, cell_size, lines, line_width, rng):
+    """
+    CHM with random canopy patches and the lines cut through them.
+        line_width: width of the cut lines in map units
+        return: float32 CHM array, first row is the top of the raster
+    """
+    # Canopy patches from smoothed noise, tree heights 5 to 25 m, open ground below 0.5 m
+    noise = rng.standard_normal((rows, cols))
+    smooth = flmrf.boxSum(noise, max(int(PATCH_RADIUS / cell_size), 1))
+    cover = smooth > np.quantile(smooth, 1.0 - CANOPY_COVER)
+    del noise, smooth
+    chm = np.where(cover, rng.uniform(5.0, 25.0, (rows, cols)),
+                   rng.uniform(0.0, 0.5, (rows, cols))).astype(np.float32)
+    del cover
+
+    # Cut lines, cells whose centres are within half the line width of a line
+    half = line_width / 2.0
+    for line in lines:
+        for (x1, y1), (x2, y2) in zip(line[:-1], line[1:]):
+            col_min = max(int((min(x1, x2) - half - X_MIN) / cell_size), 0)
+            col_max = min(int((max(x1, x2) + half - X_MIN) / cell_size) + 1, cols)
+            row_min = max(int((Y_MAX - max(y1, y2) - half) / cell_size), 0)
+            row_max = min(int((Y_MAX - min(y1, y2) + half) / cell_size) + 1, rows)
+
+            x = X_MIN + (np.arange(col_min, col_max) + 0.5) * cell_size
+            y = Y_MAX - (np.arange(row_min, row_max) + 0.5) * cell_size
+            px, py = np.meshgrid(x, y)
+            dx = x2 - x1
+            dy = y2 - y1
+            t = np.clip(((px - x1) * dx + (py - y1) * dy) / max(dx * dx + dy * dy, flmc.EPSILON), 0.0, 1.0)
+            inside = np.hypot(px - x1 - t * dx, py - y1 - t * dy) <= half
+
+            window = chm[row_min:row_max, col_min:col_max]
+            window[inside] = rng.uniform(0.0, 0.5, int(inside.sum()))
+
+    return chm
+
+
+def writeLines(lines, out_fc, spatial_reference):
+    """
+    Save lines as a polyline shapefile with the CorridorTh field used by lineFootprint.
+    """
+    arcpy.CreateFeatureclass_management(os.path.dirname(out_fc), os.path.basename(out_fc), "POLYLINE",
+                                        "", "DISABLED", "DISABLED", spatial_reference)
+    arcpy.AddField_management(out_fc, "CorridorTh", "DOUBLE")
+    with arcpy.da.InsertCursor(out_fc, ["SHAPE@", "CorridorTh"]) as cursor:
+        for line in lines:
+            points = arcpy.Array([arcpy.Point(x, y) for x, y in line])
+            cursor.insertRow([arcpy.Polyline(points, spatial_reference), 3.0])
+
+
+def prepareData(workspace, rows, cols, cell_size, num_lines, line_width, seed):
+    """
+    Generate the synthetic CHM and seed lines in workspace.
+        return: CHM path, seed lines path
+    """
+    rng = np.random.default_rng(seed)
+    spatial_reference = arcpy.SpatialReference(SPATIAL_REFERENCE)
+
+    lines = syntheticLines(rows, cols, cell_size, num_lines, rng)
+    chm = syntheticCHM(rows, cols, cell_size, lines, line_width, rng)
+    in_chm = os.path.join(workspace, "bench_chm.tif")
+    flmc.SaveArrayAsRaster(chm, X_MIN, Y_MAX, cell_size, spatial_reference, in_chm)
+    del chm
+
+    # Seed lines are the cut lines digitised with an offset, as regional scale lines are
+    seed_lines = [[(x + rng.uniform(-DIGITISING_ERROR, DIGITISING_ERROR),
+                    y + rng.uniform(-DIGITISING_ERROR, DIGITISING_ERROR)) for x, y in line] for line in lines]
+    in_line = os.path.join(workspace, "bench_seed_lines.shp")
+    writeLines(seed_lines, in_line, spatial_reference)
+
+    return in_chm, in_line
+
+
+def removeOutputs(outputs):
+    """
+    Delete outputs of an earlier run, FLM_Tools skips tools whose output already exists.
+    """
+    for output in outputs:
+        if arcpy.Exists(output):
+            arcpy.Delete_management(output)
+
+
+def runTool(name, func, *args, **kwargs):
+    """
+    Run a tool and collect its timings.
+        return: dictionary with seconds, peak memory and seconds per logged stage
+    """
+    del flmc.stepTimes[:]
+    flmc.timeLast = time.perf_counter()
+    sampler = MemorySampler()
+    sampler.start()
+
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = sampler.stop()
+
+    stages = {}
+    for step, step_seconds in flmc.stepTimes:
+        stages[step] = stages.get(step, 0.0) + step_seconds
+
+    flmc.log("Benchmark {}: {:.2f} seconds".format(name, seconds))
+    return {"seconds": seconds, "peak_rss_mb": peak, "stages": stages}
+
+
+def featureCount(fc):
+    if not arcpy.Exists(fc):
+        return 0
+
+    return int(arcpy.GetCount_management(fc)[0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark FLM tools on synthetic data.")
+    parser.add_argument("--rows", type=int, default=2000, help="CHM rows")
+    parser.add_argument("--cols", type=int, default=2000, help="CHM columns")
+    parser.add_argument("--cell-size", type=float, default=0.5, help="CHM cell size in map units")
+    parser.add_argument("--lines", type=int, default=50, help="number of cut lines")
+    parser.add_argument("--line-width", type=float, default=6.0, help="width of the cut lines in map units")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument("--tools", default=",".join(TOOLS), help="comma separated tools to run")
+    parser.add_argument("--raster-engine", default="arcpy", help="raster engine of canopyCost and dynamicLineFootprint")
+    parser.add_argument("--search-engine", default="arcpy", help="search engine of centerline")
+    parser.add_argument("--corridor-engine", default="arcpy", help="corridor engine of lineFootprint")
+    parser.add_argument("--workspace", default=None,
+                        help="folder for the synthetic data and outputs, outputs of earlier runs are replaced")
+    parser.add_argument("--output", default="FLM_Benchmark.json", help="JSON result file")
+    args = parser.parse_args(argv)
+
+    tools = [tool.strip() for tool in args.tools.split(",") if tool.strip()]
+    for tool in tools:
+        if tool not in TOOLS:
+            flmc.log("ERROR: Unknown tool {}, choose from {}.".format(tool, ", ".join(TOOLS)))
+            return False
+
+    arcpy.env.overwriteOutput = True
+    arcpy.CheckOutExtension("Spatial")
+
+    workspace = args.workspace or os.path.join(flmc.scriptPath, "FLM_Benchmark_" + time.strftime("%Y%m%d_%H%M%S"))
+    if not os.path.isdir(workspace):
+        os.makedirs(workspace)
+
+    flmc.log("Generating synthetic data in {}...".format(workspace))
+    start = time.perf_counter()
+    in_chm, in_line = prepareData(workspace, args.rows, args.cols, args.cell_size,
+                                  args.lines, args.line_width, args.seed)
+    data_seconds = time.perf_counter() - start
+
+    canopy = os.path.join(workspace, "bench_canopy.tif")
+    cost = os.path.join(workspace, "bench_cost.tif")
+    centerline = os.path.join(workspace, "bench_centerline.shp")
+    footprint = os.path.join(workspace, "bench_footprint.shp")
+    footprint_dyn = os.path.join(workspace, "bench_footprint_dyn.shp")
+    attributes = os.path.join(workspace, "bench_attributes.shp")
+
+    # Tools run in workflow order, each uses the outputs of the tools before
+    runs = {
+        "canopyCost": (FLM_Tools.canopyCost, [in_chm, canopy, cost], {"raster_engine": args.raster_engine}, None),
+        "centerline": (FLM_Tools.centerline, [in_line, cost, centerline],
+                       {"search_engine": args.search_engine}, in_line),
+        "lineFootprint": (FLM_Tools.lineFootprint, [centerline, canopy, cost, footprint],
+                          {"corridor_engine": args.corridor_engine}, centerline),
+        "dynamicLineFootprint": (FLM_Tools.dynamicLineFootprint, [centerline, in_chm, footprint_dyn],
+                                 {"raster_engine": args.raster_engine}, centerline),
+        "lineAttribute": (FLM_Tools.lineAttribute, ["IN-FEATURES", centerline, footprint, in_chm, attributes],
+                          {}, centerline),
+    }
+
+    # Outputs removed before each tool runs, so a reused workspace is not measured as a no-op
+    outputs = {
+        "canopyCost": [canopy, cost],
+        "centerline": [centerline],
+        "lineFootprint": [footprint],
+        "dynamicLineFootprint": [footprint_dyn],
+        "lineAttribute": [attributes],
+    }
+
+    results = {}
+    for tool in TOOLS:
+        if tool not in tools:
+            continue
+
+        func, tool_args, tool_kwargs, lines_fc = runs[tool]
+        removeOutputs(outputs[tool])
+        result = runTool(tool, func, *tool_args, **tool_kwargs)
+        if lines_fc is None:
+            result["cells_per_second"] = args.rows * args.cols / max(result["seconds"], flmc.EPSILON)
+        else:
+            result["lines"] = featureCount(lines_fc)
+            result["lines_per_second"] = result["lines"] / max(result["seconds"], flmc.EPSILON)
+        results[tool] = result
+
+    report = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+        "python": sys.version,
+        "platform": platform.platform(),
+        "cores": flmc.GetCores(),
+        "config": vars(args),
+        "data_seconds": data_seconds,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    flmc.log("Benchmark results written to {}".format(args.output))
+    return True
+
+
+if __name__ == '__main__':
+    main()
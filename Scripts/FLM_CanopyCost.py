@@ -27,11 +27,114 @@
 #
 # ---------------------------------------------------------------------------
 
+# System imports
+import os
+import math
+import multiprocessing
+import numpy
+
 # Import arcpy module
 import arcpy
 from arcpy.sa import *
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
+import FLM_RasterFilters as flmrf
+import FLM_RasterExpression as flmre
+
+
+def costExpression(Raster_CC, Raster_Mean, Raster_StDev, Raster_Smooth, avoidance, exponent):
+	"""
+	Cost raster formula of main as a lazy expression of FLM_RasterExpression rasters.
+	"""
+	return flmre.Power(flmre.Exp(flmre.Con((Raster_CC == 1), 1, flmre.Con((Raster_Mean+Raster_StDev <= 0), 0, (1+(Raster_Mean-Raster_StDev)/(Raster_Mean+Raster_StDev))/2)*(1-avoidance) + Raster_Smooth*avoidance)), exponent)
+
+
+def workTile(tile):
+	"""
+	Canopy and cost rasters of one CHM tile. The tile is read with a halo, so focal
+	statistics and distances near the tile edges use the same cells as the whole raster
+	and tiles match exactly at the seams.
+		tile: (params, row, col, nrows, ncols, halo), params as built in tiledCanopyCost
+		return: paths of the canopy and cost tile rasters, None when failed
+	"""
+	params, row, col, nrows, ncols, halo = tile
+	CHM_Raster, Min_Canopy_Height, Tree_Search_Radius, Max_Line_Distance, avoidance, Cost_Raster_Exponent, outWorkspace = params
+
+	try:
+		chm = arcpy.Raster(CHM_Raster)
+		cell_size = chm.meanCellWidth
+		row_min = max(row-halo, 0)
+		col_min = max(col-halo, 0)
+		row_max = min(row+nrows+halo, chm.height)
+		col_max = min(col+ncols+halo, chm.width)
+		block = flmc.GetRasterBlock(chm, row_min, col_min, row_max-row_min, col_max-col_min)
+
+		# Same steps as main on the tile with halo
+		canopy = numpy.where(block > Min_Canopy_Height, 1.0, 0.0)
+		canopy[numpy.isnan(block)] = numpy.nan
+		del block
+		mean, std = flmrf.focalMeanStd(canopy, Tree_Search_Radius/cell_size, "CIRCLE")
+		distance = flmrf.euclideanDistance(canopy >= 1, cell_size, Max_Line_Distance)
+		smooth = (Max_Line_Distance-distance)/Max_Line_Distance
+		cost = flmre.evaluateArray(costExpression(flmre.Raster(canopy), flmre.Raster(mean), flmre.Raster(std),
+												  flmre.Raster(smooth), avoidance, Cost_Raster_Exponent))
+		del mean, std, distance, smooth
+
+		# Remove the halo and save the tile
+		core = (slice(row-row_min, row-row_min+nrows), slice(col-col_min, col-col_min+ncols))
+		canopy = numpy.where(numpy.isnan(canopy[core]), 255, canopy[core]).astype(numpy.uint8)
+		x_min = chm.extent.XMin+col*cell_size
+		y_max = chm.extent.YMax-row*cell_size
+		canopy_tile = os.path.join(outWorkspace, "FLM_CC_Canopy_{}_{}.tif".format(row, col))
+		cost_tile = os.path.join(outWorkspace, "FLM_CC_Cost_{}_{}.tif".format(row, col))
+		flmc.SaveArrayAsRaster(canopy, x_min, y_max, cell_size, chm.spatialReference, canopy_tile, 255)
+		flmc.SaveArrayAsRaster(cost[core], x_min, y_max, cell_size, chm.spatialReference, cost_tile)
+	except Exception as e:
+		print("Tile {} {} failed.".format(row, col))
+		print(e)
+		return None
+
+	return canopy_tile, cost_tile
+
+
+def tiledCanopyCost(CHM_Raster, Min_Canopy_Height, Tree_Search_Radius, Max_Line_Distance, avoidance,
+					Cost_Raster_Exponent, Tile_Size, outWorkspace, Output_Canopy_Raster, Output_Cost_Raster):
+	"""
+	Process the CHM in tiles of Tile_Size cells across the process pool and mosaic
+	the tiles into the output rasters, so the whole CHM is never held in memory.
+	The halo is the larger of the tree search radius and the maximum line distance.
+	"""
+	chm = arcpy.Raster(CHM_Raster)
+	cell_size = chm.meanCellWidth
+	halo = int(math.ceil(max(Tree_Search_Radius, Max_Line_Distance)/cell_size))
+	params = (CHM_Raster, Min_Canopy_Height, Tree_Search_Radius, Max_Line_Distance, avoidance,
+			  Cost_Raster_Exponent, outWorkspace)
+	tiles = [(params, row, col, min(Tile_Size, chm.height-row), min(Tile_Size, chm.width-col), halo)
+			 for row in range(0, chm.height, Tile_Size) for col in range(0, chm.width, Tile_Size)]
+
+	flmc.log("Processing {} tiles with a halo of {} cells...".format(len(tiles), halo))
+	flmc.log("Using {} CPU cores".format(flmc.GetCores()))
+	pool = multiprocessing.Pool(processes=flmc.GetCores())
+	results = pool.map(workTile, tiles)
+	pool.close()
+	pool.join()
+	flmc.logStep("Tiles")
+
+	if None in results:
+		flmc.log("ERROR: Some tiles failed, outputs are not created.")
+		return False
+
+	flmc.log("Saving Outputs...")
+	arcpy.MosaicToNewRaster_management(";".join([r[0] for r in results]), os.path.dirname(Output_Canopy_Raster),
+									   os.path.basename(Output_Canopy_Raster), chm.spatialReference,
+									   "8_BIT_UNSIGNED", cell_size, 1, "FIRST")
+	arcpy.MosaicToNewRaster_management(";".join([r[1] for r in results]), os.path.dirname(Output_Cost_Raster),
+									   os.path.basename(Output_Cost_Raster), chm.spatialReference,
+									   "32_BIT_FLOAT", cell_size, 1, "FIRST")
+	arcpy.ClearWorkspaceCache_management()
+	flmc.logStep("Mosaic")
+
+	return True
 
 
 def main(argv=None):
@@ -56,6 +159,19 @@ def main(argv=None):
 	Cost_Raster_Exponent = float(args[5].rstrip())
 	Output_Canopy_Raster = args[6].rstrip()
 	Output_Cost_Raster = args[7].rstrip()
+	Raster_Engine = args[8].rstrip() if len(args) > 8 else "arcpy"
+	if Raster_Engine not in flmrf.RASTER_ENGINES:
+		flmc.log("Raster engine {} is not supported, arcpy is used.".format(Raster_Engine))
+		Raster_Engine = "arcpy"
+	Tile_Size = int(args[9].rstrip()) if len(args) > 9 else 0
+
+	if Tile_Size > 0:
+		if Raster_Engine != "numpy":
+			flmc.log("Tiled processing uses the numpy raster engine.")
+		avoidance = max(min(float(CanopyAvoidance), 1), 0)
+		tiledCanopyCost(CHM_Raster, Min_Canopy_Height, float(args[2].rstrip()), Max_Line_Distance, avoidance,
+						Cost_Raster_Exponent, Tile_Size, outWorkspace, Output_Canopy_Raster, Output_Cost_Raster)
+		return
 
 	# Local variables:
 	FLM_CC_EucRaster = outWorkspace+"\\FLM_CC_EucRaster.tif"
@@ -69,36 +185,63 @@ def main(argv=None):
 	arcpy.gp.Con_sa(CHM_Raster, 1, Output_Canopy_Raster, 0, "VALUE > "+str(Min_Canopy_Height))
 	flmc.logStep("Height threshold")
 	
-	# Process: CC Mean
-	flmc.log("Calculating Focal Mean...")
-	arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_Mean, Tree_Search_Area, "MEAN")
-	flmc.logStep("Focal Mean")
-	
-	# Process: CC StDev
-	flmc.log("Calculating Focal StDev..")
-	arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_StDev, Tree_Search_Area, "STD")
-	flmc.logStep("Focal StDev")
+	if Raster_Engine == "numpy":
+		canopy, x_min, y_max, cell_size = flmc.GetRasterArray(Output_Canopy_Raster)
+		spatial_reference = arcpy.Describe(Output_Canopy_Raster).spatialReference
+
+		# Process: CC Mean and StDev in one pass
+		flmc.log("Calculating Focal Mean and StDev...")
+		mean, std = flmrf.focalMeanStd(canopy, float(args[2].rstrip())/cell_size, "CIRCLE")
+		flmc.SaveArrayAsRaster(mean, x_min, y_max, cell_size, spatial_reference, FLM_CC_Mean)
+		flmc.SaveArrayAsRaster(std, x_min, y_max, cell_size, spatial_reference, FLM_CC_StDev)
+		del mean, std
+		flmc.logStep("Focal Mean and StDev")
+
+		# Process: Euclidean Distance
+		flmc.log("Calculating Euclidean Distance From Canopy...")
+		distance = flmrf.euclideanDistance(canopy >= 1, cell_size, Max_Line_Distance)
+		smoothCost = (Max_Line_Distance - distance)/Max_Line_Distance
+		flmc.SaveArrayAsRaster(smoothCost, x_min, y_max, cell_size, spatial_reference, FLM_CC_SmoothRaster)
+		del canopy, distance, smoothCost
+		flmc.logStep("Euclidean Distance")
+	else:
+		# Process: CC Mean
+		flmc.log("Calculating Focal Mean...")
+		arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_Mean, Tree_Search_Area, "MEAN")
+		flmc.logStep("Focal Mean")
+
+		# Process: CC StDev
+		flmc.log("Calculating Focal StDev..")
+		arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_StDev, Tree_Search_Area, "STD")
+		flmc.logStep("Focal StDev")
 	
-	# Process: Euclidean Distance
-	flmc.log("Calculating Euclidean Distance From Canopy...")
-	EucAllocation(Con(arcpy.Raster(Output_Canopy_Raster) >= 1, 1, ""), "", "", "", "", FLM_CC_EucRaster, "")
-	smoothCost = (float(Max_Line_Distance) - arcpy.Raster(FLM_CC_EucRaster))
-	smoothCost = Con(smoothCost > 0, smoothCost, 0)/float(Max_Line_Distance)
-	smoothCost.save(FLM_CC_SmoothRaster)
-	flmc.logStep("Euclidean Distance")
+		# Process: Euclidean Distance
+		flmc.log("Calculating Euclidean Distance From Canopy...")
+		EucAllocation(Con(arcpy.Raster(Output_Canopy_Raster) >= 1, 1, ""), "", "", "", "", FLM_CC_EucRaster, "")
+		smoothCost = (float(Max_Line_Distance) - arcpy.Raster(FLM_CC_EucRaster))
+		smoothCost = Con(smoothCost > 0, smoothCost, 0)/float(Max_Line_Distance)
+		smoothCost.save(FLM_CC_SmoothRaster)
+		flmc.logStep("Euclidean Distance")
 	
 	# Process: Euclidean Distance
 	flmc.log("Calculating Cost Raster...")
 	arcpy.env.compression = "NONE"
-	Raster_CC = arcpy.Raster(Output_Canopy_Raster)
-	Raster_Mean = arcpy.Raster(FLM_CC_Mean)
-	Raster_StDev = arcpy.Raster(FLM_CC_StDev)
-	Raster_Smooth = arcpy.Raster(FLM_CC_SmoothRaster)
 	avoidance = max(min(float(CanopyAvoidance), 1), 0)
+	if Raster_Engine == "numpy":
+		# Whole formula evaluated block by block in one pass
+		flmre.evaluate(costExpression(flmre.Raster(Output_Canopy_Raster), flmre.Raster(FLM_CC_Mean),
+									  flmre.Raster(FLM_CC_StDev), flmre.Raster(FLM_CC_SmoothRaster),
+									  avoidance, float(Cost_Raster_Exponent)), FLM_CC_CostRaster)
+		outRas = arcpy.Raster(FLM_CC_CostRaster)
+	else:
+		Raster_CC = arcpy.Raster(Output_Canopy_Raster)
+		Raster_Mean = arcpy.Raster(FLM_CC_Mean)
+		Raster_StDev = arcpy.Raster(FLM_CC_StDev)
+		Raster_Smooth = arcpy.Raster(FLM_CC_SmoothRaster)
 
-	# TODO: shorten following sentence
-	outRas = Power(Exp(Con((Raster_CC == 1), 1, Con((Raster_Mean+Raster_StDev <= 0), 0, (1+(Raster_Mean-Raster_StDev)/(Raster_Mean+Raster_StDev))/2)*(1-avoidance) + Raster_Smooth*avoidance)), float(Cost_Raster_Exponent))
-	outRas.save(FLM_CC_CostRaster)
+		# TODO: shorten following sentence
+		outRas = Power(Exp(Con((Raster_CC == 1), 1, Con((Raster_Mean+Raster_StDev <= 0), 0, (1+(Raster_Mean-Raster_StDev)/(Raster_Mean+Raster_StDev))/2)*(1-avoidance) + Raster_Smooth*avoidance)), float(Cost_Raster_Exponent))
+		outRas.save(FLM_CC_CostRaster)
 	flmc.logStep("Cost Raster")
 	
 	flmc.log("Saving Outputs...")
@@ -27,6 +27,7 @@
 # ---------------------------------------------------------------------------
 # System imports
 import os
+import functools
 import multiprocessing
 
 # ArcGIS imports
@@ -36,8 +37,13 @@ from arcpy.sa import *
 # Local imports
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
+import FLM_LeastCostPath as flmlcp
+import FLM_RasterStore as flmrs
+import FLM_ResultCache as flmrc
+import FLM_Timing as flmt
 
 workspaceName = "FLM_CL_output"
+SEARCH_ENGINES = ["arcpy", "dijkstra", "astar"]  # arcpy: CostDistance/CostPathAsPolyline; others are native
 
 
 def PathFile(path):
@@ -142,11 +148,13 @@ def workLinesMem(segment_info):
     Forest_Line_Feature_Class = f.readline().strip()
     Cost_Raster = f.readline().strip()
     Line_Processing_Radius = float(f.readline().strip())
+    Search_Engine = f.readline().strip() or "arcpy"
     f.close()
 
     lineNo = segment_info[1]  # second element is the line No.
     outWorkspaceMem = r"memory"
     arcpy.env.workspace = r"memory"
+    timer = flmt.StageTimer(outWorkspace, lineNo)
 
     fileSeg = os.path.join(outWorkspaceMem, "FLM_CL_Segment_" + str(lineNo))
     fileOrigin = os.path.join(outWorkspaceMem, "FLM_CL_Origin_" + str(lineNo))
@@ -178,6 +186,22 @@ def workLinesMem(segment_info):
         print(e)
         return
 
+    # Native least cost path, no geoprocessing round trip
+    if Search_Engine != "arcpy":
+        try:
+            centerline = centerlineNative(segment_info[0], Cost_Raster, Line_Processing_Radius, Search_Engine)
+        except Exception as e:
+            print("Problem with line starting at X " + str(x1) + ", Y " + str(y1)
+                  + "; and ending at X " + str(x2) + ", Y " + str(y2) + ".")
+            print(e)
+            centerline = []
+            return centerline
+        timer.mark("least cost path")
+        timer.done()
+
+        flmc.log("Processing line {} done".format(lineNo), level=flmc.LINE)
+        return centerline, segment_info[2]
+
     # Create segment feature class
     try:
         arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileSeg), "POLYLINE",
@@ -220,10 +244,12 @@ def workLinesMem(segment_info):
         print("Creating destination feature class failed: at X, Y" + str(xy) + ".")
         print(e)
         return
+    timer.mark("setup")
 
     try:
         # Buffer around line
         arcpy.Buffer_analysis(fileSeg, fileBuffer, Line_Processing_Radius, "FULL", "ROUND", "NONE", "", "PLANAR")
+        timer.mark("buffer")
 
         # Clip cost raster using buffer
         DescBuffer = arcpy.Describe(fileBuffer)
@@ -231,10 +257,12 @@ def workLinesMem(segment_info):
                     str(DescBuffer.extent.XMax) + " " + str(DescBuffer.extent.YMax)
         arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "",
                               "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+        timer.mark("clip")
 
         # Least cost path
         # arcpy.gp.CostDistance_sa(fileOrigin, fileClip, fileCostDist, "", fileCostBack, "", "", "", "", "TO_SOURCE")
         fileCostDist = CostDistance(arcpy.PointGeometry(arcpy.Point(x1, y1)), fileClip, "", fileCostBack)
+        timer.mark("cost distance")
         # print("Cost distance file path: {}".format(fileCostDist))
 
         # arcpy.gp.CostPathAsPolyline_sa(fileDestination, fileCostDist,
@@ -247,6 +275,7 @@ def workLinesMem(segment_info):
         with arcpy.da.SearchCursor(fileCenterline, ["SHAPE@"]) as cursor:
             for row in cursor:
                 centerline.append(row[0])
+        timer.mark("cost path")
 
     except Exception as e:
         print("Problem with line starting at X " + str(x1) + ", Y " + str(y1)
@@ -263,12 +292,43 @@ def workLinesMem(segment_info):
     arcpy.Delete_management(fileClip)
     arcpy.Delete_management(fileCostDist)
     arcpy.Delete_management(fileCostBack)
+    timer.mark("clean up")
+    timer.done()
 
     # Return centerline
-    print("Processing line {} done".format(fileSeg))
+    flmc.log("Processing line {} done".format(fileSeg), level=flmc.LINE)
     return centerline, segment_info[2]
 
 
+def centerlineNative(polyline, Cost_Raster, Line_Processing_Radius, Search_Engine):
+    """
+    Least cost path of one line computed in process on a NumPy window of the cost raster.
+    No temporary feature classes or rasters are created.
+        polyline: input line, the path goes from its first to its last vertex
+        Search_Engine: dijkstra searches the whole buffer, astar stops when
+                       the forward and backward searches meet
+        return: list with the centerline polyline, empty list if no path found
+    """
+    # Read the cost window and keep only cells within the line buffer
+    cost, buffer_mask, x_min, y_max, cell_size, vertices = flmc.GetLineBufferWindow(Cost_Raster, polyline,
+                                                                                    Line_Processing_Radius)
+    if cost.size == 0:
+        return []
+
+    source = flmlcp.pointToCell(vertices[0][0], vertices[0][1], x_min, y_max, cell_size, cost.shape)
+    destination = flmlcp.pointToCell(vertices[-1][0], vertices[-1][1], x_min, y_max, cell_size, cost.shape)
+    if Search_Engine == "astar":
+        path = flmlcp.bidirectionalAStar(cost, source, destination, cell_size, buffer_mask)
+    else:
+        path = flmlcp.leastCostPath(cost, source, destination, cell_size, buffer_mask)
+
+    coords = flmlcp.pathToCoords(path, x_min, y_max, cell_size)
+    if len(coords) < 2:
+        return []
+
+    return [arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in coords]), polyline.spatialReference)]
+
+
 def main(argv=None):
     # Setup script path and workspace folder
     global workspaceName
@@ -295,24 +355,49 @@ def main(argv=None):
     Line_Processing_Radius = args[2].rstrip()
     ProcessSegments = args[3].rstrip() == "True"
     Out_Centerline = args[4].rstrip()
+    Search_Engine = args[5].rstrip() if len(args) > 5 else "arcpy"
+    if Search_Engine not in SEARCH_ENGINES:
+        flmc.log("Search engine {} is not supported, arcpy is used.".format(Search_Engine))
+        Search_Engine = "arcpy"
+    Resume = flmrc.resumeRequested(args, 6)
+    Timing_CSV = args[7].rstrip() if len(args) > 7 else ""
+    Cache_Budget = int(args[8]) if len(args) > 8 and args[8].strip() else flmrs.CACHE_BUDGET
+    Cache_Budget = flmrs.engineCacheBudget(Search_Engine, Cache_Budget)
 
     # write params to text file
     f = open(outWorkspace + "\\params.txt", "w")
     f.write(Forest_Line_Feature_Class + "\n")
     f.write(Cost_Raster + "\n")
     f.write(Line_Processing_Radius + "\n")
+    f.write(Search_Engine + "\n")
+    f.write(str(Cache_Budget) + "\n")
     f.close()
 
     # Prepare input lines for multiprocessing
     fields = flmc.GetAllFieldsFromShp(Forest_Line_Feature_Class)
     segment_all = flmc.SplitLines(Forest_Line_Feature_Class, outWorkspace, "CL", ProcessSegments, fields)
 
-    pool = multiprocessing.Pool(processes=flmc.GetCores())
+    # Segments with results cached by an earlier run are not processed again in resume mode
+    cacheFolder = outWorkspace + "\\cache"
+    cacheParams = ["CL", flmrc.rasterFingerprint(Cost_Raster), Line_Processing_Radius, Search_Engine]
+    tasks, cached = flmrc.pendingSegments(segment_all, cacheFolder, cacheParams, Resume)
+
+    # Native engines read line windows from the cost raster in shared memory
+    descriptors = flmrs.publishRasters([Cost_Raster]) if Search_Engine != "arcpy" and tasks else []
+
+    flmt.resetTimings(outWorkspace)
+    pool = multiprocessing.Pool(processes=flmc.GetCores(), initializer=flmc.InitWorker,
+                                initargs=(flmc.StartLogListener(), flmc.LOG_LEVEL, descriptors, Cache_Budget))
     flmc.log("Multiprocessing center lines...")
     flmc.log("Using {} CPU cores".format(flmc.GetCores()))
-    centerlines = pool.map(workLinesMem, segment_all)
+    computed = flmc.MapInSpatialOrder(pool, functools.partial(flmrc.runCached, workLinesMem, cacheFolder), tasks,
+                                      lambda task: flmc.SegmentCentre(task[2]))
     pool.close()
     pool.join()
+    flmrs.releaseRasters()
+    flmc.StopLogListener()
+    centerlines = flmrc.mergeResults(len(segment_all), tasks, cached, computed)
+    flmt.reportTimings(outWorkspace, Timing_CSV)
     flmc.logStep("Center line multiprocessing done.")
 
     # No line generated, exit
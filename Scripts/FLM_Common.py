@@ -32,6 +32,8 @@
 import time
 import os
 import sys
+import logging
+import logging.handlers
 import multiprocessing
 
 # ArcGIS imports
@@ -44,6 +46,7 @@ except ImportError:
 
 timeStart = time.perf_counter()
 timeLast = timeStart
+stepTimes = []  # (step name, seconds) of every logStep call, read by FLM_Benchmark
 scriptPath = os.path.dirname(os.path.realpath(__file__))
 coresFile = "mpc.txt"
 
@@ -51,6 +54,42 @@ USE_MEMORY_WORKSPACE = 1  # switch of using memory workspace or not
 EPSILON = 1e-9
 NO_DATA = -9999
 
+# Log levels, LINE is used for per line messages of workers
+LINE = 15
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+logging.addLevelName(LINE, "LINE")
+LOG_LEVELS = {"DEBUG": logging.DEBUG, "LINE": LINE, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR,
+              "CRITICAL": logging.CRITICAL}
+LOG_LEVEL = LINE  # messages below this level are dropped, set INFO to silence per line messages
+LOG_FILE = "log.txt"
+LOG_BATCH = 100  # log records buffered before they are written to the log file
+
+logger = logging.getLogger("FLM")  # records propagate to the FLM handlers of the root logger
+logger.setLevel(logging.DEBUG)
+rootHandlers = []  # FLM handlers attached to the root logger
+logHandler = None  # buffered log file handler of the main process
+consoleHandler = None  # prints records of the main process
+logListener = None  # writes records of threads and pool workers to logHandler and consoleHandler
+logQueue = None  # queue of the main process listener, set in pool workers
+
+
+class ConsoleHandler(logging.Handler):
+    """
+    Print records to the current sys.stdout, every record in a single write.
+    Records logged with onlyFile are not printed.
+    """
+    def emit(self, record):
+        if getattr(record, "onlyFile", False):
+            return
+
+        try:
+            sys.stdout.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
 def logStart(tool):
     log("----------")
     global timeStart, timeLast
@@ -70,8 +109,10 @@ def logStep(stepName):
     global timeLast
     timeThis = time.perf_counter()
     log(stepName+" is done! Execution time: "+"{:.2f}".format(timeThis-timeLast)+" seconds")
+    stepTimes.append((stepName, timeThis-timeLast))
     timeLast = timeThis
     log("----------")
+    FlushLog()
 
 
 def logEnd(tool):
@@ -79,26 +120,141 @@ def logEnd(tool):
     timeEnd = time.perf_counter()
     global timeStart
     log("Total Execution Time: "+"{:.2f}".format(timeEnd-timeStart)+" seconds")
+    FlushLog()
 
 
-def log(text, onlyFile = False):
-    if(onlyFile == False):
-        print(text)
-    text_file = open(r"log.txt", "a")
-    text_file.write(text+"\n")
-    text_file.close()
-    del text_file
+def log(text, onlyFile = False, level = INFO):
+    """
+    Print text and write it to the log file.
+    While the log listener runs, threads of the main process and pool workers started
+    with InitWorker send the text through its queue, so every message is printed and
+    written whole by the listener thread, which writes the log file in batches.
+        level: messages below LOG_LEVEL are dropped, LINE for per line messages
+    """
+    if level < LOG_LEVEL:
+        return
+
+    if logQueue is None and multiprocessing.current_process().name != "MainProcess":
+        # Worker without a log queue, append directly
+        if(onlyFile == False):
+            print(text)
+        text_file = open(LOG_FILE, "a")
+        text_file.write(text+"\n")
+        text_file.close()
+        del text_file
+        return
+
+    if not rootHandlers:
+        SetRootHandlers([GetLogHandler(), consoleHandler])
+    logger.log(level, text, extra={"onlyFile": onlyFile})
+
+
+def GetLogHandler():
+    """
+    Buffered handler of the log file in the main process. Records are written
+    every LOG_BATCH records, on errors, at the end of each step and at exit.
+    The console handler is created with it.
+    """
+    global logHandler, consoleHandler
+    if logHandler is None:
+        fileHandler = logging.FileHandler(LOG_FILE, "a", delay=True)
+        fileHandler.setFormatter(logging.Formatter("%(message)s"))
+        logHandler = logging.handlers.MemoryHandler(LOG_BATCH, ERROR, fileHandler)
+        consoleHandler = ConsoleHandler()
+
+    return logHandler
+
+
+def SetRootHandlers(handlers):
+    """
+    Replace the FLM handlers of the root logger, other handlers of the root logger are kept.
+    """
+    global rootHandlers
+    root = logging.getLogger()
+    for handler in rootHandlers:
+        root.removeHandler(handler)
+    rootHandlers = list(handlers)
+    for handler in rootHandlers:
+        root.addHandler(handler)
+
+
+def FlushLog():
+    if logHandler is not None:
+        logHandler.flush()
+
+
+def SetLogLevel(level):
+    """
+    Set the lowest level of logged messages, a level number or a name of LOG_LEVELS such as "INFO".
+    """
+    global LOG_LEVEL
+    if isinstance(level, str) and level.upper() in LOG_LEVELS:
+        level = LOG_LEVELS[level.upper()]
+    if isinstance(level, bool) or not isinstance(level, int):
+        raise ValueError("Log level {} is not valid, use a level number or one of {}.".format(
+            level, ", ".join(LOG_LEVELS)))
+
+    LOG_LEVEL = level
+
+
+def StartLogListener():
+    """
+    Start the listener writing log records of pool workers and threads, call before
+    the pool is created. The root logger sends the records of the main process to the
+    same queue, so records of threads and processes are printed and written one by one.
+        return: queue to pass to InitWorker
+    """
+    global logListener
+    StopLogListener()
+    queue = multiprocessing.Queue()
+    logListener = logging.handlers.QueueListener(queue, GetLogHandler(), consoleHandler)
+    logListener.start()
+    SetRootHandlers([logging.handlers.QueueHandler(queue)])
+
+    return queue
+
+
+def StopLogListener():
+    """
+    Write the remaining records of pool workers, call after the pool is joined.
+    """
+    global logListener
+    if logListener is not None:
+        SetRootHandlers([GetLogHandler(), consoleHandler])
+        logListener.stop()
+        logListener = None
+    FlushLog()
+
+
+def InitWorker(log_queue, log_level, descriptors=(), cache_budget=None):
+    """
+    Pool initializer, send log records to the main process and attach the
+    rasters published by FLM_RasterStore.
+        cache_budget: bytes of the tile cache of the worker, None for FLM_RasterStore.CACHE_BUDGET
+    """
+    import FLM_RasterStore
+
+    global logQueue, LOG_LEVEL
+    logQueue = log_queue
+    LOG_LEVEL = log_level
+    SetRootHandlers([logging.handlers.QueueHandler(log_queue)])
+
+    if cache_budget is None:
+        cache_budget = FLM_RasterStore.CACHE_BUDGET
+    FLM_RasterStore.attachRasters(descriptors, cache_budget)
 
 
 def refreshLog():
-    text_file = open(r"log.txt", "w")
+    FlushLog()
+    text_file = open(LOG_FILE, "w")
     text_file.write("")
     text_file.close()
     del text_file
 
 
 def newLog(version):
-    text_file = open(r"log.txt", "a")
+    FlushLog()
+    text_file = open(LOG_FILE, "a")
     text_file.write("\n\n###\n\n\n")
     text_file.close()
     log("Forest Line Mapper v. "+str(version))
@@ -264,7 +420,8 @@ def SplitLines(linesFc, outWorkspace, toolCodename, ProcessSegments,
 
       outWorkspace: where files are placed in
       toolCodename: base name to make subfolder for tools in workspace in format FLM_toolCodename_output
-      polygons: list of lidar coverage polygon geometry with year [(polygon geometry, year), ...]
+      polygons: optional function of a segment polyline returning the IDs of the lidar coverage
+                polygons it may touch, see FLM_Pretagging.coverageCandidates
       KeepFieldName: fields to transfer from the inputs to the outputs.
 
     Return:
@@ -341,7 +498,8 @@ def SplitLines(linesFc, outWorkspace, toolCodename, ProcessSegments,
                         array.add(segment_list[vertexID+1])
                     polyline = arcpy.Polyline(array, arcpy.Describe(linesFc).spatialReference)
                     # add segments and attributes for later return
-                    all_segments.append([polyline, line, dict(zip(KeepFieldName, KeepFieldValue)), polygons])
+                    all_segments.append([polyline, line, dict(zip(KeepFieldName, KeepFieldValue)),
+                                         polygons(polyline) if polygons else None])
 
                     if not USE_MEMORY_WORKSPACE:
                         cursor.insertRow(KeepFieldValue + [polyline])
@@ -745,6 +903,293 @@ def SplitFeature (fc, idField, outWorkspace, toolCodename):
     logStep("Feature Split")
 
 
+def SegmentCentre(item):
+    """
+    Centre of the bounding box of the first geometry in a segment item of all_segments.
+    """
+    for value in item:
+        if isinstance(value, arcpy.Geometry):
+            extent = value.extent
+            return (extent.XMin + extent.XMax) / 2.0, (extent.YMin + extent.YMax) / 2.0
+
+    return 0.0, 0.0
+
+
+def HilbertIndex(x, y, order=16):
+    """
+    Distance along the Hilbert curve of points, near points get near indices.
+        x, y: arrays of point coordinates
+        order: curve order, the extent of the points is divided into 2^order cells per side
+    """
+    import numpy
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    side = 2 ** order
+    span = max(x.max() - x.min(), y.max() - y.min(), EPSILON)
+    xi = numpy.minimum(((x - x.min()) / span * side).astype(numpy.int64), side - 1)
+    yi = numpy.minimum(((y - y.min()) / span * side).astype(numpy.int64), side - 1)
+
+    index = numpy.zeros(x.shape, dtype=numpy.int64)
+    s = side // 2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant
+        flip = ~ry & rx
+        xi[flip] = side - 1 - xi[flip]
+        yi[flip] = side - 1 - yi[flip]
+        swap = ~ry
+        xi[swap], yi[swap] = yi[swap], xi[swap]
+        s //= 2
+
+    return index
+
+
+def SpatialOrder(items, centre=SegmentCentre):
+    """
+    Order of items along the Hilbert curve of their centres.
+        items: list of work items, such as all_segments
+        centre: function giving the (x, y) centre of an item
+        return: list of item indices
+    """
+    import numpy
+
+    if len(items) < 2:
+        return list(range(len(items)))
+
+    points = numpy.array([centre(item) for item in items], dtype=numpy.float64)
+    index = HilbertIndex(points[:, 0], points[:, 1])
+
+    return numpy.argsort(index, kind="stable").tolist()
+
+
+def MapInSpatialOrder(pool, func, items, centre=SegmentCentre):
+    """
+    pool.map over items sorted along the Hilbert curve.
+    pool.map hands out contiguous chunks, so each worker processes neighbouring
+    lines and its raster windows and tile cache are reused. Results are returned
+    in the order of items.
+    """
+    order = SpatialOrder(items, centre)
+    results = pool.map(func, [items[i] for i in order])
+
+    ordered = [None] * len(items)
+    for i, result in zip(order, results):
+        ordered[i] = result
+
+    return ordered
+
+
+def PointsAlongLines(vertices, group, interval, end_points=False):
+    """
+    Points every interval along many lines, as GeneratePointsAlongLines with DISTANCE.
+      vertices: (n, 2) array of the vertices of all lines, a line is a run of vertices
+      group: line ID of every vertex, sorted so the vertices of a line are together
+      interval: distance between points, the first point is the start of the line
+      end_points: add the end point of every line, as END_POINTS
+
+    Return:
+      x, y, group arrays of the points in line order, lines with a single vertex have no points
+    """
+    import numpy
+
+    # Distance of the vertices along their line
+    vector = vertices[1:] - vertices[:-1]
+    length = numpy.hypot(vector[:, 0], vector[:, 1])
+    length[(group[1:] != group[:-1]) | numpy.isnan(length)] = 0.0
+    measure = numpy.concatenate(([0.0], numpy.cumsum(length)))
+
+    groups, first = numpy.unique(group, return_index=True)
+    last = numpy.append(first[1:], len(group)) - 1
+    keep = last > first
+    groups, first, last = groups[keep], first[keep], last[keep]
+    line_length = measure[last] - measure[first]
+
+    # Point distances: every interval from the start and optionally the end point
+    n_points = numpy.floor(line_length / interval).astype(numpy.int64) + 1
+    if end_points:
+        n_points += line_length - (n_points - 1) * interval > 1e-9
+    sample_group = numpy.repeat(numpy.arange(len(groups)), n_points)
+    step = numpy.arange(n_points.sum()) - numpy.repeat(numpy.cumsum(n_points) - n_points, n_points)
+    distance = numpy.minimum(step * interval, line_length[sample_group])
+
+    # Locate the segment of every point
+    at = measure[first][sample_group] + distance
+    segment = numpy.searchsorted(measure, at, side="right") - 1
+    segment = numpy.clip(segment, first[sample_group], last[sample_group] - 1)
+    seg_length = length[segment]
+    ratio = numpy.zeros_like(at)
+    numpy.divide(at - measure[segment], seg_length, out=ratio, where=seg_length > 0)
+    xy = vertices[segment] + vector[segment] * ratio[:, None]
+
+    return xy[:, 0], xy[:, 1], groups[sample_group]
+
+
+def PercentileByGroup(values, group, n_groups, percentile):
+    """
+    Percentile of the values of every group, as numpy.percentile with linear interpolation.
+      values: float array
+      group: group ID from 0 to n_groups - 1 of every value
+
+    Return:
+      array of n_groups, NaN for groups without values
+    """
+    import numpy
+
+    order = numpy.lexsort((values, group))
+    values = values[order]
+    counts = numpy.bincount(group, minlength=n_groups)
+    starts = numpy.cumsum(counts) - counts
+
+    result = numpy.full(n_groups, numpy.nan)
+    valid = counts > 0
+    position = (counts[valid] - 1) * percentile / 100.0
+    low = numpy.floor(position).astype(numpy.int64)
+    high = numpy.ceil(position).astype(numpy.int64)
+    low_value = values[starts[valid] + low]
+    high_value = values[starts[valid] + high]
+    result[valid] = low_value + (high_value - low_value) * (position - low)
+
+    return result
+
+
+def GetRasterBlock(raster, row, col, nrows, ncols):
+    """
+    Read a block of cells of raster into a NumPy array by grid position.
+      raster: arcpy.Raster
+      row, col: first row and column of the block, counted from the upper left
+      nrows, ncols: block size in cells, must be within the raster
+
+    Return:
+      2D float array with NoData as NaN, first row is the top of the block
+    """
+    import numpy
+
+    cell_size = raster.meanCellWidth
+    lower_left = arcpy.Point(raster.extent.XMin + col * cell_size,
+                             raster.extent.YMax - (row + nrows) * cell_size)
+
+    # NoData cells are read as the raster NoData value, which works for integer rasters too
+    block = arcpy.RasterToNumPyArray(raster, lower_left, ncols, nrows).astype(numpy.float64)
+    if raster.noDataValue is not None:
+        block[block == raster.noDataValue] = numpy.nan
+
+    return block
+
+
+def GetRasterWindow(raster, extent):
+    """
+    Read the cells of raster covering extent into a NumPy array.
+    The window is snapped to the raster grid and clamped to the raster extent.
+      raster: raster path or arcpy.Raster
+      extent: (XMin, YMin, XMax, YMax) in map units
+
+    Return:
+      window: 2D float array with NoData as NaN, first row is the top of the window.
+              For rasters in FLM_RasterStore it is a read only float32 view,
+              for other raster paths it is assembled from the tile cache.
+      x_min, y_max: map coordinates of the upper left corner of the window
+      cell_size: raster cell size
+    """
+    import math
+    import numpy
+    import FLM_RasterStore
+
+    shared = FLM_RasterStore.getWindow(raster, extent)
+    if shared is not None:
+        return shared
+
+    cached = FLM_RasterStore.getCachedWindow(raster, extent)
+    if cached is not None:
+        return cached
+
+    if not isinstance(raster, arcpy.Raster):
+        raster = arcpy.Raster(raster)
+
+    cell_size = raster.meanCellWidth
+    r_ext = raster.extent
+    col_min = max(int(math.floor((extent[0] - r_ext.XMin) / cell_size)), 0)
+    col_max = min(int(math.ceil((extent[2] - r_ext.XMin) / cell_size)), raster.width)
+    row_min = max(int(math.floor((r_ext.YMax - extent[3]) / cell_size)), 0)
+    row_max = min(int(math.ceil((r_ext.YMax - extent[1]) / cell_size)), raster.height)
+
+    x_min = r_ext.XMin + col_min * cell_size
+    y_max = r_ext.YMax - row_min * cell_size
+    ncols = col_max - col_min
+    nrows = row_max - row_min
+    if ncols <= 0 or nrows <= 0:
+        return numpy.empty((0, 0)), x_min, y_max, cell_size
+
+    window = GetRasterBlock(raster, row_min, col_min, nrows, ncols)
+
+    return window, x_min, y_max, cell_size
+
+
+def GetRasterArray(raster):
+    """
+    Read the whole raster into a NumPy array, see GetRasterWindow.
+    """
+    if not isinstance(raster, arcpy.Raster):
+        raster = arcpy.Raster(raster)
+
+    window = GetRasterBlock(raster, 0, 0, raster.height, raster.width)
+
+    return window, raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth
+
+
+def SaveArrayAsRaster(array, x_min, y_max, cell_size, spatial_reference, out_raster, nodata_value=None):
+    """
+    Save a NumPy array as a raster.
+      array: 2D array, first row is the top of the raster
+      x_min, y_max: map coordinates of the upper left corner
+      spatial_reference: arcpy.SpatialReference of the output
+      nodata_value: None saves a float raster with NaN cells as NoData,
+                    otherwise the array type is kept and nodata_value is NoData
+    """
+    import numpy
+
+    if nodata_value is None:
+        array = array.astype(numpy.float32)
+        nodata_value = numpy.nan
+
+    lower_left = arcpy.Point(x_min, y_max - array.shape[0] * cell_size)
+    raster = arcpy.NumPyArrayToRaster(array, lower_left, cell_size, cell_size, nodata_value)
+    raster.save(out_raster)
+    arcpy.DefineProjection_management(out_raster, spatial_reference)
+    del raster
+
+
+def GetLineBufferWindow(raster, polyline, radius):
+    """
+    Read the raster window around polyline and the mask of its cells within
+    the round line buffer of radius. Together they replace clipping the raster
+    with the buffer: the window is not copied, so for rasters in FLM_RasterStore
+    it stays a read only view and the mask is passed to FLM_LeastCostPath.
+
+    Return:
+      window, x_min, y_max, cell_size: as returned by GetRasterWindow
+      mask: boolean array of the window cells within the line buffer
+      vertices: list of (x, y) of the polyline
+    """
+    import numpy
+    import FLM_LeastCostPath as flmlcp
+
+    vertices = [(pt.X, pt.Y) for part in polyline for pt in part if pt]
+    ext = polyline.extent
+    search_box = (ext.XMin - radius, ext.YMin - radius, ext.XMax + radius, ext.YMax + radius)
+
+    window, x_min, y_max, cell_size = GetRasterWindow(raster, search_box)
+    if window.size > 0:
+        mask = flmlcp.lineBufferMask(window.shape, x_min, y_max, cell_size, vertices, radius)
+    else:
+        mask = numpy.zeros(window.shape, dtype=bool)
+
+    return window, mask, x_min, y_max, cell_size, vertices
+
+
 def HasField(fc, fi):
   fieldnames = [field.name for field in arcpy.ListFields(fc)]
   if fi in fieldnames:
@@ -766,3 +1211,46 @@ def GetAllFieldsFromShp(in_shp):
 
     return fields
 
+
+
+def PercentileValues(seg):
+    """
+    Field values of a canopy percentile result of the dynamic canopy tools.
+      seg: [record ID, percentile L, percentile R, threshold L, threshold R]
+
+    Return:
+      percentile L, percentile R, threshold L, threshold R, Buf_Side and mean threshold
+    """
+    if seg[1] != 0 and seg[3] != 0:
+        side = "Left, Right"
+    elif seg[2] == None and seg[4] != 0:
+        side = "Right"
+    elif seg[2] != 0 and seg[4] == None:
+        side = "Left"
+    else:
+        side = "None"
+
+    return [seg[1], seg[2], seg[3], seg[4], side, (seg[3] + seg[4]) / 2]
+
+
+def UpdateRowsByOID(fc, fields, values):
+    """
+    Write values to many rows of a feature class in one cursor pass.
+      fc: feature class or table
+      fields: field names, the first is OID@
+      values: dictionary of OID to the values of the other fields
+
+    Return:
+      number of rows updated
+    """
+    updated = 0
+    with arcpy.da.UpdateCursor(fc, fields) as cursor:
+        for row in cursor:
+            row_values = values.get(row[0])
+            if row_values is None:
+                continue
+
+            cursor.updateRow([row[0]] + list(row_values))
+            updated += 1
+
+    return updated
@@ -49,11 +49,13 @@ from arcpy.sa import *
 
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
+import FLM_RasterStore as flmrs
 
 workspaceName = "FLM_DLFP_output"
 outWorkspace = ""
 Corridor_Threshold_Field = ""
 Maximum_distance_from_centerline = 0
+SAMPLING_ENGINES = ["arcpy", "native"]
 
 
 def PathFile(path):
@@ -85,6 +87,90 @@ def CopyParallel(plyP, sLength):
     return leftsection, rightsection
 
 
+def parallelSamples(lines, sLength, interval):
+    """
+    Sample points along the left and right parallel lines of all lines at once.
+    The parallel lines are offset at the vertices as CopyParallel does, and the
+    points are placed as GeneratePointsAlongLines with DISTANCE and END_POINTS.
+        lines: list of vertex arrays of shape (n, 2)
+        sLength: offset distance of the parallel lines
+        interval: distance between points
+        return: x, y, group arrays, group is 2 * line index for left, + 1 for right
+    """
+    counts = numpy.array([len(line) for line in lines], dtype=numpy.int64)
+    if counts.sum() == 0:
+        return numpy.empty(0), numpy.empty(0), numpy.empty(0, dtype=numpy.int64)
+
+    pts = numpy.concatenate([line for line in lines if len(line) > 0])
+    line_id = numpy.repeat(numpy.arange(len(lines)), counts)
+
+    # Unit vectors of the segments, zero between lines
+    vector = pts[1:] - pts[:-1]
+    length = numpy.hypot(vector[:, 0], vector[:, 1])
+    in_line = (line_id[1:] == line_id[:-1]) & (length > 0)
+    unit = numpy.zeros_like(vector)
+    unit[in_line] = vector[in_line] / length[in_line, None]
+
+    # Direction at the vertices from the segments before and after
+    tangent = numpy.zeros_like(pts)
+    tangent[1:] += unit
+    tangent[:-1] += unit
+    norm = numpy.hypot(tangent[:, 0], tangent[:, 1])
+    norm[norm == 0] = numpy.nan
+    shift = numpy.column_stack((-tangent[:, 1], tangent[:, 0])) * (sLength / norm)[:, None]
+
+    vertices = numpy.concatenate((pts + shift, pts - shift))
+    group = numpy.concatenate((line_id * 2, line_id * 2 + 1))
+    order = numpy.argsort(group, kind="stable")
+    vertices = vertices[order]
+    group = group[order]
+
+    return flmc.PointsAlongLines(vertices, group, interval, True)
+
+
+def nativePercentiles(seg_all, chm, Search_R, Canopy_Percentile, CanopyTh_Percent, interval):
+    """
+    Canopy percentile and threshold of the left and right sides of all simplified lines.
+    The CHM is read at the nearest cell of every parallel line point, points on NoData
+    or outside the CHM are excluded.
+        seg_all: records of the simplified lines, the ID first and the geometry last
+        return: list of [record ID, percentile left, percentile right, threshold left, threshold right]
+                as Forest_Matrix_Percentile_S
+    """
+    Canopy_Percentile_value = int(Canopy_Percentile)
+
+    # Check the canopy threshold percent in 0-100 range.  If it is not, 50% will be applied
+    if 100.0 > float(int(CanopyTh_Percent)) > 0.0:
+        CanopyTh_Percent_value = float(int(CanopyTh_Percent) / 100)
+    else:
+        CanopyTh_Percent_value = 0.5
+
+    lines = []
+    for record in seg_all:
+        if record[-1]:
+            lines.append(numpy.array([[pt.X, pt.Y] for pt in record[-1].getPart(0) if pt]))
+        else:
+            lines.append(numpy.empty((0, 2)))
+
+    x, y, group = parallelSamples(lines, float(Search_R), interval)
+    values = flmrs.sampleRaster(chm, x, y, "NEAREST")
+    valid = ~numpy.isnan(values)
+    percentiles = flmc.PercentileByGroup(values[valid], group[valid], len(lines) * 2, Canopy_Percentile_value)
+
+    results = []
+    for i, record in enumerate(seg_all):
+        result_PercentileL = percentiles[i * 2]
+        result_PercentileR = percentiles[i * 2 + 1]
+        if numpy.isnan(result_PercentileL) or numpy.isnan(result_PercentileR):
+            arcpy.AddMessage("Something wrong when calculating Percentile for line {}".format(str(record[0])))
+            results.append([record[0], 0, 0, 0, 0])
+        else:
+            results.append([record[0], result_PercentileL, result_PercentileR,
+                            result_PercentileL * CanopyTh_Percent_value, result_PercentileR * CanopyTh_Percent_value])
+
+    return results
+
+
 def addFields(Splited_cl, Canopy_Percentile_Field,CanopyTh_Field):
     try:  # rest and recreate Canopy Percentile in simplified Left centerline table
         if arcpy.ListFields(Splited_cl, Canopy_Percentile_Field + "L"):
@@ -374,7 +460,8 @@ def update_simpCL(seg,fieldName,split_simCL, wherecluase):
 
 def Percentile_Call(workspaceName, outWorkspace, Centerline_Feature_Class, Output_Dir, chm, Search_R,
                     Canopy_Percentile, CanopyTh_Percent, ProcessSegments,
-                    TreeSearchRadius, MaximumLineDistance, CanopyAvoidance, CostRasterExponent):
+                    TreeSearchRadius, MaximumLineDistance, CanopyAvoidance, CostRasterExponent,
+                    Sampling_Engine="arcpy"):
     # outWorkspace = flmc.SetupWorkspace(workspaceName)
     #outWorkspace = flmc.GetWorkspace(workspaceName)
     arcpy.env.workspace = outWorkspace
@@ -438,57 +525,11 @@ def Percentile_Call(workspaceName, outWorkspace, Centerline_Feature_Class, Outpu
     arcpy.management.CalculateField(Splited_simplify_cl, "SLnID", "!OBJECTID!")
 
 
-    workspace = os.path.dirname(Splited_simplify_cl)
-    # create a copy parallel polyline class
-    # create a list contains all the fields from simplified CL except geometry
-    lstFields = [field.name for field in arcpy.ListFields(Splited_simplify_cl) if field.type not in ['Geometry']]
-    # Append Geometry at the end of the list
-    lstFields.append("SHAPE@")
-    # Get the list index for field: "CorridorTh"
-    CorridorTh_index = (lstFields.index("CorridorTh"))
-    # Get the list index for field: "Buf_Side"
-    Buf_Side_index = (lstFields.index("Buf_Side"))
-    # Get the list index for field: "Search_R"
-    Search_R_index = (lstFields.index("Search_R"))
-    # Get the list index for field: "Shape@" geometry
-    lastitem_index = len(lstFields) - 1
-
-    # Copy a new simplified lines FC for parallel lines (left and right)
-    Splited_simplify_parallelline = r"memory/simplify_parallelline"
-    arcpy.CopyFeatures_management(Splited_simplify_cl, Splited_simplify_parallelline)
     Temp_Splited_simplify_cl=os.path.abspath(os.path.realpath(Output_Dir) + "/" \
                                  + os.path.basename(Centerline_Feature_Class).rpartition('.')[
                                      0] + ProcMode+"_Simplified_CL.shp")
     arcpy.CopyFeatures_management(Splited_simplify_cl,Temp_Splited_simplify_cl)
 
-
-    arcpy.AddMessage("Copy parallel lines from simplified centerline......")
-    edit = arcpy.da.Editor(workspace)
-    edit.startEditing(False, True)
-    edit.startOperation()
-    inCursor = arcpy.da.InsertCursor(Splited_simplify_parallelline, lstFields)
-    with arcpy.da.UpdateCursor(Splited_simplify_parallelline, lstFields) as cursor:
-        for row in cursor:
-            if row[lastitem_index]:
-                twoLines = CopyParallel(row[lastitem_index], row[Search_R_index])
-                row[Buf_Side_index] = "LEFT"
-                row[-1] = twoLines[0]
-                cursor.updateRow(row)
-                row[Buf_Side_index] = "RIGHT"
-                row[-1] = twoLines[1]
-                inCursor.insertRow(row)
-    del cursor
-    del inCursor
-    del Buf_Side_index
-    del Search_R_index
-    del lastitem_index
-    del lstFields
-    del twoLines
-
-    edit.stopOperation()
-    edit.stopEditing(True)
-
-
     # Get raster cell size equivalent for points interval
     CHMCellx = arcpy.GetRasterProperties_management(chm, "CELLSIZEX").getOutput(0)
 
@@ -501,114 +542,128 @@ def Percentile_Call(workspaceName, outWorkspace, Centerline_Feature_Class, Outpu
 
     # print(Cell_size)
 
-
-    points_interval = str(Cell_size) + " Meters"
-    # arcpy.AddMessage(points_interval)
-
-    # Generate points along simplified parallel lines (left and right) @ Cell Size interval
-    arcpy.AddMessage(
-        "Generate raster cell size equivalent ({}) interval points along parallel lines......".format(points_interval))
-    with arcpy.EnvManager(outputZFlag="Enabled", outputMFlag="Enabled"):
-        arcpy.management.GeneratePointsAlongLines(Splited_simplify_parallelline, r"memory/pointalonglines",
-                                                  "DISTANCE", points_interval, None, "END_POINTS")
-    arcpy.AddMessage(
-        "Generate raster cell size equivalent ({}) interval points along parallel lines......Done".format(
-            points_interval))
-
-    # assign output points feature class name and path from the results of parallel lines
-    mem_pointsAlongParallelLine = r"in_memory/pointsAlongParallelLine"
-
-    # Add Z value base on CHM into points along parallel line
-    arcpy.AddMessage("Interpolate points Z value")
-    arcpy.ddd.InterpolateShape(chm, r"memory/pointalonglines", mem_pointsAlongParallelLine, None, 1, "NEAREST",
-                               "VERTICES_ONLY",
-                               0, "EXCLUDE")
-    arcpy.Delete_management(r"memory/pointalonglines")
-
-
-    if arcpy.ListFields(mem_pointsAlongParallelLine, "Z"):
-        arcpy.DeleteField_management(mem_pointsAlongParallelLine, "Z")
-        arcpy.AddField_management(mem_pointsAlongParallelLine, "Z", "DOUBLE")
+    if Sampling_Engine == "native":
+        arcpy.AddMessage("Sample canopy along parallel lines at {} meters interval......".format(Cell_size))
+        updated_simCL_list = nativePercentiles(Alllistline, chm, Search_R, Canopy_Percentile, CanopyTh_Percent,
+                                               Cell_size)
     else:
-        arcpy.AddField_management(mem_pointsAlongParallelLine, "Z", "DOUBLE")
+        workspace = os.path.dirname(Splited_simplify_cl)
+        # create a copy parallel polyline class
+        # create a list contains all the fields from simplified CL except geometry
+        lstFields = [field.name for field in arcpy.ListFields(Splited_simplify_cl) if field.type not in ['Geometry']]
+        # Append Geometry at the end of the list
+        lstFields.append("SHAPE@")
+        # Get the list index for field: "CorridorTh"
+        CorridorTh_index = (lstFields.index("CorridorTh"))
+        # Get the list index for field: "Buf_Side"
+        Buf_Side_index = (lstFields.index("Buf_Side"))
+        # Get the list index for field: "Search_R"
+        Search_R_index = (lstFields.index("Search_R"))
+        # Get the list index for field: "Shape@" geometry
+        lastitem_index = len(lstFields) - 1
+
+        # Copy a new simplified lines FC for parallel lines (left and right)
+        Splited_simplify_parallelline = r"memory/simplify_parallelline"
+        arcpy.CopyFeatures_management(Splited_simplify_cl, Splited_simplify_parallelline)
+
+
+        arcpy.AddMessage("Copy parallel lines from simplified centerline......")
+        edit = arcpy.da.Editor(workspace)
+        edit.startEditing(False, True)
+        edit.startOperation()
+        inCursor = arcpy.da.InsertCursor(Splited_simplify_parallelline, lstFields)
+        with arcpy.da.UpdateCursor(Splited_simplify_parallelline, lstFields) as cursor:
+            for row in cursor:
+                if row[lastitem_index]:
+                    twoLines = CopyParallel(row[lastitem_index], row[Search_R_index])
+                    row[Buf_Side_index] = "LEFT"
+                    row[-1] = twoLines[0]
+                    cursor.updateRow(row)
+                    row[Buf_Side_index] = "RIGHT"
+                    row[-1] = twoLines[1]
+                    inCursor.insertRow(row)
+        del cursor
+        del inCursor
+        del Buf_Side_index
+        del Search_R_index
+        del lastitem_index
+        del lstFields
+        del twoLines
+
+        edit.stopOperation()
+        edit.stopEditing(True)
+
+
+
+        points_interval = str(Cell_size) + " Meters"
+        # arcpy.AddMessage(points_interval)
+
+        # Generate points along simplified parallel lines (left and right) @ Cell Size interval
+        arcpy.AddMessage(
+            "Generate raster cell size equivalent ({}) interval points along parallel lines......".format(points_interval))
+        with arcpy.EnvManager(outputZFlag="Enabled", outputMFlag="Enabled"):
+            arcpy.management.GeneratePointsAlongLines(Splited_simplify_parallelline, r"memory/pointalonglines",
+                                                      "DISTANCE", points_interval, None, "END_POINTS")
+        arcpy.AddMessage(
+            "Generate raster cell size equivalent ({}) interval points along parallel lines......Done".format(
+                points_interval))
+
+        # assign output points feature class name and path from the results of parallel lines
+        mem_pointsAlongParallelLine = r"in_memory/pointsAlongParallelLine"
+
+        # Add Z value base on CHM into points along parallel line
+        arcpy.AddMessage("Interpolate points Z value")
+        arcpy.ddd.InterpolateShape(chm, r"memory/pointalonglines", mem_pointsAlongParallelLine, None, 1, "NEAREST",
+                                   "VERTICES_ONLY",
+                                   0, "EXCLUDE")
+        arcpy.Delete_management(r"memory/pointalonglines")
+
+
+        if arcpy.ListFields(mem_pointsAlongParallelLine, "Z"):
+            arcpy.DeleteField_management(mem_pointsAlongParallelLine, "Z")
+            arcpy.AddField_management(mem_pointsAlongParallelLine, "Z", "DOUBLE")
+        else:
+            arcpy.AddField_management(mem_pointsAlongParallelLine, "Z", "DOUBLE")
 
-    arcpy.management.CalculateGeometryAttributes(mem_pointsAlongParallelLine, "Z POINT_Z", '', '', None, "SAME_AS_INPUT")
+        arcpy.management.CalculateGeometryAttributes(mem_pointsAlongParallelLine, "Z POINT_Z", '', '', None, "SAME_AS_INPUT")
 
 
-    pointsAlongParallelLine = os.path.realpath(Output_Dir) + "/" \
-                             + os.path.basename(Centerline_Feature_Class).rpartition('.')[0]  + ProcMode+ "_ParallelPts.shp"
-    arcpy.CopyFeatures_management(mem_pointsAlongParallelLine, pointsAlongParallelLine)
+        pointsAlongParallelLine = os.path.realpath(Output_Dir) + "/" \
+                                 + os.path.basename(Centerline_Feature_Class).rpartition('.')[0]  + ProcMode+ "_ParallelPts.shp"
+        arcpy.CopyFeatures_management(mem_pointsAlongParallelLine, pointsAlongParallelLine)
 
-    #arcpy.Delete_management("PointsAlongParalelineLy")
-    arcpy.Delete_management(mem_pointsAlongParallelLine)
+        #arcpy.Delete_management("PointsAlongParalelineLy")
+        arcpy.Delete_management(mem_pointsAlongParallelLine)
 
-    # multiprocessing for Canopy Percentile and Canopy Threshold (lef and right)
-    arcpy.AddMessage("Create Canopy Percentile and Threshold......")
+        # multiprocessing for Canopy Percentile and Canopy Threshold (lef and right)
+        arcpy.AddMessage("Create Canopy Percentile and Threshold......")
 
-    seg_line1 = partial(Forest_Matrix_Percentile_S, chm=chm, Canopy_Percentile=Canopy_Percentile,
-                       CanopyTh_Percent=CanopyTh_Percent,
-                       pointsAlongParallelLine=pointsAlongParallelLine, ProcessSegments=ProcessSegments,
-                       Canopy_Percentile_FieldL=Canopy_Percentile_Field + "L", Canopy_Percentile_FieldR=Canopy_Percentile_Field + "R"
-                       , CanopyTh_FieldL=CanopyTh_Field + "L", CanopyTh_FieldR=CanopyTh_Field + "R", Buf_Side="Buf_Side",
-                       CanopyTh_FieldM=CanopyTh_Field + "M", CorridorTh="CorridorTh", split_simCL=Temp_Splited_simplify_cl)
+        seg_line1 = partial(Forest_Matrix_Percentile_S, chm=chm, Canopy_Percentile=Canopy_Percentile,
+                           CanopyTh_Percent=CanopyTh_Percent,
+                           pointsAlongParallelLine=pointsAlongParallelLine, ProcessSegments=ProcessSegments,
+                           Canopy_Percentile_FieldL=Canopy_Percentile_Field + "L", Canopy_Percentile_FieldR=Canopy_Percentile_Field + "R"
+                           , CanopyTh_FieldL=CanopyTh_Field + "L", CanopyTh_FieldR=CanopyTh_Field + "R", Buf_Side="Buf_Side",
+                           CanopyTh_FieldM=CanopyTh_Field + "M", CorridorTh="CorridorTh", split_simCL=Temp_Splited_simplify_cl)
 
 
 
-    arcpy.AddMessage("Multiprocessing Canopy Threshold calculation...")
-    arcpy.AddMessage("Using {} CPU cores".format(str(multiprocessing.cpu_count())))
-    wherecluase = arcpy.Describe(Temp_Splited_simplify_cl).OIDFieldName
+        arcpy.AddMessage("Multiprocessing Canopy Threshold calculation...")
+        arcpy.AddMessage("Using {} CPU cores".format(str(multiprocessing.cpu_count())))
+        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+        updated_simCL_list = pool.map(seg_line1, Alllistline)
+        pool.close()
+        pool.join()
 
     fieldNames = ["OID@", Canopy_Percentile_Field + "L", Canopy_Percentile_Field + "R", CanopyTh_Field + "L",
-                  CanopyTh_Field + "R", "Buf_Side", CanopyTh_Field + "M", "CorridorTh", "SHAPE@"]
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-
-    with arcpy.da.Editor(os.path.dirname(pointsAlongParallelLine)) as edit:
-
-        updated_simCL_list=pool.map(seg_line1, Alllistline)
+                  CanopyTh_Field + "R", "Buf_Side", CanopyTh_Field + "M"]
+    with arcpy.da.Editor(os.path.dirname(Temp_Splited_simplify_cl)) as edit:
 
         print("Updating Percentile Statistic into CL attributes........")
 
-        for seg in updated_simCL_list:
-            try:
-                sqlcluase = "{}={}".format(wherecluase,seg[0] - 1)
-            # print(wherecluase)
-            except Exception as e:
-                print("Cannot create wherecluase")
-                print(e)
-
-            try:
-                upcursor = arcpy.da.UpdateCursor(Temp_Splited_simplify_cl,fieldNames,sqlcluase)
-            except Exception as e:
-                print(e)
-                print("Cannot create UpdateCursor for simple CL {}".format(seg[0]))
-            # arcpy.SelectLayerByAttribute_management(split_simCL, "CLEAR_SELECTION", sqlcluase)
-            try:
-                for row in upcursor:
-
-                    row[1] = seg[1]
-                    row[2] = seg[2]
-                    row[3] = seg[3]
-                    row[4] = seg[4]
-                    if seg[1] != 0 and seg[3] != 0:
-                        row[5] = "Left, Right"
-                    elif seg[2] == None and seg[4] != 0:
-                        row[5] = "Right"
-                    elif seg[2] != 0 and seg[4] == None:
-                        row[5] = "Left"
-                    else:
-                        row[5] = "None"
-
-                    row[6] = (seg[3] + seg[4]) / 2
-
-                    upcursor.updateRow(row)
-                    print("Updating Simplified CL: {}".format(seg[0]))
-
-                del upcursor
-            except Exception as e:
-                print(e)
-                print("Cannot Update simpCL for simple CL {}".format(seg[0]))
-    pool.close()
-    pool.join()
+        # Results are keyed by the FID of the simplified CL shapefile, written in one cursor pass
+        updates = {seg[0] - 1: flmc.PercentileValues(seg) for seg in updated_simCL_list}
+        updated = flmc.UpdateRowsByOID(Temp_Splited_simplify_cl, fieldNames, updates)
+        print("Updated {} of {} simplified CL.".format(updated, len(updates)))
 
 
 
@@ -680,6 +735,11 @@ def main(argv=None):
     CanopyAvoidance = float(args[8].rstrip())
     global CostRasterExponent
     CostRasterExponent = float(args[9].rstrip())
+    global Sampling_Engine
+    Sampling_Engine = args[10].rstrip() if len(args) > 10 and args[10] else "arcpy"
+    if Sampling_Engine not in SAMPLING_ENGINES:
+        flmc.log("Sampling engine {} is not supported, arcpy is used.".format(Sampling_Engine))
+        Sampling_Engine = "arcpy"
 
 
 
@@ -696,7 +756,8 @@ def main(argv=None):
     f.write(str(TreeSearchRadius) + "\n")
     f.write(str(MaximumLineDistance) + "\n")
     f.write(str(CanopyAvoidance) + "\n")
-    f.write(str(CostRasterExponent))
+    f.write(str(CostRasterExponent) + "\n")
+    f.write(Sampling_Engine)
     f.close()
 
     arcpy.env.overwriteOutput = True
@@ -712,7 +773,8 @@ def main(argv=None):
     Output_Dir=outWorkspace
     Percentile_Call(workspaceName, outWorkspace, Centerline_Feature_Class, Output_Dir, CHM_Raster,
                                   Search_R, Canopy_Percentile, CanopyTh_Percent, ProcessSegments,
-                                  TreeSearchRadius, MaximumLineDistance, CanopyAvoidance, CostRasterExponent)
+                                  TreeSearchRadius, MaximumLineDistance, CanopyAvoidance, CostRasterExponent,
+                                  Sampling_Engine)
 
    
 
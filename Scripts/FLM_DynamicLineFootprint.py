@@ -552,7 +552,7 @@ def main(argv=None):
     flmc.log("Multiprocessing for dynamic canopy cost raster...")
     flmc.log("Using {} CPU cores".format(flmc.GetCores()))
 
-    footprints = pool.map(CC_call, segment_all_Cal_DynCC)
+    footprints = flmc.MapInSpatialOrder(pool, CC_call, segment_all_Cal_DynCC)
 
     pool.close()
     pool.join()
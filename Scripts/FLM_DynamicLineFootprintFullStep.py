@@ -50,6 +50,9 @@ from arcpy.sa import *
 
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
+import FLM_CanopyCost
+import FLM_RasterFilters as flmrf
+import FLM_RasterExpression as flmre
 
 workspaceName = "FLM_DLFP_output"
 outWorkspace = ""
@@ -381,6 +384,7 @@ def CC_call(input_line):
         Max_Line_Distance = float(input_line[5])
         CanopyAvoidance = float(input_line[6])
         Cost_Raster_Exponent = float(input_line[7])
+        Raster_Engine = input_line[13] if len(input_line) > 13 else "arcpy"
 
         Output_Canopy_Raster = r"memory/out_canopy_raster" + str(input_line[0])
         tempbuffer = r"memory\outrbuffer" + str(input_line[0])
@@ -433,21 +437,38 @@ def CC_call(input_line):
         # Process: Turn CHM into a Canopy Closure (CC) map
         arcpy.gp.Con_sa(chm_raster, 1, Output_Canopy_Raster, 0, "VALUE > " + str(Min_Canopy_Height))
 
-        # Process: CC Mean
-        # arcpy.AddMessage("Calculating Focal Mean...")
-        arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_Mean, Tree_Search_Area, "MEAN")
+        if Raster_Engine == "numpy":
+            canopy, x_min, y_max, cell_size = flmc.GetRasterArray(Output_Canopy_Raster)
+            spatial_reference = arcpy.Describe(chm_raster).spatialReference
+
+            # Process: CC Mean and StDev in one pass
+            mean, std = flmrf.focalMeanStd(canopy, float(input_line[4]) / cell_size, "CIRCLE")
+            flmc.SaveArrayAsRaster(mean, x_min, y_max, cell_size, spatial_reference, FLM_CC_Mean)
+            flmc.SaveArrayAsRaster(std, x_min, y_max, cell_size, spatial_reference, FLM_CC_StDev)
+            del mean, std
+
+            # Process: Euclidean Distance
+            distance = flmrf.euclideanDistance(canopy >= 1, cell_size, Max_Line_Distance)
+            smoothCost = (Max_Line_Distance - distance) / Max_Line_Distance
+            flmc.SaveArrayAsRaster(smoothCost, x_min, y_max, cell_size, spatial_reference, FLM_CC_SmoothRaster)
+            del canopy, distance
+            smoothCost = arcpy.Raster(FLM_CC_SmoothRaster)
+        else:
+            # Process: CC Mean
+            # arcpy.AddMessage("Calculating Focal Mean...")
+            arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_Mean, Tree_Search_Area, "MEAN")
 
-        # Process: CC StDev
-        # arcpy.AddMessage("Calculating Focal StDev..")
-        arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_StDev, Tree_Search_Area, "STD")
+            # Process: CC StDev
+            # arcpy.AddMessage("Calculating Focal StDev..")
+            arcpy.gp.FocalStatistics_sa(Output_Canopy_Raster, FLM_CC_StDev, Tree_Search_Area, "STD")
 
-        # Process: Euclidean Distance
-        # arcpy.AddMessage("Calculating Euclidean Distance From Canopy...")
-        EucAllocation(Con(arcpy.Raster(Output_Canopy_Raster) >= 1, 1, ""), "", "", "", "", FLM_CC_EucRaster, "")
+            # Process: Euclidean Distance
+            # arcpy.AddMessage("Calculating Euclidean Distance From Canopy...")
+            EucAllocation(Con(arcpy.Raster(Output_Canopy_Raster) >= 1, 1, ""), "", "", "", "", FLM_CC_EucRaster, "")
 
-        smoothCost = (float(Max_Line_Distance) - arcpy.Raster(FLM_CC_EucRaster))
-        smoothCost = Con(smoothCost > 0, smoothCost, 0) / float(Max_Line_Distance)
-        smoothCost.save(FLM_CC_SmoothRaster)
+            smoothCost = (float(Max_Line_Distance) - arcpy.Raster(FLM_CC_EucRaster))
+            smoothCost = Con(smoothCost > 0, smoothCost, 0) / float(Max_Line_Distance)
+            smoothCost.save(FLM_CC_SmoothRaster)
     except Exception as e:
         print(e)
         print(input_line)
@@ -466,7 +487,14 @@ def CC_call(input_line):
         # decomposite above formula to steps
         USE_SINGLE_FOMULA = True
         with arcpy.EnvManager(snapRaster=chm_raster):
-            if USE_SINGLE_FOMULA:
+            if Raster_Engine == "numpy":
+                # Same formula evaluated in one fused pass
+                outExpr = FLM_CanopyCost.costExpression(flmre.Raster(Output_Canopy_Raster), flmre.Raster(FLM_CC_Mean),
+                                                        flmre.Raster(FLM_CC_StDev), flmre.Raster(FLM_CC_SmoothRaster),
+                                                        avoidance, float(Cost_Raster_Exponent))
+                flmre.evaluate(outExpr, FLM_CC_CostRaster)
+                outRas = arcpy.Raster(FLM_CC_CostRaster)
+            elif USE_SINGLE_FOMULA:
             # Original formula as follow
                 outRas = Power(Exp(Con((Raster_CC == 1), 1, Con((Raster_Mean + Raster_StDev <= 0), 0,
                                                                 (1 + (Raster_Mean - Raster_StDev) / (
@@ -683,7 +711,10 @@ def CC_call(input_line):
         arcpy.Delete_management(Raster_Smooth)
         arcpy.Delete_management(smoothCost)
 
-        arcpy.Delete_management(FLM_CC_EucRaster)
+        # Not created by the numpy raster engine and the arcpy engine respectively
+        for fileOptional in [FLM_CC_EucRaster, FLM_CC_CostRaster]:
+            if arcpy.Exists(fileOptional):
+                arcpy.Delete_management(fileOptional)
         arcpy.Delete_management(FLM_CC_SmoothRaster)
         arcpy.Delete_management(FLM_CC_Mean)
         arcpy.Delete_management(FLM_CC_StDev)
@@ -889,54 +920,18 @@ def Percentile_Call(workspaceName, outWorkspace, Centerline_Feature_Class, Outpu
 
     arcpy.AddMessage("Multiprocessing Canopy Threshold calculation...")
     arcpy.AddMessage("Using {} CPU cores".format(str(multiprocessing.cpu_count())))
-    wherecluase = arcpy.Describe(Temp_Splited_simplify_cl).OIDFieldName
-
     fieldNames = ["OID@", Canopy_Percentile_Field + "L", Canopy_Percentile_Field + "R", CanopyTh_Field + "L",
-                  CanopyTh_Field + "R", "Buf_Side", CanopyTh_Field + "M", "CorridorTh", "SHAPE@"]
+                  CanopyTh_Field + "R", "Buf_Side", CanopyTh_Field + "M"]
     pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
 
     with arcpy.da.Editor(os.path.dirname(pointsAlongParallelLine)) as edit:
         updated_simCL_list=pool.map(seg_line1, Alllistline)
         print("Updating Percentile Statistic into CL attributes........")
 
-        for seg in updated_simCL_list:
-            try:
-                sqlcluase = "{}={}".format(wherecluase,seg[0] - 1)
-            # print(wherecluase)
-            except Exception as e:
-                print("Cannot create wherecluase")
-                print(e)
-
-            try:
-                upcursor = arcpy.da.UpdateCursor(Temp_Splited_simplify_cl,fieldNames,sqlcluase)
-            except Exception as e:
-                print(e)
-                print("Cannot create UpdateCursor for simple CL {}".format(seg[0]))
-            # arcpy.SelectLayerByAttribute_management(split_simCL, "CLEAR_SELECTION", sqlcluase)
-            try:
-                for row in upcursor:
-                    row[1] = seg[1]
-                    row[2] = seg[2]
-                    row[3] = seg[3]
-                    row[4] = seg[4]
-                    if seg[1] != 0 and seg[3] != 0:
-                        row[5] = "Left, Right"
-                    elif seg[2] == None and seg[4] != 0:
-                        row[5] = "Right"
-                    elif seg[2] != 0 and seg[4] == None:
-                        row[5] = "Left"
-                    else:
-                        row[5] = "None"
-
-                    row[6] = (seg[3] + seg[4]) / 2
-
-                    upcursor.updateRow(row)
-                    print("Updating Simplified CL: {}".format(seg[0]))
-
-                del upcursor
-            except Exception as e:
-                print(e)
-                print("Cannot Update simpCL for simple CL {}".format(seg[0]))
+        # Results are keyed by the FID of the simplified CL shapefile, written in one cursor pass
+        updates = {seg[0] - 1: flmc.PercentileValues(seg) for seg in updated_simCL_list}
+        updated = flmc.UpdateRowsByOID(Temp_Splited_simplify_cl, fieldNames, updates)
+        print("Updated {} of {} simplified CL.".format(updated, len(updates)))
     pool.close()
     pool.join()
 
@@ -1007,6 +1002,11 @@ def main(argv=None):
     CanopyAvoidance = float(args[11].rstrip())
     global CostRasterExponent
     CostRasterExponent = float(args[12].rstrip())
+    global Raster_Engine
+    Raster_Engine = args[13].rstrip() if len(args) > 13 else "arcpy"
+    if Raster_Engine not in flmrf.RASTER_ENGINES:
+        flmc.log("Raster engine {} is not supported, arcpy is used.".format(Raster_Engine))
+        Raster_Engine = "arcpy"
 
     global Corridor_Threshold_Field
     Canopy_Threshold_option = args[3].rstrip()
@@ -1060,6 +1060,7 @@ def main(argv=None):
             seg.append(Expand_And_Shrink_Cell_Range)
             seg.append(Canopy_Threshold_Field)
             seg.append(Centerline_Feature_Class)
+            seg.append(Raster_Engine)
             segment_all_Cal_DynCC.append(seg)
     print("Start generate Dynamic Footprint........")
 
@@ -1068,7 +1069,7 @@ def main(argv=None):
     flmc.log("Multiprocessing for dynamic canopy cost raster...")
     flmc.log("Using {} CPU cores".format(flmc.GetCores()))
 
-    footprints = pool.map(CC_call, segment_all_Cal_DynCC)
+    footprints = flmc.MapInSpatialOrder(pool, CC_call, segment_all_Cal_DynCC)
 
     pool.close()
     pool.join()
@@ -31,6 +31,8 @@ import os
 import multiprocessing
 import math
 
+import numpy
+
 # ArcGIS imports
 import arcpy
 arcpy.CheckOutExtension("Spatial")
@@ -38,8 +40,189 @@ arcpy.CheckOutExtension("Spatial")
 # Local imports
 import FLM_Common as flmc
 import FLM_Attribute_Functions as flma
+import FLM_RasterStore as flmrs
 
 workspaceName = "FLM_SLA_output"
+ZONAL_ENGINES = ["arcpy", "native"]
+
+
+def polygonRings(polygon):
+    """
+    Vertex arrays of all rings of a polygon, rings of a part are separated by null points.
+    """
+    rings = []
+    for part in polygon:
+        ring = []
+        for pnt in part:
+            if pnt:
+                ring.append([pnt.X, pnt.Y])
+            elif ring:
+                rings.append(numpy.array(ring, dtype=numpy.float64))
+                ring = []
+        if ring:
+            rings.append(numpy.array(ring, dtype=numpy.float64))
+
+    return rings
+
+
+def zonalHeightStats(zones, zone_field, chm):
+    """
+    Count, sum and sum of squares of the CHM cells of all zones in one pass over the CHM.
+    The cells with centres inside every zone polygon are kept as sparse cell and zone pairs,
+    so cells where footprints of segments overlap are counted for each of the segments,
+    as ZonalStatisticsAsTable on the clipped footprint of every segment.
+    NoData cells of the CHM are ignored, as ZonalStatisticsAsTable with DATA.
+        zones: polygon feature class, zone_field holds non-negative integer zone IDs
+        return: count, total and total_sq arrays indexed by zone ID, CHM cell size
+    """
+    grid = flmrs.rasterGrid(chm)
+    with arcpy.da.SearchCursor(zones, [zone_field, "SHAPE@"]) as cursor:
+        zone_cells = [(int(row[0]), flmrs.polygonCells(polygonRings(row[1]), grid))
+                      for row in cursor if row[1] is not None]
+
+    count, total, total_sq = flmrs.zonalStatistics(chm, zone_cells)
+    return count, total, total_sq, grid[2]
+
+
+def heightAttributes(count, total, total_sq, cell_size):
+    """
+    AvgHeight, Volume and Roughness of every zone with CHM cells from zonalHeightStats.
+        return: dictionary of zone ID to [AvgHeight, Volume, Roughness]
+    """
+    attributes = {}
+    for zone in numpy.flatnonzero(count > 0):
+        # Volume is the sum of heights by the cell area, roughness is the root mean square height
+        attributes[int(zone)] = [total[zone] / count[zone], total[zone] * cell_size * cell_size,
+                                 math.sqrt(total_sq[zone] / count[zone])]
+
+    return attributes
+
+
+def lineVertices(lines):
+    """
+    Vertices of all lines in flat coordinate arrays.
+        lines: list of polylines
+        return: x, y arrays of all vertices, part_offsets with the first vertex of every part
+                and one past the last vertex, line_parts with the first part of every line
+                and one past the last part
+    """
+    x = []
+    y = []
+    part_offsets = [0]
+    line_parts = [0]
+    for line in lines:
+        for part in line:
+            for pnt in part:
+                if pnt:
+                    x.append(pnt.X)
+                    y.append(pnt.Y)
+            part_offsets.append(len(x))
+        line_parts.append(len(part_offsets) - 1)
+
+    return (numpy.array(x, dtype=numpy.float64), numpy.array(y, dtype=numpy.float64),
+            numpy.array(part_offsets), numpy.array(line_parts))
+
+
+def geometricAttributes(lines, meters_per_unit=1.0):
+    """
+    Length, end to end distance and start to end bearing of all lines with NumPy.
+    Bearing is in degrees clockwise from north, as LINE_BEARING of AddGeometryAttributes.
+        lines: list of polylines in a projected coordinate system
+        meters_per_unit: metres per coordinate unit, lengths are returned in metres
+                         as with Length_Unit="METERS" of AddGeometryAttributes
+        return: length, distance and bearing arrays
+    """
+    x, y, part_offsets, line_parts = lineVertices(lines)
+    n_lines = len(line_parts) - 1
+    if len(x) == 0:
+        return numpy.zeros(n_lines), numpy.zeros(n_lines), numpy.zeros(n_lines)
+
+    # Segment lengths, segments between parts are not counted
+    step = numpy.hypot(numpy.diff(x), numpy.diff(y))
+    step[part_offsets[1:-1][part_offsets[1:-1] > 0] - 1] = 0.0
+    vertex_length = numpy.concatenate(([0.0], numpy.cumsum(step)))
+
+    # First and last vertex of every line
+    first = part_offsets[line_parts[:-1]]
+    last = part_offsets[line_parts[1:]] - 1
+    valid = last >= first
+    first = numpy.where(valid, first, 0)
+    last = numpy.where(valid, last, 0)
+
+    length = numpy.where(valid, vertex_length[last] - vertex_length[first], 0.0)
+    dx = numpy.where(valid, x[last] - x[first], 0.0)
+    dy = numpy.where(valid, y[last] - y[first], 0.0)
+    distance = numpy.hypot(dx, dy)
+    bearing = numpy.degrees(numpy.arctan2(dx, dy)) % 360.0
+
+    return length * meters_per_unit, distance * meters_per_unit, bearing
+
+
+def geodesicAttributes(lines):
+    """
+    Geodesic length in metres, end to end distance in metres and start to end bearing
+    of lines in a geographic coordinate system, where planar lengths are in degrees.
+        return: length, distance and bearing arrays
+    """
+    length = numpy.zeros(len(lines))
+    distance = numpy.zeros(len(lines))
+    bearing = numpy.zeros(len(lines))
+    for i, line in enumerate(lines):
+        if line.pointCount < 2:
+            continue
+
+        sr = line.spatialReference
+        length[i] = line.getLength("GEODESIC", "METERS")
+        angle, distance[i] = arcpy.PointGeometry(line.firstPoint, sr).angleAndDistanceTo(
+            arcpy.PointGeometry(line.lastPoint, sr), "GEODESIC")
+        bearing[i] = angle % 360.0
+
+    return length, distance, bearing
+
+
+def directionClass(bearing):
+    """
+    Direction of lines from bearing: N-S, NE-SW, E-W or NW-SE in 45 degree classes.
+    """
+    classes = numpy.array(["NE-SW", "E-W", "NW-SE", "N-S"])
+    return classes[(numpy.floor(((bearing - 22.5) % 180.0) / 45.0).astype(numpy.int64)) % 4]
+
+
+def addGeometricAttributes(segment_all, areaAnalysis):
+    """
+    Set the shape and footprint attributes of all segments at once.
+    LENGTH, BEARING, Sinuosity and Direction come from the segment vertices,
+    AvgWidth and Fragment from POLY_AREA and PERIMETER of the footprint.
+        segment_all: segments from flmc.SplitLines, the attribute dictionaries are updated
+    LENGTH is in metres like the METERS unit of AddGeometryAttributes, so AvgWidth
+    is in metres with POLY_AREA in square metres.
+    """
+    lines = [segment[0] for segment in segment_all]
+    sr = lines[0].spatialReference if lines else None
+    if sr is not None and sr.type == "Geographic":
+        length, distance, bearing = geodesicAttributes(lines)
+    else:
+        meters_per_unit = sr.metersPerUnit if sr is not None and sr.metersPerUnit else 1.0
+        length, distance, bearing = geometricAttributes(lines, meters_per_unit)
+    direction = directionClass(bearing)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        sinuosity = numpy.where(distance > 0, length / distance, float("inf"))
+        if areaAnalysis:
+            area = numpy.array([segment[2]["POLY_AREA"] for segment in segment_all], dtype=numpy.float64)
+            perimeter = numpy.array([segment[2]["PERIMETER"] for segment in segment_all], dtype=numpy.float64)
+            avg_width = numpy.where(length > 0, area / length, float("inf"))
+            fragment = numpy.where(area > 0, perimeter / area, float("inf"))
+
+    for i, segment in enumerate(segment_all):
+        attributes = segment[2]
+        attributes["LENGTH"] = float(length[i])
+        attributes["BEARING"] = float(bearing[i])
+        attributes["Sinuosity"] = float(sinuosity[i])
+        attributes["Direction"] = str(direction[i])
+        if areaAnalysis:
+            attributes["AvgWidth"] = float(avg_width[i])
+            attributes["Fragment"] = float(fragment[i])
 
 
 def workLines(lineNo):
@@ -177,6 +360,8 @@ def workLinesMem(segment_info):
     """
     New version of worklines. It uses memory workspace instead of shapefiles.
     The refactoring is to accelerate the processing speed.
+    Only the CHM statistics of the segment footprint are calculated here, the
+    geometric attributes of all segments are set in main by addGeometricAttributes.
     """
 
     # input verification
@@ -197,6 +382,7 @@ def workLinesMem(segment_info):
     Attributed_Segments = f.readline().strip()
     areaAnalysis = True if f.readline().strip() == "True" else False
     heightAnalysis = True if f.readline().strip() == "True" else False
+    Zonal_Engine = f.readline().strip() or "arcpy"
     f.close()
 
     line = [segment_info[0]]
@@ -207,24 +393,12 @@ def workLinesMem(segment_info):
     arcpy.env.workspace = r"memory"
 
     # Temporary files
-    lineSeg = os.path.join(outWorkspaceMem, "FLM_SLA_Segment_" + str(lineNo))
     lineBuffer = os.path.join(outWorkspaceMem, "FLM_SLA_Buffer_" + str(lineNo))
     lineClip = os.path.join(outWorkspaceMem, "FLM_SLA_Clip_" + str(lineNo))
     lineStats = os.path.join(outWorkspaceMem, "FLM_SLA_Stats_" + str(lineNo))
 
-    # Create segment feature class
-    try:
-        arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(lineSeg), "POLYLINE",
-                                            Input_Lines, "DISABLED", "DISABLED", Input_Lines)
-        cursor = arcpy.da.InsertCursor(lineSeg, ["SHAPE@"])
-        cursor.insertRow([segment_info[0]])
-        del cursor
-    except Exception as e:
-        print("Create feature class {} failed.".format(fileSeg))
-        print(e)
-        return
-
-    if areaAnalysis:
+    # The native zonal engine computes the CHM attributes of all segments in main
+    if areaAnalysis and Zonal_Engine == "arcpy":
         arcpy.Buffer_analysis(line, lineBuffer, LineSearchRadius, line_side="FULL", line_end_type="FLAT",
                               dissolve_option="NONE", dissolve_field="", method="PLANAR")
         arcpy.Clip_analysis(Input_Footprint, lineBuffer, lineClip)
@@ -237,91 +411,39 @@ def workLinesMem(segment_info):
                 lineStats = ""
                 print(e)
 
-    rows = arcpy.UpdateCursor(lineSeg)
-    shapeField = arcpy.Describe(lineSeg).ShapeFieldName
-    row = rows.next()
-
-    feat = row.getValue(shapeField)  # creates a geometry object
-    length = float(attributes["LENGTH"])  # creates a geometry object
-
-    try:
-        bearing = float(attributes["BEARING"])  # creates a geometry object
-    except Exception as e:
-        bearing = 0
-        print(e)
-
-    # TODO: retrieve vertices from line directly and remove lineSeg
-    segmentnum = 0
-    segment_list = []
-    for segment in feat:  # loops through every segment in a line
-        # loops through every vertex of every segment
-        # get.PArt returns an array of points for a particular part in the geometry
-        for pnt in feat.getPart(segmentnum):
-            if pnt:  # adds all the vertices to segment_list, which creates an array
-                segment_list.append(arcpy.Point(float(pnt.X), float(pnt.Y)))
-
-    # Sinuosity calculation
-    eucDistance = arcpy.PointGeometry(feat.firstPoint).distanceTo(arcpy.PointGeometry(feat.lastPoint))
-    try:
-        attributes["Sinuosity"] = length / eucDistance
-    except Exception as e:
-        attributes["Sinuosity"] = float("inf")
-        print(e)
-
-    # Direction based on bearing
-    ori = "N-S"
-    if 22.5 <= bearing < 67.5 or 202.5 <= bearing < 247.5:
-        ori = "NE-SW"
-    elif 67.5 <= bearing < 112.5 or 247.5 <= bearing < 292.5:
-        ori = "E-W"
-    elif 112.5 <= bearing < 157.5 or 292.5 <= bearing < 337.5:
-        ori = "NW-SE"
-    attributes["Direction"] = ori
-
-    # If footprint polygons are available, get area-based variables
-    if areaAnalysis:
-        totalArea = float(attributes["POLY_AREA"])
-        totalPerim = float(attributes["PERIMETER"])
-
-        attributes["AvgWidth"] = totalArea / length
-
-        try:
-            attributes["Fragment"] = totalPerim / totalArea
-        except Exception as e:
-            attributes["Fragment"] = float("inf")
-
-        if arcpy.Exists(lineStats):
-            # Retrieve useful stats from table which are used to derive CHM attributes
-            ChmFootprintCursor = arcpy.SearchCursor(lineStats)
-            ChmFoot = ChmFootprintCursor.next()
-            chm_count = float(ChmFoot.getValue("COUNT"))
-            chm_area = float(ChmFoot.getValue("AREA"))
-            chm_mean = float(ChmFoot.getValue("MEAN"))
-            chm_std = float(ChmFoot.getValue("STD"))
-            chm_sum = float(ChmFoot.getValue("SUM"))
-            del ChmFootprintCursor
-
-            # Average vegetation height directly obtained from CHM mean
-            attributes["AvgHeight"] = chm_mean
-
-            # Cell area obtained via dividing the total area by the number of cells
-            # (this assumes that the projection is UTM to obtain a measure in square meters)
-            cellArea = chm_area / chm_count
-
-            # CHM volume (3D) is obtained via multiplying the sum of height (1D) of all cells
-            # of all cells within the footprint by the area of each cell (2D)
-            attributes["Volume"] = chm_sum * cellArea
-
-            # The following math is performed to use available stats (fast) and avoid further
-            # raster sampling procedures (slow).
-            # RMSH is equal to the square root of the sum of the squared mean and
-            # the squared standard deviation (population)
-            # STD of population (n) is derived from the STD of sample (n-1).
-            # This number is not useful by itself, only to derive RMSH.
-            sqStdPop = math.pow(chm_std, 2) * (chm_count - 1) / chm_count
-
-            # Obtain RMSH from mean and STD
-            attributes["Roughness"] = math.sqrt(math.pow(chm_mean, 2) + sqStdPop)
+    # If footprint polygons are available, get CHM-based variables
+    if areaAnalysis and arcpy.Exists(lineStats):
+        # Retrieve useful stats from table which are used to derive CHM attributes
+        ChmFootprintCursor = arcpy.SearchCursor(lineStats)
+        ChmFoot = ChmFootprintCursor.next()
+        chm_count = float(ChmFoot.getValue("COUNT"))
+        chm_area = float(ChmFoot.getValue("AREA"))
+        chm_mean = float(ChmFoot.getValue("MEAN"))
+        chm_std = float(ChmFoot.getValue("STD"))
+        chm_sum = float(ChmFoot.getValue("SUM"))
+        del ChmFootprintCursor
+
+        # Average vegetation height directly obtained from CHM mean
+        attributes["AvgHeight"] = chm_mean
+
+        # Cell area obtained via dividing the total area by the number of cells
+        # (this assumes that the projection is UTM to obtain a measure in square meters)
+        cellArea = chm_area / chm_count
+
+        # CHM volume (3D) is obtained via multiplying the sum of height (1D) of all cells
+        # of all cells within the footprint by the area of each cell (2D)
+        attributes["Volume"] = chm_sum * cellArea
+
+        # The following math is performed to use available stats (fast) and avoid further
+        # raster sampling procedures (slow).
+        # RMSH is equal to the square root of the sum of the squared mean and
+        # the squared standard deviation (population)
+        # STD of population (n) is derived from the STD of sample (n-1).
+        # This number is not useful by itself, only to derive RMSH.
+        sqStdPop = math.pow(chm_std, 2) * (chm_count - 1) / chm_count
+
+        # Obtain RMSH from mean and STD
+        attributes["Roughness"] = math.sqrt(math.pow(chm_mean, 2) + sqStdPop)
 
      # Clean temporary files
     if arcpy.Exists(lineClip):
@@ -356,6 +478,14 @@ def main(argv=None):
     Tolerance_Radius = float(args[5].rstrip())
     LineSearchRadius = float(args[6].rstrip())
     Attributed_Segments = args[7].rstrip()
+    Zonal_Engine = args[8].rstrip() if len(args) > 8 and args[8] else "arcpy"
+    if Zonal_Engine not in ZONAL_ENGINES:
+        flmc.log("Zonal engine {} is not supported, arcpy is used.".format(Zonal_Engine))
+        Zonal_Engine = "arcpy"
+    Split_Engine = args[9].rstrip() if len(args) > 9 and args[9] else "arcpy"
+    if Split_Engine not in flma.SPLIT_ENGINES:
+        flmc.log("Split engine {} is not supported, arcpy is used.".format(Split_Engine))
+        Split_Engine = "arcpy"
 
     areaAnalysis = arcpy.Exists(Input_Footprint)
     heightAnalysis = arcpy.Exists(Input_CHM)
@@ -373,6 +503,7 @@ def main(argv=None):
     f.write(Attributed_Segments + "\n")
     f.write(str(areaAnalysis) + "\n")
     f.write(str(heightAnalysis) + "\n")
+    f.write(Zonal_Engine + "\n")
     f.close()
 
     # Only process the following SampleingType
@@ -392,12 +523,16 @@ def main(argv=None):
     flmc.log("FlmLineSplit: Input_Lines = " + Input_Lines)
     # Get all original fields
     keepFields = flmc.GetAllFieldsFromShp(Input_Lines)
-    SLA_Segmented_Lines = flma.FlmLineSplit(outWorkspace, Input_Lines, SamplingType, Segment_Length, Tolerance_Radius)
+    SLA_Segmented_Lines = flma.FlmLineSplit(outWorkspace, Input_Lines, SamplingType, Segment_Length, Tolerance_Radius,
+                                            Split_Engine)
     flmc.logStep("Line segmentation")
 
     # Linear attributes
     flmc.log("Adding attributes...")
-    arcpy.AddGeometryAttributes_management(SLA_Segmented_Lines, "LENGTH;LINE_BEARING", "METERS")
+    # LENGTH and BEARING are calculated from the segment vertices by addGeometricAttributes
+    for field in ["LENGTH", "BEARING"]:
+        if not flmc.HasField(SLA_Segmented_Lines, field):
+            arcpy.AddField_management(SLA_Segmented_Lines, field, "DOUBLE")
     keepFields += ["LENGTH", "BEARING"]
 
     if areaAnalysis:
@@ -420,6 +555,13 @@ def main(argv=None):
         arcpy.JoinField_management(SLA_Segmented_Lines, arcpy.Describe(SLA_Segmented_Lines).OIDFieldName,
                                    fileFootprints, "ORIG_FID", fields="POLY_AREA;PERIMETER")
         keepFields += ["POLY_AREA", "PERIMETER"]
+
+        # Footprint of every segment is labelled by the segment FID in ORIG_FID
+        if heightAnalysis and Zonal_Engine == "native":
+            flmc.log("Calculating CHM statistics of all segment footprints...")
+            height_attributes = heightAttributes(*zonalHeightStats(fileFootprints, "ORIG_FID", Input_CHM))
+            flmc.logStep("Footprint zonal statistics")
+
         arcpy.Delete_management(fileBuffer)
         arcpy.Delete_management(fileIdentity)
         arcpy.Delete_management(fileFootprints)
@@ -438,19 +580,30 @@ def main(argv=None):
             arcpy.AddField_management(SLA_Segmented_Lines, "Volume", "DOUBLE")
             arcpy.AddField_management(SLA_Segmented_Lines, "Roughness", "DOUBLE")
             keepFields += ["AvgHeight", "Volume", "Roughness"]
+            if Zonal_Engine == "native":
+                flmc.UpdateRowsByOID(SLA_Segmented_Lines, ["OID@", "AvgHeight", "Volume", "Roughness"],
+                                     height_attributes)
 
     # Prepare input lines for multiprocessing
     # ["Direction","Sinuosity","Area","AvgWidth","Perimeter","Fragment","SLA_Unity","AvgHeight","Volume","Roughness"])
     segment_all = flmc.SplitLines(SLA_Segmented_Lines, outWorkspace, "SLA", False, keepFields)
 
-    pool = multiprocessing.Pool(processes=flmc.GetCores())
-    flmc.log("Multiprocessing lines...")
-    # pool.map(workLinesMem, range(1, numLines + 1))
-    line_with_attributes = pool.map(workLinesMem, segment_all)
-    pool.close()
-    pool.join()
+    flmc.log("Calculating geometric attributes...")
+    addGeometricAttributes(segment_all, areaAnalysis)
+    flmc.logStep("Geometric attributes")
+
+    # Only the CHM statistics with the arcpy zonal engine are left to the workers
+    if areaAnalysis and heightAnalysis and Zonal_Engine == "arcpy":
+        pool = multiprocessing.Pool(processes=flmc.GetCores())
+        flmc.log("Multiprocessing lines...")
+        # pool.map(workLinesMem, range(1, numLines + 1))
+        line_with_attributes = flmc.MapInSpatialOrder(pool, workLinesMem, segment_all)
+        pool.close()
+        pool.join()
 
-    flmc.logStep("Line attributes multiprocessing")
+        flmc.logStep("Line attributes multiprocessing")
+    else:
+        line_with_attributes = [[[segment[0]], segment[2]] for segment in segment_all]
 
     # Create output line attribute shapefile
     flmc.log("Create line attribute shapefile...")
@@ -0,0 +1,309 @@
+#
+#    Copyright (C) 2021  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_LeastCostPath.py
+# Script Author: Applied Geospatial Research Group
+# Date: 2026-Oct-18
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Native least cost path functions working on NumPy windows of the
+# cost raster. They replace the CostDistance and CostPathAsPolyline round
+# trip for a single line, so no temporary rasters are written.
+#
+# ---------------------------------------------------------------------------
+# System imports
+import heapq
+import math
+
+import numpy as np
+
+# Neighbour offsets (row, col, distance factor) of the 8-connected grid.
+# The index in this list is what the backlink array stores.
+SQRT2 = math.sqrt(2.0)
+NEIGHBOURS = [(-1, -1, SQRT2), (-1, 0, 1.0), (-1, 1, SQRT2),
+              (0, -1, 1.0), (0, 1, 1.0),
+              (1, -1, SQRT2), (1, 0, 1.0), (1, 1, SQRT2)]
+NO_BACKLINK = -1
+
+
+def pointToCell(x, y, x_min, y_max, cell_size, shape):
+    """
+    Convert map coordinates to (row, col) of the window, clamped to the window.
+    """
+    row = int(math.floor((y_max - y) / cell_size))
+    col = int(math.floor((x - x_min) / cell_size))
+    row = min(max(row, 0), shape[0] - 1)
+    col = min(max(col, 0), shape[1] - 1)
+
+    return row, col
+
+
+def lineBufferMask(shape, x_min, y_max, cell_size, vertices, radius):
+    """
+    Boolean mask of the cells whose centres are within radius of the polyline.
+    This mimics clipping the cost raster with the round line buffer.
+        vertices: list of (x, y) of the polyline
+    """
+    rows, cols = shape
+    xs = x_min + (np.arange(cols) + 0.5) * cell_size
+    ys = y_max - (np.arange(rows) + 0.5) * cell_size
+    px, py = np.meshgrid(xs, ys)
+
+    mask = np.zeros(shape, dtype=bool)
+    if len(vertices) == 1:
+        vertices = [vertices[0], vertices[0]]
+
+    for (x1, y1), (x2, y2) in zip(vertices[:-1], vertices[1:]):
+        dx = x2 - x1
+        dy = y2 - y1
+        seg_len_sq = dx * dx + dy * dy
+        if seg_len_sq > 0:
+            t = ((px - x1) * dx + (py - y1) * dy) / seg_len_sq
+            np.clip(t, 0.0, 1.0, out=t)
+        else:
+            t = np.zeros(shape)
+        dist_sq = (px - (x1 + t * dx)) ** 2 + (py - (y1 + t * dy)) ** 2
+        mask |= dist_sq <= radius * radius
+
+    return mask
+
+
+def costDistance(cost, sources, cell_size=1.0, mask=None):
+    """
+    Accumulated cost distance from source cells with a Dijkstra heap search.
+    Moving between two neighbouring cells costs the mean of both cell costs times
+    the travel distance, as in ArcGIS CostDistance. NaN cells are barriers.
+        cost: 2D array of cost values, it is only read
+        sources: list of (row, col) source cells
+        cell_size: raster cell size
+        mask: optional boolean array of the cells that can be crossed, see lineBufferMask
+        return: accumulated cost array (NaN where unreachable) and backlink array
+                holding the NEIGHBOURS index each cell was reached from
+    """
+    rows, cols = cost.shape
+    valid = np.isfinite(cost)
+    if mask is not None:
+        valid &= mask
+    costs = np.where(valid, cost, 0.0).ravel().tolist()
+    valid = valid.ravel().tolist()
+
+    accum = [math.inf] * (rows * cols)
+    backlink = [NO_BACKLINK] * (rows * cols)
+    heap = []
+    for row, col in sources:
+        i = row * cols + col
+        if valid[i]:
+            accum[i] = 0.0
+            heap.append((0.0, i))
+    heapq.heapify(heap)
+
+    steps = [(dr, dc, factor * cell_size * 0.5) for dr, dc, factor in NEIGHBOURS]
+    while heap:
+        dist, i = heapq.heappop(heap)
+        if dist > accum[i]:
+            continue  # stale heap entry
+
+        row, col = divmod(i, cols)
+        cost_i = costs[i]
+        for k, (dr, dc, half_step) in enumerate(steps):
+            nr = row + dr
+            nc = col + dc
+            if nr < 0 or nr >= rows or nc < 0 or nc >= cols:
+                continue
+            j = nr * cols + nc
+            if not valid[j]:
+                continue
+            new_dist = dist + half_step * (cost_i + costs[j])
+            if new_dist < accum[j]:
+                accum[j] = new_dist
+                backlink[j] = k
+                heapq.heappush(heap, (new_dist, j))
+
+    accum = np.array(accum).reshape(rows, cols)
+    accum[np.isinf(accum)] = np.nan
+    backlink = np.array(backlink, dtype=np.int8).reshape(rows, cols)
+
+    return accum, backlink
+
+
+def tracePath(backlink, destination):
+    """
+    Follow the backlink array from destination back to the source.
+        return: list of (row, col) from source to destination,
+                empty list when destination was not reached
+    """
+    row, col = destination
+    path = [(row, col)]
+    max_steps = backlink.size
+    while backlink[row, col] != NO_BACKLINK:
+        dr, dc, _ = NEIGHBOURS[backlink[row, col]]
+        row -= dr
+        col -= dc
+        path.append((row, col))
+        if len(path) > max_steps:
+            return []
+
+    path.reverse()
+    return path
+
+
+def pathToCoords(path, x_min, y_max, cell_size):
+    """
+    Convert a path of cells to map coordinates of cell centres.
+    Vertices in the middle of straight runs are dropped, so the output
+    has vertices only where the path changes direction.
+    """
+    if not path:
+        return []
+
+    cells = [path[0]]
+    for prev, cur, nxt in zip(path[:-2], path[1:-1], path[2:]):
+        if (cur[0] - prev[0], cur[1] - prev[1]) != (nxt[0] - cur[0], nxt[1] - cur[1]):
+            cells.append(cur)
+    if len(path) > 1:
+        cells.append(path[-1])
+
+    return [(x_min + (col + 0.5) * cell_size, y_max - (row + 0.5) * cell_size) for row, col in cells]
+
+
+def leastCostPath(cost, source, destination, cell_size=1.0, mask=None):
+    """
+    Least cost path between two cells of the cost window.
+        source, destination: (row, col) cells
+        mask: optional boolean array of the cells that can be crossed
+        return: list of (row, col) from source to destination
+    """
+    accum, backlink = costDistance(cost, [source], cell_size, mask)
+    if np.isnan(accum[destination]):
+        return []
+
+    return tracePath(backlink, destination)
+
+
+def corridor(cost, source, destination, cell_size=1.0, threshold=0.0, mask=None):
+    """
+    Least cost corridor between two cells, equivalent to Corridor_sa on the two
+    CostDistance surfaces. Both accumulated cost surfaces are computed in process
+    and summed in place, no intermediate rasters are created.
+        source, destination: (row, col) cells
+        threshold: corridor cells are within threshold of the corridor minimum
+        mask: optional boolean array of the cells that can be crossed
+        return: corridor array (NaN where unreachable), its minimum (None when
+                no cell is reachable) and the boolean mask of corridor cells
+    """
+    corridor_array, _ = costDistance(cost, [source], cell_size, mask)
+    accum_destination, _ = costDistance(cost, [destination], cell_size, mask)
+    corridor_array += accum_destination
+    del accum_destination
+
+    reachable = np.isfinite(corridor_array)
+    if not reachable.any():
+        return corridor_array, None, reachable
+
+    corridor_min = float(corridor_array[reachable].min())
+    mask = reachable
+    mask[reachable] = corridor_array[reachable] - corridor_min <= threshold
+
+    return corridor_array, corridor_min, mask
+
+
+def bidirectionalAStar(cost, source, destination, cell_size=1.0, mask=None):
+    """
+    Point to point least cost path with a bidirectional A* search.
+    The forward search from source and the backward search from destination
+    take turns and stop as soon as neither frontier can improve the best path
+    found where they meet, so cells far from the optimal path are never visited.
+    The heuristic is the straight line distance times the minimum cell cost,
+    which never overestimates the remaining cost.
+        source, destination: (row, col) cells
+        mask: optional boolean array of the cells that can be crossed
+        return: list of (row, col) from source to destination
+    """
+    rows, cols = cost.shape
+    valid = np.isfinite(cost)
+    if mask is not None:
+        valid &= mask
+    if not valid[source] or not valid[destination]:
+        return []
+    if source == destination:
+        return [source]
+
+    h_scale = cell_size * max(float(cost[valid].min()), 0.0)
+    costs = np.where(valid, cost, 0.0).ravel().tolist()
+    valid = valid.ravel().tolist()
+
+    n = rows * cols
+    start = [source[0] * cols + source[1], destination[0] * cols + destination[1]]
+    targets = [destination, source]  # forward search heads to destination and vice versa
+    dist = [[math.inf] * n, [math.inf] * n]
+    backlink = [[NO_BACKLINK] * n, [NO_BACKLINK] * n]
+    closed = [bytearray(n), bytearray(n)]
+    heaps = [[], []]
+    for side in (0, 1):
+        dist[side][start[side]] = 0.0
+        heaps[side].append((0.0, start[side]))
+
+    steps = [(dr, dc, factor * cell_size * 0.5) for dr, dc, factor in NEIGHBOURS]
+    best = math.inf
+    meet = -1
+    while heaps[0] and heaps[1]:
+        # Early termination: no frontier cell can lead to a cheaper path
+        if heaps[0][0][0] >= best or heaps[1][0][0] >= best:
+            break
+
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1  # expand the smaller frontier
+        _, i = heapq.heappop(heaps[side])
+        if closed[side][i]:
+            continue
+        closed[side][i] = 1
+
+        dist_side = dist[side]
+        dist_other = dist[1 - side]
+        back_side = backlink[side]
+        target_row, target_col = targets[side]
+        row, col = divmod(i, cols)
+        dist_i = dist_side[i]
+        cost_i = costs[i]
+        for k, (dr, dc, half_step) in enumerate(steps):
+            nr = row + dr
+            nc = col + dc
+            if nr < 0 or nr >= rows or nc < 0 or nc >= cols:
+                continue
+            j = nr * cols + nc
+            if not valid[j]:
+                continue
+            new_dist = dist_i + half_step * (cost_i + costs[j])
+            if new_dist < dist_side[j]:
+                dist_side[j] = new_dist
+                back_side[j] = k
+                heuristic = h_scale * math.hypot(nr - target_row, nc - target_col)
+                heapq.heappush(heaps[side], (new_dist + heuristic, j))
+            if dist_side[j] + dist_other[j] < best:
+                best = dist_side[j] + dist_other[j]
+                meet = j
+
+    if meet < 0:
+        return []
+
+    meet_cell = divmod(meet, cols)
+    forward = tracePath(np.array(backlink[0], dtype=np.int8).reshape(rows, cols), meet_cell)
+    backward = tracePath(np.array(backlink[1], dtype=np.int8).reshape(rows, cols), meet_cell)
+    backward.reverse()
+
+    return forward + backward[1:]
@@ -31,7 +31,10 @@
 
 # System imports
 import os
+import itertools
+import functools
 import multiprocessing
+import numpy
 
 # ArcGIS imports
 import arcpy
@@ -39,8 +42,14 @@ from arcpy.sa import *
 
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
+import FLM_LeastCostPath as flmlcp
+import FLM_RasterStore as flmrs
+import FLM_ResultCache as flmrc
+import FLM_Timing as flmt
 
 workspaceName = "FLM_LFP_output"
+CORRIDOR_ENGINES = ["arcpy", "native"]  # arcpy: CostDistance/Corridor; native: in process corridor kernel
+CHUNK_SIZE = 8  # lines handed to a worker at a time
 outWorkspace = ""
 Corridor_Threshold_Field = ""
 Maximum_distance_from_centerline = 0
@@ -193,7 +202,7 @@ def workLines(lineNo):
     # Process: Raster to Polygon
     arcpy.RasterToPolygon_conversion(fileNull, fileFootprint, "SIMPLIFY", "VALUE", "SINGLE_OUTER_PART", "")
 
-    flmc.log("Processing line {} done".format(fileSeg))
+    flmc.log("Processing line {} done".format(fileSeg), level=flmc.LINE)
 
     # Clean temporary files
     try:
@@ -215,6 +224,33 @@ def workLines(lineNo):
         print("Line Footprint: Deleting temporary file failed. Inspect later.")
 
 
+def corridorNative(polyline, Cost_Raster, Maximum_distance_from_centerline, Corridor_Threshold):
+    """
+    Thresholded corridor of one line computed in process on a NumPy window of the cost raster.
+    It replaces the Buffer, Clip, CostDistance and Corridor steps, no temporary rasters are created.
+        return: raster with 0 for corridor cells and 1 for other cells in the line buffer,
+                None if the line ends are not connected
+    """
+    cost, buffer_mask, x_min, y_max, cell_size, vertices = flmc.GetLineBufferWindow(Cost_Raster, polyline,
+                                                                                    Maximum_distance_from_centerline)
+    if cost.size == 0:
+        return None
+
+    source = flmlcp.pointToCell(vertices[0][0], vertices[0][1], x_min, y_max, cell_size, cost.shape)
+    destination = flmlcp.pointToCell(vertices[-1][0], vertices[-1][1], x_min, y_max, cell_size, cost.shape)
+    corridor, corridor_min, mask = flmlcp.corridor(cost, source, destination, cell_size, Corridor_Threshold,
+                                                   buffer_mask)
+    if corridor_min is None:
+        return None
+
+    # Same classes as (Corridor - CorrMin) > Corridor_Threshold
+    corridor_class = numpy.where(mask, 0.0, 1.0).astype(numpy.float32)
+    corridor_class[numpy.isnan(corridor)] = numpy.nan
+    lower_left = arcpy.Point(x_min, y_max - corridor_class.shape[0] * cell_size)
+
+    return arcpy.NumPyArrayToRaster(corridor_class, lower_left, cell_size, cell_size, numpy.nan)
+
+
 def workLinesMemory(segment_info):
     """
     New version of worklines. It uses memory workspace instead of shapefiles.
@@ -235,10 +271,12 @@ def workLinesMemory(segment_info):
     Corridor_Threshold = float(f.readline().strip())
     Maximum_distance_from_centerline = float(f.readline().strip())
     Expand_And_Shrink_Cell_Range = f.readline().strip()
+    Corridor_Engine = f.readline().strip() or "arcpy"
     f.close()
 
     lineNo = segment_info[1]  # second element is the line No.
     outWorkspaceMem = r"memory"
+    timer = flmt.StageTimer(outWorkspace, lineNo)
 
     # Temporary files
     fileSeg = os.path.join(outWorkspaceMem, "FLM_LFP_Segment_" + str(lineNo))
@@ -271,94 +309,118 @@ def workLinesMemory(segment_info):
     x2 = segment_list[-1].X
     y2 = segment_list[-1].Y
 
-    # Create segment feature class
-    try:
-        arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileSeg), "POLYLINE",
-                                            Centerline_Feature_Class, "DISABLED",
-                                            "DISABLED", Centerline_Feature_Class)
-        cursor = arcpy.da.InsertCursor(fileSeg, ["SHAPE@"])
-        cursor.insertRow([segment_info[0]])
-        del cursor
-    except Exception as e:
-        print("Create feature class {} failed.".format(fileSeg))
-        print(e)
-        return
-
-    # Create origin feature class
-    try:
-        arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileOrigin), "POINT",
-                                            Centerline_Feature_Class, "DISABLED",
-                                            "DISABLED", Centerline_Feature_Class)
-        cursor = arcpy.da.InsertCursor(fileOrigin, ["SHAPE@XY"])
-        xy = (float(x1), float(y1))
-        cursor.insertRow([xy])
-        del cursor
-    except Exception as e:
-        print("Create feature class {} failed.".format(fileOrigin))
-        print(e)
-        return
-
-    # Create destination feature class
-    try:
-        arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileDestination), "POINT",
-                                            Centerline_Feature_Class, "DISABLED",
-                                            "DISABLED", Centerline_Feature_Class)
-        cursor = arcpy.da.InsertCursor(fileDestination, ["SHAPE@XY"])
-        xy = (float(x2), float(y2))
-        cursor.insertRow([xy])
-        del cursor
-    except Exception as e:
-        print("Create feature class {} failed.".format(fileDestination))
-        print(e)
-        return
-
-    # Buffer around line
-    try:
-        arcpy.Buffer_analysis(fileSeg, fileBuffer, Maximum_distance_from_centerline,
-                              "FULL", "ROUND", "NONE", "", "PLANAR")
-    except Exception as e:
-        print("Create buffer for {} failed".format(fileSeg))
-        print(e)
-        return
-
-    # Clip cost raster using buffer
-    DescBuffer = arcpy.Describe(fileBuffer)
-    SearchBox = str(DescBuffer.extent.XMin) + " " + str(DescBuffer.extent.YMin) + " " + \
-                str(DescBuffer.extent.XMax) + " " + str(DescBuffer.extent.YMax)
-    arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "",
-                          "ClippingGeometry", "NO_MAINTAIN_EXTENT")
-
-    try:
-        # Process: Cost Distance
-        arcpy.gp.CostDistance_sa(fileOrigin, fileClip, fileCostDa, "", "", "", "", "", "", "TO_SOURCE")
-        arcpy.gp.CostDistance_sa(fileDestination, fileClip, fileCostDb, "", "", "", "", "", "", "TO_SOURCE")
-
-        # Process: Corridor
-        arcpy.gp.Corridor_sa(fileCostDa, fileCostDb, fileCorridor)
-    except Exception as e:
-        print(e)
+    if Corridor_Engine == "arcpy":
+        # Create segment feature class
+        try:
+            arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileSeg), "POLYLINE",
+                                                Centerline_Feature_Class, "DISABLED",
+                                                "DISABLED", Centerline_Feature_Class)
+            cursor = arcpy.da.InsertCursor(fileSeg, ["SHAPE@"])
+            cursor.insertRow([segment_info[0]])
+            del cursor
+        except Exception as e:
+            print("Create feature class {} failed.".format(fileSeg))
+            print(e)
+            return
+
+        # Create origin feature class
+        try:
+            arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileOrigin), "POINT",
+                                                Centerline_Feature_Class, "DISABLED",
+                                                "DISABLED", Centerline_Feature_Class)
+            cursor = arcpy.da.InsertCursor(fileOrigin, ["SHAPE@XY"])
+            xy = (float(x1), float(y1))
+            cursor.insertRow([xy])
+            del cursor
+        except Exception as e:
+            print("Create feature class {} failed.".format(fileOrigin))
+            print(e)
+            return
+
+        # Create destination feature class
+        try:
+            arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileDestination), "POINT",
+                                                Centerline_Feature_Class, "DISABLED",
+                                                "DISABLED", Centerline_Feature_Class)
+            cursor = arcpy.da.InsertCursor(fileDestination, ["SHAPE@XY"])
+            xy = (float(x2), float(y2))
+            cursor.insertRow([xy])
+            del cursor
+        except Exception as e:
+            print("Create feature class {} failed.".format(fileDestination))
+            print(e)
+            return
+        timer.mark("setup")
+
+        # Buffer around line
+        try:
+            arcpy.Buffer_analysis(fileSeg, fileBuffer, Maximum_distance_from_centerline,
+                                  "FULL", "ROUND", "NONE", "", "PLANAR")
+        except Exception as e:
+            print("Create buffer for {} failed".format(fileSeg))
+            print(e)
+            return
+        timer.mark("buffer")
+
+        # Clip cost raster using buffer
+        DescBuffer = arcpy.Describe(fileBuffer)
+        SearchBox = str(DescBuffer.extent.XMin) + " " + str(DescBuffer.extent.YMin) + " " + \
+                    str(DescBuffer.extent.XMax) + " " + str(DescBuffer.extent.YMax)
+        arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "",
+                              "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+        timer.mark("clip")
+
+        try:
+            # Process: Cost Distance
+            arcpy.gp.CostDistance_sa(fileOrigin, fileClip, fileCostDa, "", "", "", "", "", "", "TO_SOURCE")
+            arcpy.gp.CostDistance_sa(fileDestination, fileClip, fileCostDb, "", "", "", "", "", "", "TO_SOURCE")
+            timer.mark("cost distance")
+
+            # Process: Corridor
+            arcpy.gp.Corridor_sa(fileCostDa, fileCostDb, fileCorridor)
+            timer.mark("corridor")
+        except Exception as e:
+            print(e)
+    else:
+        # Both cost distance surfaces and the corridor are computed in process
+        try:
+            RasterCorridor = corridorNative(segment_info[0], Cost_Raster,
+                                            Maximum_distance_from_centerline, Corridor_Threshold)
+            if RasterCorridor is None:
+                print("Line segment {} error: no corridor found".format(lineNo))
+                return []
+
+            RasterCorridor.save(fileCorridorMin)
+            arcpy.DefineProjection_management(fileCorridorMin, segment_info[0].spatialReference)
+            del RasterCorridor
+            timer.mark("corridor")
+        except Exception as e:
+            print(e)
 
     footprint = []
 
     # Calculate minimum value of corridor raster
     try:
-        RasterCorridor = arcpy.Raster(fileCorridor)
+        if Corridor_Engine == "arcpy":
+            RasterCorridor = arcpy.Raster(fileCorridor)
 
-        if not RasterCorridor.minimum is None:
-            CorrMin = float(RasterCorridor.minimum)
-        else:
-            print("Line segment {} error: RasterCorridor.minimum is None", lineNo)
-            CorrMin = 0
+            if not RasterCorridor.minimum is None:
+                CorrMin = float(RasterCorridor.minimum)
+            else:
+                print("Line segment {} error: RasterCorridor.minimum is None", lineNo)
+                CorrMin = 0
 
-        # Set minimum as zero and save minimum file
-        RasterCorridor = ((RasterCorridor - CorrMin) > Corridor_Threshold)
-        RasterCorridor.save(fileCorridorMin)
+            # Set minimum as zero and save minimum file
+            RasterCorridor = ((RasterCorridor - CorrMin) > Corridor_Threshold)
+            RasterCorridor.save(fileCorridorMin)
+            del RasterCorridor
 
         # Process: Stamp CC and Max Line Width
         RasterClass = SetNull(IsNull(Raster(fileCorridorMin)),
                               (Raster(fileCorridorMin) + (Raster(Canopy_Raster) >= 1)) > 0)
         RasterClass.save(fileThreshold)
-        del RasterCorridor, RasterClass
+        del RasterClass
+        timer.mark("threshold")
 
         if (int(Expand_And_Shrink_Cell_Range) > 0):
             # Process: Expand
@@ -368,10 +430,12 @@ def workLinesMemory(segment_info):
             arcpy.gp.Shrink_sa(fileExpand, fileShrink, Expand_And_Shrink_Cell_Range, "1")
         else:
             fileShrink = fileThreshold
+        timer.mark("expand shrink")
 
         # Process: Boundary Clean
         arcpy.gp.BoundaryClean_sa(fileShrink, fileClean, "ASCEND", "ONE_WAY")
         # arcpy.gp.BoundaryClean_sa(fileShrink, fileClean, "NO_SORT", "ONE_WAY")  # This is original code
+        timer.mark("boundary clean")
 
         # Process: Set Null
         arcpy.gp.SetNull_sa(fileClean, "1", fileNull, "VALUE > 0")
@@ -379,11 +443,12 @@ def workLinesMemory(segment_info):
         # Process: Raster to Polygon
         footprint = arcpy.RasterToPolygon_conversion(fileNull, arcpy.Geometry(),
                                                      "SIMPLIFY", "VALUE", "MULTIPLE_OUTER_PART", "")
+        timer.mark("polygonize")
 
     except Exception as e:
         print(e)
 
-    flmc.log("Processing line {} done".format(fileSeg))
+    flmc.log("Processing line {} done".format(fileSeg), level=flmc.LINE)
 
     # Clean temporary files
     try:
@@ -403,10 +468,47 @@ def workLinesMemory(segment_info):
         arcpy.Delete_management(fileNull)
     except Exception as e:
         print("Line Footprint: Deleting temporary file failed. Inspect later.")
+    timer.mark("clean up")
+    timer.done()
 
     return footprint  # list of polygons
 
 
+def writeFootprints(footprints, fileMerge, spatial_reference, numLines):
+    """
+    Append footprint polygons to fileMerge as the workers return them,
+    so results are not held in memory until all lines are processed.
+        footprints: iterator of polygon lists, e.g. from pool.imap_unordered,
+                    None or an empty list for lines that failed
+        return: number of polygons written
+    """
+    if arcpy.Exists(fileMerge):
+        arcpy.Delete_management(fileMerge)
+    arcpy.CreateFeatureclass_management(os.path.dirname(fileMerge), os.path.basename(fileMerge),
+                                        "POLYGON", "", "DISABLED", "DISABLED", spatial_reference)
+
+    numPolygons = 0
+    numFailed = 0
+    with arcpy.da.InsertCursor(fileMerge, ["SHAPE@"]) as cursor:
+        for lineDone, polygons in enumerate(footprints, 1):
+            if not polygons:
+                numFailed += 1
+                continue
+
+            for polygon in polygons:
+                cursor.insertRow([polygon])
+                numPolygons += 1
+
+            if lineDone % 1000 == 0:
+                flmc.log("{} of {} lines written.".format(lineDone, numLines))
+
+    if numFailed > 0:
+        flmc.log("WARNING: {} of {} lines failed and have no footprint.".format(numFailed, numLines),
+                 level=flmc.WARNING)
+
+    return numPolygons
+
+
 def HasField(fc, fi):
     fieldnames = [field.name for field in arcpy.ListFields(fc)]
     if fi in fieldnames:
@@ -448,6 +550,16 @@ def main(argv=None):
     ProcessSegments = args[7].rstrip() == "True"
     global Output_Footprint
     Output_Footprint = args[8].rstrip()
+    global Corridor_Engine
+    Corridor_Engine = args[9].rstrip() if len(args) > 9 else "arcpy"
+    if Corridor_Engine not in CORRIDOR_ENGINES:
+        flmc.log("Corridor engine {} is not supported, arcpy is used.".format(Corridor_Engine))
+        Corridor_Engine = "arcpy"
+    Chunk_Size = int(args[10].rstrip()) if len(args) > 10 else CHUNK_SIZE
+    Resume = flmrc.resumeRequested(args, 11)
+    Timing_CSV = args[12].rstrip() if len(args) > 12 else ""
+    Cache_Budget = int(args[13]) if len(args) > 13 and args[13].strip() else flmrs.CACHE_BUDGET
+    Cache_Budget = flmrs.engineCacheBudget(Corridor_Engine, Cache_Budget)
     outWorkspace = flmc.SetupWorkspace(workspaceName)
 
     # write params to text file for use in function workLinesMemory
@@ -460,6 +572,8 @@ def main(argv=None):
     f.write(Corridor_Threshold + "\n")
     f.write(str(Maximum_distance_from_centerline) + "\n")
     f.write(Expand_And_Shrink_Cell_Range + "\n")
+    f.write(Corridor_Engine + "\n")
+    f.write(str(Cache_Budget) + "\n")
     f.close()
 
     # TODO: this code block is not necessary
@@ -471,27 +585,56 @@ def main(argv=None):
     segment_all = flmc.SplitLines(Centerline_Feature_Class, outWorkspace,
                                   "LFP", ProcessSegments, Corridor_Threshold_Field)
 
+    # Segments with results cached by an earlier run are not processed again in resume mode
+    segment_all = [segment_all[i] for i in flmc.SpatialOrder(segment_all)]
+    cacheFolder = outWorkspace + "\\cache"
+    cacheParams = ["LFP", flmrc.rasterFingerprint(Canopy_Raster), flmrc.rasterFingerprint(Cost_Raster),
+                   Corridor_Threshold, Maximum_distance_from_centerline, Expand_And_Shrink_Cell_Range,
+                   Corridor_Engine]
+    tasks, cached = flmrc.pendingSegments(segment_all, cacheFolder, cacheParams, Resume)
+
+    # Native engine reads line windows from the cost raster in shared memory
+    descriptors = flmrs.publishRasters([Cost_Raster]) if Corridor_Engine != "arcpy" and tasks else []
+
     # TODO: inspect how GetCores works. Make sure it uses all the CPU cores
-    pool = multiprocessing.Pool(processes=flmc.GetCores())
+    flmt.resetTimings(outWorkspace)
+    pool = multiprocessing.Pool(processes=flmc.GetCores(), initializer=flmc.InitWorker,
+                                initargs=(flmc.StartLogListener(), flmc.LOG_LEVEL, descriptors, Cache_Budget))
     flmc.log("Multiprocessing line corridors...")
     flmc.log("Using {} CPU cores".format(flmc.GetCores()))
 
-    footprints = pool.map(workLinesMemory, segment_all)  # new version of memory based processing
+    # Footprints are written as they arrive, chunks of spatially ordered lines keep worker locality
+    fileMerge = outWorkspace + "\\FLM_LFP_Merge.shp"
+    try:
+        footprints = itertools.chain(cached.values(),
+                                     pool.imap_unordered(functools.partial(flmrc.runCached, workLinesMemory,
+                                                                           cacheFolder),
+                                                         tasks, max(Chunk_Size, 1)))
+        writeFootprints(footprints, fileMerge, arcpy.Describe(Centerline_Feature_Class).spatialReference,
+                        len(segment_all))
+    except Exception as e:
+        # A partial merge is not dissolved into the output
+        flmc.log("ERROR: Writing footprints failed, {} is not created.".format(Output_Footprint), level=flmc.ERROR)
+        flmc.log(str(e), level=flmc.ERROR)
+        pool.terminate()
+        pool.join()
+        flmrs.releaseRasters()
+        flmc.StopLogListener()
+        return False
+
     pool.close()
     pool.join()
+    flmrs.releaseRasters()
+    flmc.StopLogListener()
+    flmt.reportTimings(outWorkspace, Timing_CSV)
     flmc.logStep("Corridor multiprocessing")
 
     flmc.log("Merging footprints...")
     try:
-        # Flatten footprints which is a list of list
-        ft_list = [item for sublist in footprints for item in sublist]
-
-        fileMerge = outWorkspace + "\\FLM_LFP_Merge.shp"
-        arcpy.Merge_management(ft_list, fileMerge)
         arcpy.Dissolve_management(fileMerge, Output_Footprint)
         # arcpy.Delete_management(fileMerge)
     except Exception as e:
-        print("e")
+        print(e)
 
     flmc.logStep("Footprints merged.")
 
@@ -33,49 +33,97 @@ import math
 
 from statistics import *
 
+import shapely.wkb
+from shapely.geometry import box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
 # ArcGIS imports
 import arcpy
 from arcpy.sa import *
 
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
+import FLM_LineFootprint
+import FLM_RasterStore as flmrs
 
 workspaceName = "FLM_PT_output"
 outWorkspace = ""
 Maximum_distance_from_centerline = 32
 ProcessSegments = False  # keep whole line by default
 
+# LiDAR coverage of this process, see buildCoverage
+coverage = {"years": [], "prepared": [], "tree": None}
+
 def PathFile(path):
     return path[path.rfind("\\") + 1:]
 
 def retrievePolygons(polygon_shpfile):
     """
-    Retrieve all polygon geometries from shapefile
+    Retrieve all polygons with year from shapefile
+        return: list of (polygon WKB, year), it is sent to the pool workers once
     """
     fields = ["SHAPE@", "Year"]
     polygons = []
     with arcpy.da.SearchCursor(polygon_shpfile, fields) as cursor:
         for row in cursor:
             if row[1] > 0:
-                polygons.append(row)
+                polygons.append((bytes(row[0].WKB), row[1]))
 
     return polygons
 
+def buildCoverage(polygons):
+    """
+    Build the R-tree of polygon bounding boxes and the prepared polygons of this process.
+        polygons: list of (polygon WKB, year) from retrievePolygons
+    """
+    geometries = [shapely.wkb.loads(polygon[0]) for polygon in polygons]
+    coverage["years"] = [polygon[1] for polygon in polygons]
+    coverage["prepared"] = [prep(geometry) for geometry in geometries]
+    coverage["tree"] = STRtree(geometries) if geometries else None
+
+def coverageCandidates(line):
+    """
+    IDs of the coverage polygons whose bounding box intersects the line extent.
+    """
+    if coverage["tree"] is None:
+        return []
+
+    extent = line.extent
+    query = getattr(coverage["tree"], "query_items", coverage["tree"].query)  # Shapely 1.8 returns indices by query_items
+    return sorted(int(i) for i in query(box(extent.XMin, extent.YMin, extent.XMax, extent.YMax)))
+
+def initWorker(log_queue, log_level, descriptors, cache_budget, polygons):
+    """
+    Pool initializer, build the LiDAR coverage once in every worker.
+    """
+    flmc.InitWorker(log_queue, log_level, descriptors, cache_budget)
+    buildCoverage(polygons)
+
 def existenceByLiDARYear(line_info):
-    line = line_info[0]
-    polygons = line_info[3]
+    """
+    The line exists when it is in a LiDAR coverage polygon newer than the line.
+    Only the candidate polygons from coverageCandidates are tested.
+    """
+    polygon_ids = line_info[3]
+    if not polygon_ids or line_info[2]["YEAR"] <= 0:
+        return False
+
+    line = shapely.wkb.loads(bytes(line_info[0].WKB))
     years = []
-    for polygon in polygons:
-        if polygon[0].crosses(line) or polygon[0].contains(line):
-            years.append(polygon[1])
+    for i in polygon_ids:
+        if coverage["prepared"][i].crosses(line) or coverage["prepared"][i].contains(line):
+            years.append(coverage["years"][i])
 
-    if len(years) > 0 and line_info[2]["YEAR"] > 0:
+    if len(years) > 0:
         if max(years) > line_info[2]["YEAR"]:
             return True
 
     return False
 
 
+
+
 def getStats(point_values):
     if len(point_values) <= 1:
         return -9999.0, -9999.0, -9999.0, -9999.0
@@ -194,6 +242,7 @@ def workLinesMem(segment_info):
     In_Lidar_Year = f.readline().strip()
     Maximum_distance_from_centerline = float(f.readline().strip())
     Out_Tagged_Line = f.readline().strip()
+    Corridor_Engine = f.readline().strip() or "arcpy"
     f.close()
 
     # Determine line existence by LiDAR year
@@ -242,94 +291,112 @@ def workLinesMem(segment_info):
     x2 = segment_list[-1].X
     y2 = segment_list[-1].Y
 
-    # Create segment feature class
-    try:
-        arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileSeg), "POLYLINE",
-                                            Centerline_Feature_Class, "DISABLED",
-                                            "DISABLED", Centerline_Feature_Class)
-        cursor = arcpy.da.InsertCursor(fileSeg, ["SHAPE@"])
-        cursor.insertRow([segment_info[0]])
-        del cursor
-    except Exception as e:
-        print("Create feature class {} failed.".format(fileSeg))
-        print(e)
-        return failed_line
-
-    # Create origin feature class
-    try:
-        arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileOrigin), "POINT",
-                                            Centerline_Feature_Class, "DISABLED",
-                                            "DISABLED", Centerline_Feature_Class)
-        cursor = arcpy.da.InsertCursor(fileOrigin, ["SHAPE@XY"])
-        xy = (float(x1), float(y1))
-        cursor.insertRow([xy])
-        del cursor
-    except Exception as e:
-        print("Create feature class {} failed.".format(fileOrigin))
-        print(e)
-        return failed_line
-
-    # Create destination feature class
-    try:
-        arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileDestination), "POINT",
-                                            Centerline_Feature_Class, "DISABLED",
-                                            "DISABLED", Centerline_Feature_Class)
-        cursor = arcpy.da.InsertCursor(fileDestination, ["SHAPE@XY"])
-        xy = (float(x2), float(y2))
-        cursor.insertRow([xy])
-        del cursor
-    except Exception as e:
-        print("Create feature class {} failed.".format(fileDestination))
-        print(e)
-        return failed_line
-
-    # Buffer around line
-    try:
-        arcpy.Buffer_analysis(segment_info[0], fileBuffer, Maximum_distance_from_centerline,
-                              "FULL", "ROUND", "NONE", "", "PLANAR")
-    except Exception as e:
-        print("Create buffer for {} failed".format(lineNo))
-        print(e)
-        return failed_line
-
-    # Clip cost raster using buffer
-    DescBuffer = arcpy.Describe(fileBuffer)
-    SearchBox = str(DescBuffer.extent.XMin) + " " + str(DescBuffer.extent.YMin) + " " + str(
-        DescBuffer.extent.XMax) + " " + str(DescBuffer.extent.YMax)
-    arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "",
-                          "ClippingGeometry", "NO_MAINTAIN_EXTENT")
-
-    try:
-        # Process: Cost Distance
-        arcpy.gp.CostDistance_sa(fileOrigin, fileClip, fileCostDa, "", "", "", "", "", "", "TO_SOURCE")
-        arcpy.gp.CostDistance_sa(fileDestination, fileClip, fileCostDb, "", "", "", "", "", "", "TO_SOURCE")
-
-        # Process: Corridor
-        arcpy.gp.Corridor_sa(fileCostDa, fileCostDb, fileCorridor)
-    except Exception as e:
-        print(e)
-        return failed_line
+    if Corridor_Engine == "arcpy":
+        # Create segment feature class
+        try:
+            arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileSeg), "POLYLINE",
+                                                Centerline_Feature_Class, "DISABLED",
+                                                "DISABLED", Centerline_Feature_Class)
+            cursor = arcpy.da.InsertCursor(fileSeg, ["SHAPE@"])
+            cursor.insertRow([segment_info[0]])
+            del cursor
+        except Exception as e:
+            print("Create feature class {} failed.".format(fileSeg))
+            print(e)
+            return failed_line
+
+        # Create origin feature class
+        try:
+            arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileOrigin), "POINT",
+                                                Centerline_Feature_Class, "DISABLED",
+                                                "DISABLED", Centerline_Feature_Class)
+            cursor = arcpy.da.InsertCursor(fileOrigin, ["SHAPE@XY"])
+            xy = (float(x1), float(y1))
+            cursor.insertRow([xy])
+            del cursor
+        except Exception as e:
+            print("Create feature class {} failed.".format(fileOrigin))
+            print(e)
+            return failed_line
+
+        # Create destination feature class
+        try:
+            arcpy.CreateFeatureclass_management(outWorkspaceMem, os.path.basename(fileDestination), "POINT",
+                                                Centerline_Feature_Class, "DISABLED",
+                                                "DISABLED", Centerline_Feature_Class)
+            cursor = arcpy.da.InsertCursor(fileDestination, ["SHAPE@XY"])
+            xy = (float(x2), float(y2))
+            cursor.insertRow([xy])
+            del cursor
+        except Exception as e:
+            print("Create feature class {} failed.".format(fileDestination))
+            print(e)
+            return failed_line
+
+        # Buffer around line
+        try:
+            arcpy.Buffer_analysis(segment_info[0], fileBuffer, Maximum_distance_from_centerline,
+                                  "FULL", "ROUND", "NONE", "", "PLANAR")
+        except Exception as e:
+            print("Create buffer for {} failed".format(lineNo))
+            print(e)
+            return failed_line
+
+        # Clip cost raster using buffer
+        DescBuffer = arcpy.Describe(fileBuffer)
+        SearchBox = str(DescBuffer.extent.XMin) + " " + str(DescBuffer.extent.YMin) + " " + str(
+            DescBuffer.extent.XMax) + " " + str(DescBuffer.extent.YMax)
+        arcpy.Clip_management(Cost_Raster, SearchBox, fileClip, fileBuffer, "",
+                              "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+
+        try:
+            # Process: Cost Distance
+            arcpy.gp.CostDistance_sa(fileOrigin, fileClip, fileCostDa, "", "", "", "", "", "", "TO_SOURCE")
+            arcpy.gp.CostDistance_sa(fileDestination, fileClip, fileCostDb, "", "", "", "", "", "", "TO_SOURCE")
+
+            # Process: Corridor
+            arcpy.gp.Corridor_sa(fileCostDa, fileCostDb, fileCorridor)
+        except Exception as e:
+            print(e)
+            return failed_line
+    else:
+        # Both cost distance surfaces and the corridor are computed in process
+        try:
+            RasterCorridor = FLM_LineFootprint.corridorNative(segment_info[0], Cost_Raster,
+                                                              Maximum_distance_from_centerline, Corridor_Threshold)
+            if RasterCorridor is None:
+                print("Line segment {} error: no corridor found".format(lineNo))
+                return failed_line
+
+            RasterCorridor.save(fileCorridorMin)
+            arcpy.DefineProjection_management(fileCorridorMin, segment_info[0].spatialReference)
+            del RasterCorridor
+        except Exception as e:
+            print(e)
+            return failed_line
 
     footprint = []
 
     # Calculate minimum value of corridor raster
     try:
-        RasterCorridor = arcpy.Raster(fileCorridor)
+        if Corridor_Engine == "arcpy":
+            RasterCorridor = arcpy.Raster(fileCorridor)
 
-        if not RasterCorridor.minimum is None:
-            CorrMin = float(RasterCorridor.minimum)
-        else:
-            print("Line segment {} error: RasterCorridor.minimum is None", lineNo)
-            CorrMin = 0
+            if not RasterCorridor.minimum is None:
+                CorrMin = float(RasterCorridor.minimum)
+            else:
+                print("Line segment {} error: RasterCorridor.minimum is None", lineNo)
+                CorrMin = 0
 
-        # Set minimum as zero and save minimum file
-        RasterCorridor = ((RasterCorridor - CorrMin) > Corridor_Threshold)
-        RasterCorridor.save(fileCorridorMin)
+            # Set minimum as zero and save minimum file
+            RasterCorridor = ((RasterCorridor - CorrMin) > Corridor_Threshold)
+            RasterCorridor.save(fileCorridorMin)
+            del RasterCorridor
 
         # Process: Stamp CC and Max Line Width
         RasterClass = SetNull(IsNull(Raster(fileCorridorMin)), (Raster(fileCorridorMin) + (Raster(Canopy_Raster) >= 1)) > 0)
         RasterClass.save(fileThreshold)
-        del RasterCorridor, RasterClass
+        del RasterClass
 
         if (int(Expand_And_Shrink_Cell_Range) > 0):
             # Process: Expand
@@ -356,24 +423,14 @@ def workLinesMem(segment_info):
 
     line_exist = tagLine(footprint, In_CHM, segment_info)
 
-    flmc.log("Processing line {} done. Line exist: {}".format(fileSeg, line_exist))
+    flmc.log("Processing line {} done. Line exist: {}".format(fileSeg, line_exist), level=flmc.LINE)
 
-    # Clean temporary files
+    # Clean temporary files, the native corridor engine creates only some of them
     try:
-        arcpy.Delete_management(fileSeg)
-        arcpy.Delete_management(fileOrigin)
-        arcpy.Delete_management(fileDestination)
-        arcpy.Delete_management(fileBuffer)
-        arcpy.Delete_management(fileClip)
-        arcpy.Delete_management(fileCostDa)
-        arcpy.Delete_management(fileCostDb)
-        arcpy.Delete_management(fileThreshold)
-        arcpy.Delete_management(fileCorridor)
-        arcpy.Delete_management(fileCorridorMin)
-        arcpy.Delete_management(fileExpand)
-        arcpy.Delete_management(fileShrink)
-        arcpy.Delete_management(fileClean)
-        arcpy.Delete_management(fileNull)
+        for fileTemp in [fileSeg, fileOrigin, fileDestination, fileBuffer, fileClip, fileCostDa, fileCostDb,
+                         fileThreshold, fileCorridor, fileCorridorMin, fileExpand, fileShrink, fileClean, fileNull]:
+            if arcpy.Exists(fileTemp):
+                arcpy.Delete_management(fileTemp)
     except Exception as e:
         print("Line Footprint: Deleting temporary file failed. Inspect later.")
         return failed_line
@@ -410,6 +467,13 @@ def main(argv=None):
     Maximum_distance_from_centerline = float(args[5].rstrip()) / 2.0
     global Out_Tagged_Line
     Out_Tagged_Line = args[6].rstrip()
+    global Corridor_Engine
+    Corridor_Engine = args[7].rstrip() if len(args) > 7 and args[7] else "arcpy"
+    if Corridor_Engine not in FLM_LineFootprint.CORRIDOR_ENGINES:
+        flmc.log("Corridor engine {} is not supported, arcpy is used.".format(Corridor_Engine))
+        Corridor_Engine = "arcpy"
+    Cache_Budget = int(args[8]) if len(args) > 8 and args[8].strip() else flmrs.CACHE_BUDGET
+    Cache_Budget = flmrs.engineCacheBudget(Corridor_Engine, Cache_Budget)
     outWorkspace = flmc.SetupWorkspace(workspaceName)
 
     # write params to text file
@@ -422,6 +486,8 @@ def main(argv=None):
     f.write(In_Lidar_Year + "\n")
     f.write(str(Maximum_distance_from_centerline) + "\n")
     f.write(Out_Tagged_Line + "\n")
+    f.write(Corridor_Engine + "\n")
+    f.write(str(Cache_Budget) + "\n")
     f.close()
 
     # Remind if Status field is already in Shapefile
@@ -429,21 +495,28 @@ def main(argv=None):
         print("{} has Status field, it will be overwritten.".format(Centerline_Feature_Class))
 
     polygons = retrievePolygons(In_Lidar_Year)
+    buildCoverage(polygons)
 
-    # Prepare input lines for multiprocessing
+    # Prepare input lines for multiprocessing, segments carry only the IDs of candidate polygons
     fields = flmc.GetAllFieldsFromShp(Centerline_Feature_Class)
     global ProcessSegments
     segment_all = flmc.SplitLines(Centerline_Feature_Class, outWorkspace,
-                                  "LFP", ProcessSegments, fields, polygons)
+                                  "LFP", ProcessSegments, fields, coverageCandidates)
+
+    # Native engine reads line windows from the cost raster in shared memory
+    descriptors = flmrs.publishRasters([Cost_Raster]) if Corridor_Engine != "arcpy" else []
 
     # TODO: inspect how GetCores works. Make sure it uses all the CPU cores
-    pool = multiprocessing.Pool(processes=flmc.GetCores())
+    pool = multiprocessing.Pool(processes=flmc.GetCores(), initializer=initWorker,
+                                initargs=(flmc.StartLogListener(), flmc.LOG_LEVEL, descriptors, Cache_Budget, polygons))
     flmc.log("Multiprocessing line corridors...")
     flmc.log("Using {} CPU cores".format(flmc.GetCores()))
 
-    tagged_lines = pool.map(workLinesMem, segment_all)  # new version of memory based processing
+    tagged_lines = flmc.MapInSpatialOrder(pool, workLinesMem, segment_all)  # new version of memory based processing
     pool.close()
     pool.join()
+    flmrs.releaseRasters()
+    flmc.StopLogListener()
     flmc.logStep("Tagging lines multiprocessing")
 
     flmc.log("Write lines with existence and all statistics...")
@@ -0,0 +1,254 @@
+#
+#    Copyright (C) 2021  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_RasterExpression.py
+# Script Author: Applied Geospatial Research Group
+# Date: 2026-Oct-18
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Lazy map algebra. Expressions written with Raster, Con, Exp and
+# Power and the arithmetic operators are only recorded. evaluate then runs the
+# whole chain block by block, so no full size intermediate raster is created.
+# NoData is NaN and propagates like in arcpy.sa.
+#
+# ---------------------------------------------------------------------------
+# System imports
+import os
+
+import numpy as np
+
+BLOCK_SIZE = 1024  # block size in cells
+
+
+class Expression(object):
+    """
+    Node of a lazy raster expression.
+        op: NumPy function applied to the evaluated arguments, None for inputs
+        args: child expressions or numbers
+    """
+    __hash__ = object.__hash__
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+
+    def __add__(self, other):
+        return Expression(np.add, [self, other])
+
+    def __radd__(self, other):
+        return Expression(np.add, [other, self])
+
+    def __sub__(self, other):
+        return Expression(np.subtract, [self, other])
+
+    def __rsub__(self, other):
+        return Expression(np.subtract, [other, self])
+
+    def __mul__(self, other):
+        return Expression(np.multiply, [self, other])
+
+    def __rmul__(self, other):
+        return Expression(np.multiply, [other, self])
+
+    def __truediv__(self, other):
+        return Expression(np.divide, [self, other])
+
+    def __rtruediv__(self, other):
+        return Expression(np.divide, [other, self])
+
+    def __lt__(self, other):
+        return Expression(np.less, [self, other])
+
+    def __le__(self, other):
+        return Expression(np.less_equal, [self, other])
+
+    def __gt__(self, other):
+        return Expression(np.greater, [self, other])
+
+    def __ge__(self, other):
+        return Expression(np.greater_equal, [self, other])
+
+    def __eq__(self, other):
+        return Expression(np.equal, [self, other])
+
+    def inputs(self):
+        """
+        Input rasters of the expression, each listed once.
+        """
+        # Compare by identity, == builds an expression
+        found = []
+        for arg in self.args:
+            if isinstance(arg, Expression):
+                for item in arg.inputs():
+                    if not any(item is other for other in found):
+                        found.append(item)
+
+        return found
+
+    def evaluateBlock(self, blocks):
+        """
+        Evaluate the expression on one block.
+            blocks: dictionary of input Raster to its block array
+            return: block array and whether it is a temporary the caller may overwrite
+        """
+        values = []
+        for arg in self.args:
+            if isinstance(arg, Expression):
+                values.append(arg.evaluateBlock(blocks))
+            else:
+                values.append((arg, False))
+
+        # Write the result into a temporary operand when there is one
+        out = None
+        for value, owned in values:
+            if owned and isinstance(value, np.ndarray) and value.dtype == np.float64:
+                out = value
+                break
+
+        arrays = [value for value, _ in values]
+        if self.op in (np.less, np.less_equal, np.greater, np.greater_equal, np.equal):
+            # Comparisons give 1 and 0, NoData stays NoData
+            with np.errstate(invalid="ignore"):
+                result = self.op(*arrays).astype(np.float64)
+            for value in arrays:
+                if isinstance(value, np.ndarray):
+                    result[np.isnan(value)] = np.nan
+            return result, True
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            if out is None or not isinstance(self.op, np.ufunc):
+                result = self.op(*arrays)
+            else:
+                result = self.op(*arrays, out=out)
+
+        return result, True
+
+
+class Raster(Expression):
+    """
+    Input of an expression.
+        source: raster path, arcpy.Raster or NumPy array
+    """
+    def __init__(self, source):
+        Expression.__init__(self, None, [])
+        self.source = source
+
+    def inputs(self):
+        return [self]
+
+    def evaluateBlock(self, blocks):
+        return blocks[self], False
+
+
+def conditional(condition, true_value, false_value):
+    """
+    Cell wise condition like numpy.where, NoData where the condition is NoData.
+    """
+    with np.errstate(invalid="ignore"):
+        result = np.where(condition != 0, true_value, false_value).astype(np.float64)
+    result[np.isnan(condition)] = np.nan
+
+    return result
+
+
+def Con(condition, true_value, false_value):
+    """
+    Lazy arcpy.sa.Con.
+    """
+    return Expression(conditional, [condition, true_value, false_value])
+
+
+def Exp(value):
+    """
+    Lazy arcpy.sa.Exp.
+    """
+    return Expression(np.exp, [value])
+
+
+def Power(value, exponent):
+    """
+    Lazy arcpy.sa.Power.
+    """
+    return Expression(np.power, [value, exponent])
+
+
+def evaluateArray(expression):
+    """
+    Evaluate an expression whose inputs are NumPy arrays of the same shape in one block.
+    """
+    blocks = {item: np.asarray(item.source, dtype=np.float64) for item in expression.inputs()}
+    result, _ = expression.evaluateBlock(blocks)
+
+    return result
+
+
+def evaluate(expression, out_raster, block_size=BLOCK_SIZE):
+    """
+    Evaluate an expression of rasters block by block and save the result.
+    Each block of every input is read once and the whole chain is applied to it
+    in one pass, so memory use is a few blocks instead of one raster per step.
+    Input rasters must have the same extent and cell size.
+        out_raster: output raster path, blocks are mosaicked into it
+        return: True when the output is saved
+    """
+    import arcpy
+    import FLM_Common as flmc
+
+    inputs = expression.inputs()
+    rasters = [arcpy.Raster(item.source) for item in inputs]
+    template = rasters[0]
+    for raster in rasters[1:]:
+        if (raster.width, raster.height) != (template.width, template.height) or \
+                abs(raster.meanCellWidth - template.meanCellWidth) > 1e-9 * template.meanCellWidth:
+            flmc.log("ERROR: Rasters of the expression are not on the same grid.")
+            return False
+
+    cell_size = template.meanCellWidth
+    spatial_reference = template.spatialReference
+    out_folder = os.path.dirname(out_raster)
+    out_name = os.path.splitext(os.path.basename(out_raster))[0]
+
+    block_files = []
+    for row in range(0, template.height, block_size):
+        for col in range(0, template.width, block_size):
+            nrows = min(block_size, template.height - row)
+            ncols = min(block_size, template.width - col)
+            blocks = {item: flmc.GetRasterBlock(raster, row, col, nrows, ncols)
+                      for item, raster in zip(inputs, rasters)}
+            result, _ = expression.evaluateBlock(blocks)
+            del blocks
+
+            x_min = template.extent.XMin + col * cell_size
+            y_max = template.extent.YMax - row * cell_size
+            if nrows == template.height and ncols == template.width:
+                # Single block, no mosaic needed
+                flmc.SaveArrayAsRaster(result, x_min, y_max, cell_size, spatial_reference, out_raster)
+                return True
+
+            block_file = os.path.join(arcpy.env.scratchFolder, "{}_{}_{}.tif".format(out_name, row, col))
+            flmc.SaveArrayAsRaster(result, x_min, y_max, cell_size, spatial_reference, block_file)
+            block_files.append(block_file)
+            del result
+
+    arcpy.MosaicToNewRaster_management(";".join(block_files), out_folder, os.path.basename(out_raster),
+                                       spatial_reference, "32_BIT_FLOAT", cell_size, 1, "FIRST")
+    for block_file in block_files:
+        arcpy.Delete_management(block_file)
+
+    return True
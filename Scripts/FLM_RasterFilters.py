@@ -0,0 +1,219 @@
+#
+#    Copyright (C) 2021  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_RasterFilters.py
+# Script Author: Applied Geospatial Research Group
+# Date: 2026-Oct-18
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Raster filters working on NumPy arrays, used in place of the
+# arcpy.sa neighbourhood tools when building canopy and cost rasters.
+#
+# ---------------------------------------------------------------------------
+# System imports
+import numpy as np
+
+RASTER_ENGINES = ["arcpy", "numpy"]  # arcpy: FocalStatistics and EucAllocation; numpy: this module
+
+
+def circleKernel(radius):
+    """
+    Circular neighbourhood as used by FocalStatistics: cells whose centres
+    are within radius of the processing cell centre.
+        radius: radius in cells
+        return: 2D float array of 0 and 1
+    """
+    half = int(np.floor(radius))
+    offsets = np.arange(-half, half + 1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing="ij")
+
+    return (dx * dx + dy * dy <= radius * radius).astype(np.float64)
+
+
+def boxSum(array, half):
+    """
+    Sum of each (2 * half + 1) square window with a summed-area table.
+    Cells outside the array count as zero. Run time does not depend on half.
+    """
+    rows, cols = array.shape
+    table = np.zeros((rows + 1, cols + 1))
+    np.cumsum(array, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+
+    top = np.clip(np.arange(rows) - half, 0, rows)
+    bottom = np.clip(np.arange(rows) + half + 1, 0, rows)
+    left = np.clip(np.arange(cols) - half, 0, cols)
+    right = np.clip(np.arange(cols) + half + 1, 0, cols)
+
+    return (table[np.ix_(bottom, right)] - table[np.ix_(top, right)]
+            - table[np.ix_(bottom, left)] + table[np.ix_(top, left)])
+
+
+def fftConvolve(arrays, kernel):
+    """
+    Convolve each array with kernel by FFT, output has the shape of the input.
+    Cells outside the arrays count as zero. The kernel transform is computed
+    once and shared by all arrays, which must have the same shape.
+        arrays: list of 2D arrays
+        kernel: 2D array with odd dimensions
+    """
+    rows, cols = arrays[0].shape
+    k_rows, k_cols = kernel.shape
+    shape = (rows + k_rows - 1, cols + k_cols - 1)
+    kernel_fft = np.fft.rfft2(kernel, shape)
+
+    r0 = k_rows // 2
+    c0 = k_cols // 2
+    results = []
+    for array in arrays:
+        full = np.fft.irfft2(np.fft.rfft2(array, shape) * kernel_fft, shape)
+        results.append(full[r0:r0 + rows, c0:c0 + cols])
+
+    return results
+
+
+def focalMeanStd(array, radius, shape="CIRCLE"):
+    """
+    Focal mean and standard deviation computed together in one pass, same as
+    FocalStatistics MEAN and STD with NoData ignored. Square neighbourhoods use
+    summed-area tables and circular ones FFT convolution, so run time does not
+    grow with the radius.
+        array: 2D array, NaN is NoData
+        radius: neighbourhood radius in cells, half width for RECTANGLE
+        shape: CIRCLE or RECTANGLE
+        return: mean and std arrays, NaN where the neighbourhood has no data
+    """
+    valid = np.isfinite(array)
+    if not valid.any():
+        return np.full(array.shape, np.nan), np.full(array.shape, np.nan)
+
+    # Integer values such as canopy classes give exact sums after rounding, so the
+    # result does not depend on the array extent. Other values are shifted by the
+    # global mean to keep the variance accurate.
+    integral = np.array_equal(array[valid], np.rint(array[valid]))
+    shift = 0.0 if integral else float(array[valid].mean())
+    values = np.where(valid, array - shift, 0.0)
+    counts = valid.astype(np.float64)
+
+    if shape == "RECTANGLE":
+        half = int(np.floor(radius))
+        sums = [boxSum(a, half) for a in (values, values * values, counts)]
+    else:
+        sums = fftConvolve([values, values * values, counts], circleKernel(radius))
+
+    value_sum, square_sum, count = sums
+    count = np.rint(count)
+    if integral:
+        value_sum = np.rint(value_sum)
+        square_sum = np.rint(square_sum)
+    has_data = count > 0
+    count[~has_data] = 1.0
+
+    mean = value_sum / count
+    variance = square_sum / count - mean * mean
+    variance[variance < 1e-12] = 0.0  # FFT round off in flat neighbourhoods
+    mean += shift
+    std = np.sqrt(variance)
+    mean[~has_data] = np.nan
+    std[~has_data] = np.nan
+
+    return mean, std
+
+
+def squaredDistance1D(f):
+    """
+    One dimensional squared distance transform of each row of f with the
+    lower envelope of parabolas (Felzenszwalb and Huttenlocher). All rows are
+    processed together, so the Python loop runs once per column, not per cell.
+        f: 2D array of squared distances, inf where there is no source
+        return: min over x of (q - x)^2 + f[x] for every cell q of each row
+    """
+    rows, cols = f.shape
+    row_index = np.arange(rows)
+    v = np.zeros((rows, cols), dtype=np.int64)  # columns of the envelope parabolas
+    z = np.full((rows, cols + 1), np.inf)  # left boundaries of the parabolas
+    k = np.full(rows, -1, dtype=np.int64)  # last parabola of each row, -1 when empty
+
+    # Build lower envelopes
+    for q in range(cols):
+        fq = f[:, q] + q * q
+        active = row_index[np.isfinite(fq)]
+        s = np.full(active.size, -np.inf)
+        pending = np.arange(active.size)
+        while pending.size > 0:
+            r = active[pending]
+            kk = k[r]
+            has_parabola = kk >= 0
+            pending = pending[has_parabola]
+            r = r[has_parabola]
+            kk = kk[has_parabola]
+            vk = v[r, kk]
+            s_pending = (fq[r] - (f[r, vk] + vk * vk)) / (2.0 * (q - vk))
+            s[pending] = s_pending
+
+            # Drop the last parabola where the new one hides it
+            hidden = s_pending <= z[r, kk]
+            k[r[hidden]] -= 1
+            pending = pending[hidden]
+            s[pending] = -np.inf
+
+        k[active] += 1
+        v[active, k[active]] = q
+        z[active, k[active]] = s
+        z[active, k[active] + 1] = np.inf
+
+    # Evaluate lower envelopes
+    d = np.full((rows, cols), np.inf)
+    active = row_index[k >= 0]
+    j = np.zeros(active.size, dtype=np.int64)
+    for q in range(cols):
+        advance = z[active, j + 1] < q
+        while advance.any():
+            j[advance] += 1
+            advance = z[active, j + 1] < q
+        vj = v[active, j]
+        d[active, q] = (q - vj) ** 2 + f[active, vj]
+
+    return d
+
+
+def euclideanDistance(source, cell_size=1.0, max_distance=None):
+    """
+    Exact Euclidean distance from each cell centre to the nearest source cell,
+    the same as the distance output of EucAllocation. The transform is separable:
+    a column pass followed by a row pass with squaredDistance1D.
+        source: 2D boolean array, True for source cells (canopy)
+        cell_size: raster cell size
+        max_distance: distances are capped at this value in map units
+        return: float32 distance array, inf where no source is reachable and no cap is given
+    """
+    cap = np.inf if max_distance is None else float(max_distance) / cell_size
+    f = np.where(source, 0.0, np.inf)
+    d = squaredDistance1D(f.T).T
+
+    # Column distances beyond the cap cannot give a distance within the cap
+    d[d > cap * cap] = np.inf
+    d = squaredDistance1D(d)
+
+    distance = np.sqrt(d).astype(np.float32)
+    if max_distance is not None:
+        np.minimum(distance, cap, out=distance)
+    distance *= cell_size
+
+    return distance
@@ -27,21 +27,155 @@
 #
 # ---------------------------------------------------------------------------
 
+# System imports
+import os
+import numpy
+
 # Import arcpy module
 import arcpy
 from arcpy.sa import *
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
 import FLM_Attribute_Functions as flma
+import FLM_RasterStore as flmrs
+
+SAMPLING_ENGINES = ["arcpy", "native"]
+PERCENTILES = [10, 50, 90]
+
+# Sampling methods of the tool and merge rules to segment statistics
+METHOD_STATISTICS = {"Minimum": "MIN", "Min": "MIN", "Maximum": "MAX", "Max": "MAX", "Mean": "MEAN",
+					 "Standard Deviation": "STD", "StdDev": "STD", "Median": "MEDIAN", "Mode": "MODE",
+					 "Range": "RANGE", "Sum": "SUM", "Count": "COUNT", "First": "FIRST", "Last": "LAST"}
+
+def segmentSamples(segments, interval):
+	"""
+	Sample points every interval along every segment, calculated from the segment vertices.
+		segments: list of polylines
+		return: x, y and segment index of the points
+	"""
+	vertices = []
+	part_ids = []
+	part_segment = []
+	for i, segment in enumerate(segments):
+		if segment is None:
+			continue
+		for part in segment:
+			points = [[pnt.X, pnt.Y] for pnt in part if pnt]
+			vertices += points
+			part_ids += [len(part_segment)] * len(points)
+			part_segment.append(i)
+
+	if not vertices:
+		return numpy.empty(0), numpy.empty(0), numpy.empty(0, dtype=numpy.int64)
+
+	x, y, part = flmc.PointsAlongLines(numpy.array(vertices, dtype=numpy.float64), numpy.array(part_ids), interval)
+	return x, y, numpy.array(part_segment)[part]
+
+def segmentStatistics(values, segment, n_segments):
+	"""
+	Statistics of the sample values of every segment, NoData samples are ignored.
+		values: sample values in order along the segments
+		segment: segment index of every sample
+		return: dictionary of statistic to array of n_segments, NaN for segments without samples
+	"""
+	valid = ~numpy.isnan(values)
+	values = values[valid]
+	segment = segment[valid]
+
+	count = numpy.bincount(segment, minlength=n_segments)
+	has = count > 0
+	total = numpy.bincount(segment, values, minlength=n_segments)
+	mean = numpy.full(n_segments, numpy.nan)
+	mean[has] = total[has] / count[has]
+	squares = numpy.bincount(segment, (values - mean[segment]) ** 2, minlength=n_segments)
+	std = numpy.full(n_segments, numpy.nan)
+	std[has] = numpy.sqrt(squares[has] / numpy.maximum(count[has] - 1, 1))
+
+	# Values sorted within segments give minimum, maximum and mode
+	order = numpy.lexsort((values, segment))
+	sorted_values = values[order]
+	sorted_segment = segment[order]
+	starts = numpy.cumsum(count) - count
+	minimum = numpy.full(n_segments, numpy.nan)
+	maximum = numpy.full(n_segments, numpy.nan)
+	minimum[has] = sorted_values[starts[has]]
+	maximum[has] = sorted_values[starts[has] + count[has] - 1]
+
+	# Mode is the longest run of equal values, the smallest value on ties
+	mode = numpy.full(n_segments, numpy.nan)
+	if len(values) > 0:
+		run_start = numpy.flatnonzero(numpy.concatenate(([True], (sorted_values[1:] != sorted_values[:-1]) |
+														 (sorted_segment[1:] != sorted_segment[:-1]))))
+		run_length = numpy.diff(numpy.append(run_start, len(values)))
+		run_segment = sorted_segment[run_start]
+		runs = numpy.lexsort((run_start, -run_length, run_segment))
+		best = runs[numpy.concatenate(([True], run_segment[runs][1:] != run_segment[runs][:-1]))]
+		mode[run_segment[best]] = sorted_values[run_start[best]]
+
+	# First and last samples along the segments
+	first = numpy.full(n_segments, numpy.nan)
+	last = numpy.full(n_segments, numpy.nan)
+	first[segment[::-1]] = values[::-1]
+	last[segment] = values
 
-def main():
+	statistics = {"COUNT": count.astype(numpy.float64), "SUM": numpy.where(has, total, numpy.nan), "MEAN": mean,
+				  "STD": std, "MIN": minimum, "MAX": maximum, "RANGE": maximum - minimum, "MODE": mode,
+				  "MEDIAN": flmc.PercentileByGroup(values, segment, n_segments, 50), "FIRST": first, "LAST": last}
+	for p in PERCENTILES:
+		statistics["P" + str(p)] = flmc.PercentileByGroup(values, segment, n_segments, p)
+
+	return statistics
+
+def nativeRasterAttributes(Segmented_Lines, Input_Raster, Measure_Interval, Sampling_Method, Attributed_Segments):
+	"""
+	Sample the raster along every segment and write the segment statistics, without sample point files.
+	Samples are placed every Measure_Interval from the start of each segment and read by
+	vectorized indexing of the raster cells. RASTERVALU holds the statistic of Sampling_Method,
+	and MEAN, MIN, MAX and percentiles are added. Every segment is written like in the arcpy path,
+	segments without valid samples get null statistics.
+	"""
+	fields = [field.name for field in arcpy.ListFields(Segmented_Lines)
+			  if field.type not in ["Geometry", "OID"] and field.editable]
+	stat_fields = ["RASTERVALU", "MEAN", "MIN", "MAX"] + ["P" + str(p) for p in PERCENTILES]
+	fields = [field for field in fields if field not in stat_fields]
+
+	with arcpy.da.SearchCursor(Segmented_Lines, ["SHAPE@"] + fields) as cursor:
+		rows = [list(row) for row in cursor]
+
+	x, y, segment = segmentSamples([row[0] for row in rows], Measure_Interval)
+	values = flmrs.sampleRaster(Input_Raster, x, y, "NEAREST")
+	statistics = segmentStatistics(values, segment, len(rows))
+	statistics["RASTERVALU"] = statistics[METHOD_STATISTICS.get(Sampling_Method, "MEAN")]
+
+	arcpy.CreateFeatureclass_management(os.path.dirname(Attributed_Segments), os.path.basename(Attributed_Segments),
+										"POLYLINE", Segmented_Lines, "DISABLED", "DISABLED", Segmented_Lines)
+	for field in stat_fields:
+		if not flmc.HasField(Attributed_Segments, field):
+			arcpy.AddField_management(Attributed_Segments, field, "DOUBLE")
+
+	attributed = 0
+	with arcpy.da.InsertCursor(Attributed_Segments, ["SHAPE@"] + fields + stat_fields) as cursor:
+		for i, row in enumerate(rows):
+			if statistics["COUNT"][i] == 0:
+				cursor.insertRow(row + [None] * len(stat_fields))
+				continue
+			cursor.insertRow(row + [None if numpy.isnan(statistics[field][i]) else float(statistics[field][i])
+									for field in stat_fields])
+			attributed += 1
+
+	flmc.log("{} of {} segments have valid samples.".format(attributed, len(rows)))
+
+def main(argv=None):
 	# Setup script path and output folder
 	outWorkspace = flmc.SetupWorkspace("FLM_RLA_output")
 	arcpy.env.workspace = outWorkspace
 	arcpy.env.overwriteOutput = True
 	
 	# Load arguments from file
-	args = flmc.GetArgs("FLM_RLA_params.txt")
+	if argv:
+		args = argv
+	else:
+		args = flmc.GetArgs("FLM_RLA_params.txt")
 			
 	# Tool arguments
 	Input_Lines = args[0].rstrip()
@@ -52,6 +186,25 @@ def main():
 	Tolerance_Radius = float(args[5].rstrip())
 	Sampling_Method = args[6].rstrip()
 	Attributed_Segments = args[7].rstrip()
+	Sampling_Engine = args[8].rstrip() if len(args) > 8 and args[8] else "arcpy"
+	if Sampling_Engine not in SAMPLING_ENGINES:
+		flmc.log("Sampling engine {} is not supported, arcpy is used.".format(Sampling_Engine))
+		Sampling_Engine = "arcpy"
+	Split_Engine = args[9].rstrip() if len(args) > 9 and args[9] else "arcpy"
+	if Split_Engine not in flma.SPLIT_ENGINES:
+		flmc.log("Split engine {} is not supported, arcpy is used.".format(Split_Engine))
+		Split_Engine = "arcpy"
+
+	if Sampling_Engine == "native":
+		flmc.log("Splitting lines...")
+		FLM_RLA_Segmented_Lines = flma.FlmLineSplit(outWorkspace, Input_Lines, SamplingType, Segment_Length, Tolerance_Radius,
+													Split_Engine)
+		flmc.logStep("Line split")
+
+		flmc.log("Sampling raster along line segments...")
+		nativeRasterAttributes(FLM_RLA_Segmented_Lines, Input_Raster, Measure_Interval, Sampling_Method, Attributed_Segments)
+		flmc.logStep("Raster sampling")
+		return
 
 	# Local variables:
 	FLM_RLA_Measure_Points = outWorkspace+"\\FLM_RLA_Measure_Points.shp"
@@ -75,7 +228,8 @@ def main():
 	fieldmappings.addFieldMap (fieldmap)
 
 	flmc.log("Splitting lines...")
-	FLM_RLA_Segmented_Lines = flma.FlmLineSplit(outWorkspace,Input_Lines,SamplingType,Segment_Length,Tolerance_Radius)
+	FLM_RLA_Segmented_Lines = flma.FlmLineSplit(outWorkspace,Input_Lines,SamplingType,Segment_Length,Tolerance_Radius,
+												Split_Engine)
 	flmc.logStep("Line split")
 
 	flmc.log("Generating raster statistics along line segments")
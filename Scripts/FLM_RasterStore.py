@@ -0,0 +1,470 @@
+#
+#    Copyright (C) 2021  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_RasterStore.py
+# Script Author: Applied Geospatial Research Group
+# Date: 2026-Oct-18
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Shared memory raster store. The parent process loads a raster once
+# into shared memory and the pool workers attach to it, so every worker reads
+# its line windows as zero-copy NumPy views instead of clipping the raster.
+# Rasters too large for shared memory are read through a per process LRU
+# cache of decoded tiles, so adjacent lines reuse tiles instead of the file.
+# Only the native engines read rasters through the store, the arcpy engines
+# clip the raster for every line and run without a tile cache.
+#
+# Usage in a tool main:
+#   descriptors = flmrs.publishRasters([Cost_Raster])
+#   Cache_Budget = flmrs.engineCacheBudget(Engine, Cache_Budget)
+#   pool = multiprocessing.Pool(processes=flmc.GetCores(), initializer=flmc.InitWorker,
+#                               initargs=(flmc.StartLogListener(), flmc.LOG_LEVEL, descriptors, Cache_Budget))
+#   ...
+#   flmrs.releaseRasters()
+#   flmc.StopLogListener()
+#
+# flmc.GetRasterWindow returns windows from the store for published rasters
+# and from the tile cache for other raster paths.
+# flmrs.sampleRaster returns values at points from either of them.
+# flmrs.zonalStatistics reduces the cells of overlapping zones given as sparse
+# cell and zone pairs, e.g. from flmrs.polygonCells.
+#
+# ---------------------------------------------------------------------------
+# System imports
+import os
+import math
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+import numpy as np
+
+STRIP_ROWS = 1024  # rows read at a time when loading a raster
+SHARED_MEMORY_LIMIT = 8 * 1024 ** 3  # largest raster in bytes loaded into shared memory
+TILE_SIZE = 512  # tile side in cells of the tile cache
+CACHE_BUDGET = 256 * 1024 ** 2  # bytes of decoded tiles kept per process, 0 disables the cache
+ZONE_PAIRS = 20000000  # cell and zone pairs collected before their cells are read
+
+# Rasters of this process: raster key -> (SharedMemory, array, x_min, y_max, cell_size)
+published = {}
+
+# Tile cache of this process: (raster key, tile row, tile col) -> tile array, least recently used first
+tile_cache = OrderedDict()
+cache_bytes = 0
+cache_budget = CACHE_BUDGET
+opened = {}  # raster key -> arcpy.Raster
+
+
+def rasterKey(raster):
+    """
+    Key of a raster path in the store, None for other raster inputs.
+    """
+    if not isinstance(raster, str):
+        return None
+
+    return os.path.normcase(os.path.abspath(raster))
+
+
+def windowIndices(extent, x_min, y_max, cell_size, height, width):
+    """
+    Rows and columns of the raster grid covering extent, clamped to the raster.
+        return: row_min, row_max, col_min, col_max, end exclusive
+    """
+    col_min = max(int(math.floor((extent[0] - x_min) / cell_size)), 0)
+    col_max = min(int(math.ceil((extent[2] - x_min) / cell_size)), width)
+    row_min = max(int(math.floor((y_max - extent[3]) / cell_size)), 0)
+    row_max = min(int(math.ceil((y_max - extent[1]) / cell_size)), height)
+
+    return row_min, row_max, col_min, col_max
+
+
+def publishRasters(rasters):
+    """
+    Load rasters into shared memory in the parent process.
+    The rasters are read in strips of rows straight into the shared buffer
+    as float32, NoData as NaN. Rasters larger than SHARED_MEMORY_LIMIT are
+    left to the tile cache of the workers.
+        rasters: list of raster paths
+        return: list of descriptors for attachRasters, empty when loading failed
+    """
+    import arcpy
+    import FLM_Common as flmc
+
+    descriptors = []
+    for path in rasters:
+        try:
+            raster = arcpy.Raster(path)
+            shape = (raster.height, raster.width)
+            if shape[0] * shape[1] * 4 > SHARED_MEMORY_LIMIT:
+                flmc.log("Raster {} is too large for shared memory, workers will use the tile cache.".format(path))
+                continue
+
+            shm = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1] * 4)
+            array = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+            for row in range(0, shape[0], STRIP_ROWS):
+                nrows = min(STRIP_ROWS, shape[0] - row)
+                array[row:row + nrows] = flmc.GetRasterBlock(raster, row, 0, nrows, shape[1])
+        except Exception as e:
+            flmc.log("Raster {} is not loaded into shared memory, workers will read it from file.".format(path))
+            print(e)
+            continue
+
+        x_min = raster.extent.XMin
+        y_max = raster.extent.YMax
+        cell_size = raster.meanCellWidth
+        published[rasterKey(path)] = (shm, array, x_min, y_max, cell_size)
+        descriptors.append((path, shm.name, shape, x_min, y_max, cell_size))
+        flmc.log("Raster {} loaded into shared memory.".format(path))
+
+    return descriptors
+
+
+def engineCacheBudget(engine, budget):
+    """
+    Tile cache budget of the workers for a raster engine.
+    Only the native engines read raster windows through the store and the tile
+    cache, the arcpy engine clips the raster for every line, so its workers
+    keep no tiles.
+        return: budget for native engines, 0 for arcpy
+    """
+    if engine != "arcpy":
+        return budget
+
+    if budget != CACHE_BUDGET:
+        import FLM_Common as flmc
+        flmc.log("WARNING: The tile cache is only used by the native engines, cache budget {} is ignored."
+                 .format(budget), level=flmc.WARNING)
+
+    return 0
+
+
+def attachRasters(descriptors, budget=CACHE_BUDGET):
+    """
+    Pool initializer, attach the worker process to the published rasters.
+    The arrays are read only views of the shared memory.
+        budget: bytes of the tile cache of the worker
+    """
+    global cache_budget
+    cache_budget = budget
+
+    for path, name, shape, x_min, y_max, cell_size in descriptors:
+        shm = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        array.flags.writeable = False
+        published[rasterKey(path)] = (shm, array, x_min, y_max, cell_size)
+
+
+def releaseRasters():
+    """
+    Free the shared memory of the rasters published by this process.
+    Call in the parent after the pool is joined.
+    """
+    for key in list(published.keys()):
+        shm, array = published.pop(key)[0:2]
+        del array
+        shm.close()
+        shm.unlink()
+
+
+def getWindow(raster, extent):
+    """
+    Window of a published raster, see flmc.GetRasterWindow.
+        return: (window, x_min, y_max, cell_size) with window a read only view,
+                None when the raster is not in the store
+    """
+    item = published.get(rasterKey(raster))
+    if item is None:
+        return None
+
+    _, array, r_x_min, r_y_max, cell_size = item
+    row_min, row_max, col_min, col_max = windowIndices(extent, r_x_min, r_y_max, cell_size, *array.shape)
+
+    x_min = r_x_min + col_min * cell_size
+    y_max = r_y_max - row_min * cell_size
+    if col_max <= col_min or row_max <= row_min:
+        return np.empty((0, 0)), x_min, y_max, cell_size
+
+    return array[row_min:row_max, col_min:col_max], x_min, y_max, cell_size
+
+
+def getTile(key, raster, tile_row, tile_col):
+    """
+    Decoded tile of raster from the tile cache, read and cached when missing.
+    Least recently used tiles are dropped when the cache exceeds its budget.
+    """
+    global cache_bytes
+
+    tile = tile_cache.get((key, tile_row, tile_col))
+    if tile is not None:
+        tile_cache.move_to_end((key, tile_row, tile_col))
+        return tile
+
+    import FLM_Common as flmc
+
+    row = tile_row * TILE_SIZE
+    col = tile_col * TILE_SIZE
+    nrows = min(TILE_SIZE, raster.height - row)
+    ncols = min(TILE_SIZE, raster.width - col)
+    tile = flmc.GetRasterBlock(raster, row, col, nrows, ncols).astype(np.float32)
+
+    tile_cache[(key, tile_row, tile_col)] = tile
+    cache_bytes += tile.nbytes
+    while cache_bytes > cache_budget and len(tile_cache) > 1:
+        _, dropped = tile_cache.popitem(last=False)
+        cache_bytes -= dropped.nbytes
+
+    return tile
+
+
+def openRaster(key, raster):
+    """
+    arcpy.Raster of a raster path, opened once per process.
+    """
+    source = opened.get(key)
+    if source is None:
+        import arcpy
+        source = arcpy.Raster(raster)
+        opened[key] = source
+
+    return source
+
+
+def getCachedWindow(raster, extent):
+    """
+    Window of a raster path assembled from cached tiles, see flmc.GetRasterWindow.
+        return: (window, x_min, y_max, cell_size), None when the cache is disabled
+                or raster is not a path
+    """
+    key = rasterKey(raster)
+    if key is None or cache_budget <= 0:
+        return None
+
+    source = openRaster(key, raster)
+    cell_size = source.meanCellWidth
+    r_x_min = source.extent.XMin
+    r_y_max = source.extent.YMax
+    row_min, row_max, col_min, col_max = windowIndices(extent, r_x_min, r_y_max, cell_size,
+                                                       source.height, source.width)
+
+    x_min = r_x_min + col_min * cell_size
+    y_max = r_y_max - row_min * cell_size
+    if col_max <= col_min or row_max <= row_min:
+        return np.empty((0, 0)), x_min, y_max, cell_size
+
+    window = np.empty((row_max - row_min, col_max - col_min), dtype=np.float32)
+    for tile_row in range(row_min // TILE_SIZE, (row_max - 1) // TILE_SIZE + 1):
+        for tile_col in range(col_min // TILE_SIZE, (col_max - 1) // TILE_SIZE + 1):
+            tile = getTile(key, source, tile_row, tile_col)
+
+            # Overlap of the tile and the window in raster rows and columns
+            top = max(row_min, tile_row * TILE_SIZE)
+            bottom = min(row_max, tile_row * TILE_SIZE + tile.shape[0])
+            left = max(col_min, tile_col * TILE_SIZE)
+            right = min(col_max, tile_col * TILE_SIZE + tile.shape[1])
+            window[top - row_min:bottom - row_min, left - col_min:right - col_min] = \
+                tile[top - tile_row * TILE_SIZE:bottom - tile_row * TILE_SIZE,
+                     left - tile_col * TILE_SIZE:right - tile_col * TILE_SIZE]
+
+    return window, x_min, y_max, cell_size
+
+
+def sampleCells(raster, rows, cols):
+    """
+    Values of raster cells by grid position.
+    Published rasters are indexed directly, other rasters are read by tile
+    through the tile cache, so every tile is decoded once for all positions.
+        raster: raster path
+        rows, cols: integer arrays of cell rows and columns
+        return: float array, NaN for NoData and positions outside the raster
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.full(rows.shape, np.nan)
+    key = rasterKey(raster)
+
+    item = published.get(key)
+    if item is not None:
+        array = item[1]
+        inside = (rows >= 0) & (rows < array.shape[0]) & (cols >= 0) & (cols < array.shape[1])
+        values[inside] = array[rows[inside], cols[inside]]
+        return values
+
+    source = openRaster(key, raster)
+    inside = np.flatnonzero((rows >= 0) & (rows < source.height) & (cols >= 0) & (cols < source.width))
+    tile_cols = (source.width - 1) // TILE_SIZE + 1
+    tiles = (rows[inside] // TILE_SIZE) * tile_cols + cols[inside] // TILE_SIZE
+
+    # Group the positions by tile
+    order = np.argsort(tiles, kind="stable")
+    inside = inside[order]
+    tiles = tiles[order]
+    unique_tiles, starts = np.unique(tiles, return_index=True)
+    ends = np.append(starts[1:], len(tiles))
+    for tile_id, start, end in zip(unique_tiles, starts, ends):
+        tile_row, tile_col = divmod(int(tile_id), tile_cols)
+        tile = getTile(key, source, tile_row, tile_col)
+        index = inside[start:end]
+        values[index] = tile[rows[index] - tile_row * TILE_SIZE, cols[index] - tile_col * TILE_SIZE]
+
+    return values
+
+
+def sampleRaster(raster, x, y, method="NEAREST"):
+    """
+    Raster values at map coordinates.
+        raster: raster path
+        x, y: coordinate arrays
+        method: NEAREST for the value of the cell containing the point,
+                BILINEAR for the interpolation of the four nearest cell centres
+        return: float array, NaN for NoData and points outside the raster
+    """
+    key = rasterKey(raster)
+    item = published.get(key)
+    if item is not None:
+        x_min, y_max, cell_size = item[2:5]
+    else:
+        source = openRaster(key, raster)
+        x_min = source.extent.XMin
+        y_max = source.extent.YMax
+        cell_size = source.meanCellWidth
+
+    col = (np.asarray(x, dtype=np.float64) - x_min) / cell_size
+    row = (y_max - np.asarray(y, dtype=np.float64)) / cell_size
+    if method == "NEAREST":
+        return sampleCells(raster, np.floor(row), np.floor(col))
+
+    # Weights of the cell centres around the point
+    row = row - 0.5
+    col = col - 0.5
+    row_0 = np.floor(row)
+    col_0 = np.floor(col)
+    w_row = row - row_0
+    w_col = col - col_0
+
+    return (sampleCells(raster, row_0, col_0) * (1 - w_row) * (1 - w_col)
+            + sampleCells(raster, row_0, col_0 + 1) * (1 - w_row) * w_col
+            + sampleCells(raster, row_0 + 1, col_0) * w_row * (1 - w_col)
+            + sampleCells(raster, row_0 + 1, col_0 + 1) * w_row * w_col)
+
+
+def rasterGrid(raster):
+    """
+    Grid of a raster path.
+        return: x_min, y_max, cell_size, height, width
+    """
+    key = rasterKey(raster)
+    item = published.get(key)
+    if item is not None:
+        return item[2], item[3], item[4], item[1].shape[0], item[1].shape[1]
+
+    source = openRaster(key, raster)
+    return source.extent.XMin, source.extent.YMax, source.meanCellWidth, source.height, source.width
+
+
+def polygonCells(rings, grid):
+    """
+    Cells with centres inside a polygon, as PolygonToRaster with CELL_CENTER.
+    Every cell row is intersected with all ring edges and the cells between
+    pairs of crossings are inside by the even-odd rule, so holes are excluded.
+        rings: list of (n, 2) vertex arrays of all rings of the polygon
+        grid: x_min, y_max, cell_size, height, width from rasterGrid
+        return: sorted unique cell indices (row * width + col)
+    """
+    x_min, y_max, cell_size, height, width = grid
+    rings = [ring for ring in rings if len(ring) > 2]
+    if not rings:
+        return np.empty(0, dtype=np.int64)
+
+    start = np.concatenate([ring for ring in rings])
+    end = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    row_min, row_max = windowIndices((start[:, 0].min(), start[:, 1].min(), start[:, 0].max(), start[:, 1].max()),
+                                     x_min, y_max, cell_size, height, width)[0:2]
+
+    cells = []
+    step = max(ZONE_PAIRS // (10 * len(start)), 1)
+    for first in range(row_min, row_max, step):
+        rows = np.arange(first, min(first + step, row_max))
+        y = (y_max - (rows + 0.5) * cell_size)[:, None]
+
+        # Crossings of the cell row centres with the edges, sorted along every row
+        crossing = (start[:, 1] <= y) != (end[:, 1] <= y)
+        row_index, edge = np.nonzero(crossing)
+        y = y[row_index, 0]
+        x = start[edge, 0] + (y - start[edge, 1]) * (end[edge, 0] - start[edge, 0]) / (end[edge, 1] - start[edge, 1])
+        order = np.lexsort((x, row_index))
+        x = x[order]
+        row = rows[row_index[order]]
+
+        # Cell columns with centres between every pair of crossings
+        col_from = np.clip(np.ceil((x[0::2] - x_min) / cell_size - 0.5), 0, width).astype(np.int64)
+        col_to = np.clip(np.ceil((x[1::2] - x_min) / cell_size - 0.5), 0, width).astype(np.int64)
+        lengths = np.maximum(col_to - col_from, 0)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        cells.append(np.repeat(row[0::2] * width + col_from, lengths) + offsets)
+
+    return np.unique(np.concatenate(cells))
+
+
+def zonalStatistics(raster, zone_cells):
+    """
+    Count, sum and sum of squares of the raster cells of zones that may overlap.
+    The zones are kept as sparse pairs of cell and zone, so a cell is counted for
+    every zone it belongs to. Every cell of a batch of ZONE_PAIRS pairs is read once
+    and the pair values are reduced per zone with np.bincount. NoData cells are
+    ignored, as ZonalStatisticsAsTable with DATA.
+        raster: raster path
+        zone_cells: iterable of (zone ID, cell indices) with non-negative integer zone IDs,
+                    cell indices from polygonCells or as row * width + col
+        return: count, total and total_sq arrays indexed by zone ID
+    """
+    width = rasterGrid(raster)[4]
+    count = np.zeros(0)
+    total = np.zeros(0)
+    total_sq = np.zeros(0)
+
+    def addBatch(pair_zones, pair_cells):
+        zones = np.concatenate(pair_zones)
+        cells, inverse = np.unique(np.concatenate(pair_cells), return_inverse=True)
+        values = sampleCells(raster, cells // width, cells % width)[inverse]
+        valid = ~np.isnan(values)
+        size = max(len(count), int(zones.max()) + 1)
+        return (np.pad(count, (0, size - len(count))) + np.bincount(zones[valid], minlength=size),
+                np.pad(total, (0, size - len(total))) + np.bincount(zones[valid], values[valid], minlength=size),
+                np.pad(total_sq, (0, size - len(total_sq)))
+                + np.bincount(zones[valid], values[valid] ** 2, minlength=size))
+
+    pair_zones = []
+    pair_cells = []
+    pairs = 0
+    for zone, cells in zone_cells:
+        if len(cells) == 0:
+            continue
+
+        pair_zones.append(np.full(len(cells), zone, dtype=np.int64))
+        pair_cells.append(np.asarray(cells, dtype=np.int64))
+        pairs += len(cells)
+        if pairs >= ZONE_PAIRS:
+            count, total, total_sq = addBatch(pair_zones, pair_cells)
+            pair_zones = []
+            pair_cells = []
+            pairs = 0
+
+    if pairs > 0:
+        count, total, total_sq = addBatch(pair_zones, pair_cells)
+
+    return count, total, total_sq
@@ -0,0 +1,389 @@
+#
+#    Copyright (C) 2021  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_ResultCache.py
+# Script Author: Applied Geospatial Research Group
+# Date: 2026-Oct-18
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: On disk cache of per segment worker results. Each result is saved
+# as soon as the worker finishes the segment, under a key made of the segment
+# geometry and attributes, the tool parameters and the input raster files.
+# A resumed run only processes the segments without a cached result, so a run
+# stopped part way continues where it stopped and a rerun with unchanged
+# inputs only reads the cache.
+#
+# Incremental runs after line editing compare the input lines with a copy of
+# the previous input. Output rows carry the content key of their input line in
+# KEY_FIELD, so only added or modified lines are processed and their rows are
+# spliced into the previous output. Tools with a dissolved output rebuild it
+# from the result cache instead.
+#
+# Usage in a tool main:
+#   folder = outWorkspace + "\\cache"
+#   params = ["LFP", flmrc.rasterFingerprint(Cost_Raster), ...]
+#   tasks, cached = flmrc.pendingSegments(segment_all, folder, params, Resume)
+#   computed = pool.map(functools.partial(flmrc.runCached, workLinesMem, folder), tasks)
+#   results = flmrc.mergeResults(len(segment_all), tasks, cached, computed)
+#
+# ---------------------------------------------------------------------------
+# System imports
+import os
+import sys
+import glob
+import hashlib
+import pickle
+from collections import Counter
+
+ID_FIELDS = ("FID", "OBJECTID", "OID")  # feature IDs change when features are deleted, left out of keys
+KEY_FIELD = "FLM_KEY"  # content key of the input line of an output row, see keyLines
+
+
+def resumeRequested(args, index):
+    """
+    Resume mode from the tool arguments or the --resume command line switch.
+        index: position of the resume argument in args
+    """
+    if len(args) > index and args[index].rstrip() == "True":
+        return True
+
+    return "--resume" in sys.argv
+
+
+def rasterFingerprint(raster):
+    """
+    Fingerprint of a raster from its path, size and modification time of its files,
+    so results are not reused after the raster is rewritten.
+    """
+    path = os.path.abspath(raster)
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(glob.escape(path), "*")))  # ESRI grid
+    else:
+        files = sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + ".*"))  # raster and side car files
+
+    fingerprint = [os.path.normcase(path)]
+    for file in files:
+        if os.path.isfile(file):
+            stat = os.stat(file)
+            fingerprint.append((os.path.basename(file), stat.st_size, stat.st_mtime_ns))
+
+    return repr(fingerprint)
+
+
+def segmentKey(segment, params):
+    """
+    Content key of a segment item of all_segments.
+    Geometries are hashed by their WKB and attribute dictionaries by their values.
+    Line numbers and inputs shared by all segments are left out, the inputs are
+    expected in params.
+        params: tool name, parameters and raster fingerprints
+    """
+    import arcpy
+
+    digest = hashlib.sha1(repr(params).encode("utf-8"))
+    for value in segment:
+        if isinstance(value, arcpy.Geometry):
+            digest.update(bytes(value.WKB))
+        elif isinstance(value, dict):
+            attributes = [item for item in sorted(value.items()) if item[0] not in ID_FIELDS]
+            digest.update(repr(attributes).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def resultPath(folder, key):
+    return os.path.join(folder, key[:2], key + ".pkl")
+
+
+def loadResult(folder, key):
+    """
+    Cached result of a key.
+        return: (True, result) when found, (False, None) otherwise
+    """
+    try:
+        with open(resultPath(folder, key), "rb") as f:
+            return True, pickle.load(f)
+    except Exception:
+        return False, None
+
+
+def saveResult(folder, key, result):
+    """
+    Save a result, the file is written under a temporary name first so an
+    interrupted write never leaves a partial result behind.
+    """
+    path = resultPath(folder, key)
+    temp = path + ".{}.tmp".format(os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp, "wb") as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+    except Exception as e:
+        print("Saving cached result {} failed.".format(key))
+        print(e)
+
+
+def pendingSegments(segments, folder, params, resume):
+    """
+    Split segments into tasks to process and cached results.
+        resume: when False every segment is processed again
+        return: tasks, list of (segment index, key, segment) for runCached
+                cached, dictionary of segment index to cached result
+    """
+    import FLM_Common as flmc
+
+    tasks = []
+    cached = {}
+    for index, segment in enumerate(segments):
+        key = segmentKey(segment, params)
+        if resume:
+            found, result = loadResult(folder, key)
+            if found and result:
+                cached[index] = result
+                continue
+
+        tasks.append((index, key, segment))
+
+    if resume:
+        flmc.log("{} of {} segments have cached results.".format(len(cached), len(segments)))
+
+    return tasks, cached
+
+
+def runCached(func, folder, task):
+    """
+    Worker wrapper, process the segment of task with func and cache the result.
+    Failed results, None or an empty list, are not cached so a resumed run processes
+    the segment again. Bind func and folder with functools.partial to use it in pool.map.
+    """
+    _, key, segment = task
+    result = func(segment)
+    if result:
+        saveResult(folder, key, result)
+
+    return result
+
+
+def mergeResults(count, tasks, cached, computed):
+    """
+    Results of all segments in segment order.
+        computed: results of tasks in task order
+    """
+    import FLM_Common as flmc
+
+    results = [None] * count
+    for index, result in cached.items():
+        results[index] = result
+
+    failed = 0
+    for task, result in zip(tasks, computed):
+        results[task[0]] = result
+        if not result:
+            failed += 1
+
+    if failed > 0:
+        flmc.log("WARNING: {} of {} segments failed and are not cached.".format(failed, len(tasks)),
+                 level=flmc.WARNING)
+
+    return results
+
+
+def featureKeys(fc):
+    """
+    Content keys of the features of a feature class from geometry and attributes.
+    """
+    import arcpy
+
+    fields = [field.name for field in arcpy.ListFields(fc) if field.type not in ("OID", "Geometry")]
+    keys = []
+    with arcpy.da.SearchCursor(fc, ["SHAPE@WKB"] + fields) as cursor:
+        for row in cursor:
+            digest = hashlib.sha1(bytes(row[0]) if row[0] else b"")
+            digest.update(repr(row[1:]).encode("utf-8"))
+            keys.append(digest.hexdigest())
+
+    return keys
+
+
+def diffFeatures(previous_fc, fc):
+    """
+    Compare the features of fc with previous_fc by geometry and attributes.
+        return: number of added or modified features, number of removed features
+    """
+    previous = Counter(featureKeys(previous_fc))
+    current = Counter(featureKeys(fc))
+
+    return sum((current - previous).values()), sum((previous - current).values())
+
+
+def prepareIncremental(in_line, previous_line, out_file):
+    """
+    Prepare an incremental run after in_line is edited for tools with a dissolved
+    output, which has no rows to splice, see updateIncremental. The output is
+    removed so the tool rebuilds it, unchanged lines then come from the result cache.
+        previous_line: copy of the input lines of the previous run
+        return: True when the tool has to run, False when out_file is up to date
+    """
+    import arcpy
+    import FLM_Common as flmc
+
+    if arcpy.Exists(previous_line) and arcpy.Exists(out_file):
+        changed, removed = diffFeatures(previous_line, in_line)
+        flmc.log("{} lines added or modified, {} lines removed since the previous run.".format(changed, removed))
+        if changed == 0 and removed == 0:
+            return False
+
+    if arcpy.Exists(out_file):
+        arcpy.Delete_management(out_file)
+
+    return True
+
+
+def finishIncremental(in_line, previous_line):
+    """
+    Keep a copy of the processed input lines for the next incremental run.
+    """
+    import arcpy
+
+    arcpy.CopyFeatures_management(in_line, previous_line)
+
+
+def keyLines(in_line, out_lines, keys, selected):
+    """
+    Copy the lines of in_line with a content key in selected to out_lines and
+    store the key in KEY_FIELD. Tools copy the input fields to their outputs,
+    so output rows can be traced back to their input lines.
+        keys: content keys of the features of in_line from featureKeys
+        selected: set of the content keys to copy
+        return: number of lines copied
+    """
+    import arcpy
+
+    if arcpy.Exists(out_lines):
+        arcpy.Delete_management(out_lines)
+    arcpy.CopyFeatures_management(in_line, out_lines)
+    arcpy.AddField_management(out_lines, KEY_FIELD, "TEXT", field_length=40)
+
+    count = 0
+    with arcpy.da.UpdateCursor(out_lines, [KEY_FIELD]) as cursor:
+        for row, key in zip(cursor, keys):
+            if key not in selected:
+                cursor.deleteRow()
+                continue
+
+            cursor.updateRow([key])
+            count += 1
+
+    return count
+
+
+def spliceOutput(out_file, new_file, changed):
+    """
+    Delete the rows of out_file traced back to changed input lines
+    and insert the rows of new_file.
+        changed: set of content keys of the added, modified and removed input lines
+        new_file: output of the tool for the added and modified lines, None when there are none
+        return: number of rows deleted, number of rows inserted
+    """
+    import arcpy
+
+    deleted = 0
+    with arcpy.da.UpdateCursor(out_file, [KEY_FIELD]) as cursor:
+        for row in cursor:
+            if row[0] in changed:
+                cursor.deleteRow()
+                deleted += 1
+
+    inserted = 0
+    if new_file:
+        out_fields = {field.name for field in arcpy.ListFields(out_file)}
+        fields = [field.name for field in arcpy.ListFields(new_file)
+                  if field.type not in ("OID", "Geometry") and field.editable and field.name in out_fields]
+        with arcpy.da.SearchCursor(new_file, ["SHAPE@"] + fields) as source, \
+                arcpy.da.InsertCursor(out_file, ["SHAPE@"] + fields) as cursor:
+            for row in source:
+                cursor.insertRow(row)
+                inserted += 1
+
+    return deleted, inserted
+
+
+def updateIncremental(in_line, previous_line, out_file, run):
+    """
+    Update out_file after in_line is edited. The lines are compared with the
+    previous input by geometry and attributes, only added or modified lines are
+    processed. The rows of modified and removed lines are deleted from out_file
+    and the rows of the processed lines inserted. The first run, or a run on an
+    output without KEY_FIELD, processes all lines.
+        previous_line: copy of the input lines of the previous run, updated after the run
+        run: function(lines, output) running the tool on a line feature class
+        return: True when out_file is updated, False when it is up to date or
+                processing the edited lines failed
+    """
+    import arcpy
+    import FLM_Common as flmc
+
+    keys = featureKeys(in_line)
+    splice = (arcpy.Exists(previous_line) and arcpy.Exists(out_file) and
+              KEY_FIELD in [field.name for field in arcpy.ListFields(out_file)])
+    if splice:
+        current = Counter(keys)
+        previous = Counter(featureKeys(previous_line))
+        flmc.log("{} lines added or modified, {} lines removed since the previous run."
+                 .format(sum((current - previous).values()), sum((previous - current).values())))
+
+        # Every line of a key whose count differs is processed again
+        changed = {key for key in current.keys() | previous.keys() if current[key] != previous[key]}
+        if not changed:
+            return False
+    else:
+        changed = set(keys)
+        if arcpy.Exists(out_file):
+            arcpy.Delete_management(out_file)
+
+    base, ext = os.path.splitext(previous_line)
+    edited_line = base + "_edited" + ext
+    count = keyLines(in_line, edited_line, keys, changed)
+
+    if splice:
+        out_base, out_ext = os.path.splitext(out_file)
+        edited_out = out_base + "_edited" + out_ext
+        if arcpy.Exists(edited_out):
+            arcpy.Delete_management(edited_out)
+        if count > 0:
+            run(edited_line, edited_out)
+            if not arcpy.Exists(edited_out):
+                # previous_line is kept, so the next run processes the same lines again
+                flmc.log("ERROR: Processing the edited lines failed, {} is not updated.".format(out_file),
+                         level=flmc.ERROR)
+                arcpy.Delete_management(edited_line)
+                return False
+
+        deleted, inserted = spliceOutput(out_file, edited_out if count > 0 else None, changed)
+        flmc.log("{} rows deleted from and {} rows inserted into {}.".format(deleted, inserted, out_file))
+        if count > 0:
+            arcpy.Delete_management(edited_out)
+    else:
+        run(edited_line, out_file)
+
+    arcpy.Delete_management(edited_line)
+    finishIncremental(in_line, previous_line)
+
+    return True
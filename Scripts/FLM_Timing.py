@@ -0,0 +1,170 @@
+#
+#    Copyright (C) 2021  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# FLM_Timing.py
+# Script Author: Applied Geospatial Research Group
+# Date: 2026-Oct-18
+#
+# This script is part of the Forest Line Mapper (FLM) toolset
+# Webpage: https://github.com/appliedgrg/flm
+#
+# Purpose: Per line stage timings of worker functions. Workers record the
+# seconds of each sub step of a line with a StageTimer. The timings are kept
+# in memory and appended in batches to one file per worker process, and the
+# parent reports percentiles per stage after the pool is joined.
+#
+# Usage in a worker:
+#   timer = flmt.StageTimer(outWorkspace, lineNo)
+#   ... buffer ...
+#   timer.mark("buffer")
+#   ... clip ...
+#   timer.mark("clip")
+#   timer.done()
+#
+# Usage in a tool main:
+#   flmt.resetTimings(outWorkspace)
+#   ... pool.map, pool.close, pool.join ...
+#   flmt.reportTimings(outWorkspace, Timing_CSV)
+#
+# ---------------------------------------------------------------------------
+# System imports
+import os
+import csv
+import glob
+import time
+import multiprocessing.util
+
+import numpy as np
+
+FLUSH_ROWS = 500  # timing rows kept in memory before they are written
+PERCENTILES = [50, 90, 99]
+
+# Timing rows of this process not yet written: (line, stage, seconds)
+pending = []
+pending_file = {"path": None}
+
+
+def timingFolder(workspace):
+    return os.path.join(workspace, "timing")
+
+
+def flushTimings():
+    """
+    Append the pending timing rows of this process to its timing file.
+    """
+    if not pending or pending_file["path"] is None:
+        return
+
+    try:
+        with open(pending_file["path"], "a", newline="") as f:
+            csv.writer(f).writerows(pending)
+    except Exception as e:
+        print("Writing timings failed.")
+        print(e)
+    del pending[:]
+
+
+class StageTimer(object):
+    """
+    Monotonic timings of the stages of one line.
+        workspace: tool workspace, the timing files are in its timing folder
+        line: line number
+    """
+    def __init__(self, workspace, line):
+        self.workspace = workspace
+        self.line = line
+        self.stages = []
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        """
+        End a stage, its time is measured from the previous mark.
+        """
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def done(self):
+        """
+        Keep the timings of the line, they are written in batches and when the worker exits.
+        """
+        if pending_file["path"] is None:
+            pending_file["path"] = os.path.join(timingFolder(self.workspace), "timing_{}.csv".format(os.getpid()))
+            multiprocessing.util.Finalize(None, flushTimings, exitpriority=10)
+
+        pending.extend((self.line, stage, seconds) for stage, seconds in self.stages)
+        if len(pending) >= FLUSH_ROWS:
+            flushTimings()
+
+
+def resetTimings(workspace):
+    """
+    Remove the timings of an earlier run, call before the pool is created.
+    """
+    folder = timingFolder(workspace)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    for path in glob.glob(os.path.join(folder, "timing_*.csv")):
+        os.remove(path)
+
+
+def reportTimings(workspace, csv_path=None):
+    """
+    Log total seconds and percentiles of every stage over all lines, call after the pool is joined.
+        csv_path: optional CSV file with the seconds of every stage per line
+        return: dictionary of stage to statistics
+    """
+    import FLM_Common as flmc
+
+    flushTimings()
+    stages = []  # stage names in order of first appearance
+    lines = {}
+    for path in glob.glob(os.path.join(timingFolder(workspace), "timing_*.csv")):
+        with open(path, newline="") as f:
+            for line, stage, seconds in csv.reader(f):
+                if stage not in stages:
+                    stages.append(stage)
+                times = lines.setdefault(line, {})
+                times[stage] = times.get(stage, 0.0) + float(seconds)
+
+    if not lines:
+        return {}
+
+    statistics = {}
+    flmc.log("Stage timings of {} lines (seconds):".format(len(lines)))
+    flmc.log("{:<20}{:>10}".format("stage", "total") + "".join("{:>10}".format("p" + str(p)) for p in PERCENTILES)
+             + "{:>10}".format("max"))
+    for stage in stages:
+        values = np.array([times[stage] for times in lines.values() if stage in times])
+        statistics[stage] = {"lines": len(values), "total": float(values.sum()), "max": float(values.max())}
+        for p in PERCENTILES:
+            statistics[stage]["p" + str(p)] = float(np.percentile(values, p))
+
+        flmc.log("{:<20}{:>10.2f}".format(stage, values.sum())
+                 + "".join("{:>10.3f}".format(statistics[stage]["p" + str(p)]) for p in PERCENTILES)
+                 + "{:>10.3f}".format(values.max()))
+
+    if csv_path:
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["line"] + stages)
+            for line in sorted(lines, key=lambda item: int(item) if item.isdigit() else item):
+                writer.writerow([line] + [lines[line].get(stage, "") for stage in stages])
+        flmc.log("Per line stage timings written to {}".format(csv_path))
+
+    return statistics
@@ -13,18 +13,38 @@ import FLM_VertexOptimization
 import FLM_CenterLine
 import FLM_LineFootprint
 import FLM_ForestLineAttributes
+import FLM_RasterLineAttributes
 import FLM_DynamicLineFootprintFullStep
+import FLM_ResultCache
+import FLM_RasterStore
+import FLM_Common
+
+
+def setLogLevel(level):
+    """
+    Set the lowest level of logged messages
+    level: "LINE" logs every processed line (default), "INFO" silences per line
+           messages on large jobs, "WARNING" and "ERROR" log problems only
+    """
+    FLM_Common.SetLogLevel(level)
+
 
 def canopyCost(in_raster,
                out_canopy_raster, out_cost_raster,
                height_thresh=1, search_radius=3,
                max_line_dist=10, canopy_avoidance=0.3,
-               cost_exponent=1.5):
+               cost_exponent=1.5, raster_engine="arcpy", tile_size=0):
     """
     Generate cost raster
+
+    raster_engine: "arcpy" uses FocalStatistics and EucAllocation,
+                   "numpy" computes focal mean and std in one pass and
+                   the exact distance from canopy with NumPy
+    tile_size: tile size in cells, tiles are processed in parallel with
+               the numpy engine. 0 processes the whole raster at once
     """
     print("Processing canopy cost: ", out_canopy_raster)
-    argv = [None] * 8
+    argv = [None] * 10
     argv[0] = in_raster  # CHM raster
     argv[1] = str(height_thresh)  # Canopy Height Threshold
     argv[2] = str(search_radius)  # Tree Search Radius
@@ -33,6 +53,8 @@ def canopyCost(in_raster,
     argv[5] = str(cost_exponent)  # Cost Raster Exponent
     argv[6] = out_canopy_raster  # Output Canopy Raster
     argv[7] = out_cost_raster  # Output Cost Raster
+    argv[8] = raster_engine  # Focal statistics and distance engine
+    argv[9] = str(tile_size)  # Tile size in cells
     print(argv[6])
 
     if not os.path.exists(out_canopy_raster) and not os.path.exists(out_cost_raster):
@@ -40,9 +62,15 @@ def canopyCost(in_raster,
 
 
 def preTagging(in_center_line, in_chm, in_canopy_raster, in_cost_raster, in_lidar_year,
-               out_tagged_line, corridor_thresh="CorridorTh", max_line_width=32):
+               out_tagged_line, corridor_thresh="CorridorTh", max_line_width=32, corridor_engine="arcpy",
+               cache_budget=FLM_RasterStore.CACHE_BUDGET):
     """
     Generate line footprint
+
+    corridor_engine: "arcpy" uses CostDistance and Corridor tools,
+                     "native" computes the corridor in process from the cost raster in shared memory
+    cache_budget: bytes of raster tiles cached by every worker, 0 disables the cache,
+                  only used by the native engines
     """
 
     print("Tagging lines: ", out_tagged_line)
@@ -54,6 +82,8 @@ def preTagging(in_center_line, in_chm, in_canopy_raster, in_cost_raster, in_lida
     argv[4] = in_lidar_year  # Input LiDAR coverage with acquisition year
     argv[5] = str(max_line_width)  # maximum line width
     argv[6] = out_tagged_line  # Output line foot print
+    argv[7] = corridor_engine  # corridor engine
+    argv[8] = str(cache_budget)  # tile cache bytes per worker
 
     if not os.path.exists(in_center_line):
         print("Input line file {} not exists, ignore.".format(in_center_line))
@@ -66,17 +96,21 @@ def preTagging(in_center_line, in_chm, in_canopy_raster, in_cost_raster, in_lida
     FLM_Pretagging.main(argv)
 
 
-def vertexOptimization(in_line, in_cost_raster, out_center_line, line_process_radius=35):
+def vertexOptimization(in_line, in_cost_raster, out_center_line, line_process_radius=35, search_engine="arcpy"):
     """
     Optimize vertices
+
+    search_engine: arcpy (CostDistance and CostPathAsPolyline), dijkstra or astar
+                   (native searches on the cost raster in shared memory)
     """
 
     print("Processing center line: ", out_center_line)
-    argv = [None] * 4
+    argv = [None] * 5
     argv[0] = in_line  # input line
     argv[1] = in_cost_raster  # Cost raster
     argv[2] = str(line_process_radius)  # line process radius
     argv[3] = out_center_line  # Output center line
+    argv[4] = search_engine  # least cost path search engine
 
     if not os.path.exists(in_line):
         print("Input line file {} not exists, ignore.".format(in_line))
@@ -90,18 +124,29 @@ def vertexOptimization(in_line, in_cost_raster, out_center_line, line_process_ra
 
 
 def centerline(in_line, in_cost_raster, out_center_line,
-               line_radius=35, process_segments=True):
+               line_radius=35, process_segments=True, search_engine="arcpy", resume=False,
+               timing_csv="", cache_budget=FLM_RasterStore.CACHE_BUDGET):
     """
     Generate centerline
+    search_engine: arcpy (CostDistance and CostPathAsPolyline), dijkstra (native NumPy search)
+                   or astar (native bidirectional A* search with early termination)
+    resume: reuse the cached results of segments processed by an earlier run
+    timing_csv: optional CSV file of the seconds of every processing stage per line
+    cache_budget: bytes of raster tiles cached by every worker, 0 disables the cache,
+                  only used by the native engines
     """
 
     print("Processing center line: ", out_center_line)
-    argv = [None] * 5
+    argv = [None] * 9
     argv[0] = in_line  # input line
     argv[1] = in_cost_raster  # Cost raster
     argv[2] = str(line_radius)  # line process radius
     argv[3] = str(process_segments)  # Process segments TODO: bool or sting?
     argv[4] = out_center_line  # Output center line
+    argv[5] = search_engine  # least cost path search engine
+    argv[6] = str(resume)  # resume from cached results
+    argv[7] = timing_csv  # per line stage timings
+    argv[8] = str(cache_budget)  # tile cache bytes per worker
 
     if not os.path.exists(in_line):
         print("Input line file {} not exists, ignore.".format(in_line))
@@ -114,18 +159,42 @@ def centerline(in_line, in_cost_raster, out_center_line,
     FLM_CenterLine.main(argv)
 
 
+def centerlineIncremental(in_line, previous_line, in_cost_raster, out_center_line,
+                          line_radius=35, process_segments=True, search_engine="arcpy"):
+    """
+    Update centerlines after input lines are edited
+    previous_line: copy of the input lines of the previous run, updated after the run.
+    Only added or modified lines are processed, their centerlines replace the
+    centerlines of modified and removed lines in out_center_line.
+    """
+
+    def run(lines, out_lines):
+        centerline(lines, in_cost_raster, out_lines, line_radius, process_segments, search_engine, True)
+
+    if not FLM_ResultCache.updateIncremental(in_line, previous_line, out_center_line, run):
+        print("Centerline file {} is not updated.".format(out_center_line))
+
+
 def lineFootprint(in_center_line, in_canopy_raster, in_cost_raster,
                    out_footprint,
                    corridor_thresh="CorridorTh", max_line_width=10,
                    expand_shrink_range=0, process_segments=False,
-                   corridor_threshold=3):
+                   corridor_threshold=3, corridor_engine="arcpy", chunk_size=8,
+                   resume=False, timing_csv="", cache_budget=FLM_RasterStore.CACHE_BUDGET):
     """
     Generate line footprint
 
+    corridor_engine: "arcpy" uses CostDistance and Corridor tools,
+                     "native" computes the corridor in process with NumPy
+    chunk_size: number of lines handed to a worker at a time
+    resume: reuse the cached results of segments processed by an earlier run
+    timing_csv: optional CSV file of the seconds of every processing stage per line
+    cache_budget: bytes of raster tiles cached by every worker, 0 disables the cache,
+                  only used by the native engines
     """
 
     print("Processing line footprint: ", out_footprint)
-    argv = [None] * 9
+    argv = [None] * 14
     argv[0] = in_center_line  # center line
     argv[1] = in_canopy_raster  # canopy raster
     argv[2] = in_cost_raster  # Cost raster
@@ -135,6 +204,11 @@ def lineFootprint(in_center_line, in_canopy_raster, in_cost_raster,
     argv[6] = str(expand_shrink_range)  # expand and shrink cell range
     argv[7] = str(process_segments)  # process segments
     argv[8] = out_footprint  # Output line foot print
+    argv[9] = corridor_engine  # corridor engine
+    argv[10] = str(chunk_size)  # lines per worker task
+    argv[11] = str(resume)  # resume from cached results
+    argv[12] = timing_csv  # per line stage timings
+    argv[13] = str(cache_budget)  # tile cache bytes per worker
 
     if not os.path.exists(in_center_line):
         print("Input line file {} not exists, ignore.".format(in_center_line))
@@ -147,18 +221,42 @@ def lineFootprint(in_center_line, in_canopy_raster, in_cost_raster,
     FLM_LineFootprint.main(argv)
 
 
+def lineFootprintIncremental(in_center_line, previous_center_line, in_canopy_raster, in_cost_raster,
+                             out_footprint,
+                             corridor_thresh="CorridorTh", max_line_width=10,
+                             expand_shrink_range=0, process_segments=False,
+                             corridor_threshold=3, corridor_engine="arcpy"):
+    """
+    Update line footprint after center lines are edited
+    previous_center_line: copy of the center lines of the previous run, updated after the run.
+    Only added or modified lines are processed, footprints of the other lines
+    come from the result cache of the previous run.
+    """
+
+    if not FLM_ResultCache.prepareIncremental(in_center_line, previous_center_line, out_footprint):
+        print("Footprint file {} is up to date.".format(out_footprint))
+        return
+
+    lineFootprint(in_center_line, in_canopy_raster, in_cost_raster, out_footprint,
+                  corridor_thresh, max_line_width, expand_shrink_range, process_segments,
+                  corridor_threshold, corridor_engine, resume=True)
+    FLM_ResultCache.finishIncremental(in_center_line, previous_center_line)
+
+
 def dynamicLineFootprint(in_center_line, in_chm_raster, out_footprint, max_line_width=32,
                    expand_shrink_range=0, process_segments=False, offset_line_distance=10,
                    canopy_percentile=90, canopy_thresh_percentage=50, tree_search_radius=1.5,
-                   max_line_distance=1.5, canopy_avoidance=0.0, cost_raster_exponent=1):
+                   max_line_distance=1.5, canopy_avoidance=0.0, cost_raster_exponent=1,
+                   raster_engine="arcpy"):
     """
     Generate line footprint
 
+    raster_engine: "arcpy" or "numpy", engine of the per line canopy cost raster
     """
     import FLM_DynamicLineFootprintFullStep
 
     print("Processing line footprint: ", out_footprint)
-    argv = [None] * 13
+    argv = [None] * 14
     argv[0] = in_center_line
     argv[1] = in_chm_raster
     argv[2] = str(max_line_width)
@@ -172,6 +270,7 @@ def dynamicLineFootprint(in_center_line, in_chm_raster, out_footprint, max_line_
     argv[10] = str(max_line_distance)
     argv[11] = str(canopy_avoidance)
     argv[12] = str(cost_raster_exponent)
+    argv[13] = raster_engine
 
     if not os.path.exists(in_center_line):
         print("Input line file {} not exists, ignore.".format(in_center_line))
@@ -189,14 +288,19 @@ def dynamicLineFootprint(in_center_line, in_chm_raster, out_footprint, max_line_
 
 
 def lineAttribute(sampling_type, in_line, in_footprint, in_chm, out_line_attribute,
-                  segment_length=30, line_split_tolerance=3, max_line_width=25):
+                  segment_length=30, line_split_tolerance=3, max_line_width=25, zonal_engine="arcpy",
+                  split_engine="arcpy"):
     """
     Generate line attribute
     sampling_type: IN-FEATURES, WHOLE-LINE, LINE-CROSSINGS, ARBITRARY
+    zonal_engine: "arcpy" runs ZonalStatisticsAsTable for every segment,
+                  "native" computes CHM statistics of all segments in one pass with NumPy
+    split_engine: "arcpy" splits lines with geoprocessing tools through shapefiles,
+                  "native" splits lines in memory along their vertex arrays
     """
 
     print("Processing forest line attributes {0} under mode {1}".format(out_line_attribute, sampling_type))
-    argv = [None] * 8
+    argv = [None] * 10
     argv[0] = in_line  # input line (output)
     argv[1] = in_footprint  # line footprint
     argv[2] = in_chm  # input CHM
@@ -205,6 +309,8 @@ def lineAttribute(sampling_type, in_line, in_footprint, in_chm, out_line_attribu
     argv[5] = str(line_split_tolerance)  # line split tolerance
     argv[6] = str(max_line_width)  # maximum line width
     argv[7] = out_line_attribute   # Output line attributes
+    argv[8] = zonal_engine  # CHM zonal statistics engine
+    argv[9] = split_engine  # line split engine
 
     if not os.path.exists(in_line):
         print("Input line file {} not exists, ignore.".format(in_line))
@@ -216,19 +322,55 @@ def lineAttribute(sampling_type, in_line, in_footprint, in_chm, out_line_attribu
 
     FLM_ForestLineAttributes.main(argv)
 
-def rasterAttribute(self):
-    return
+def rasterAttribute(sampling_type, in_line, in_raster, out_line_attribute, sampling_interval=1,
+                    segment_length=30, line_split_tolerance=3, sampling_method="Mean", sampling_engine="arcpy",
+                    split_engine="arcpy"):
+    """
+    Generate raster line attribute
+    sampling_type: IN-FEATURES, WHOLE-LINE, LINE-CROSSINGS, ARBITRARY
+    sampling_method: Minimum, Maximum, Mean, Standard Deviation, Median, Mode, Range
+    sampling_engine: "arcpy" samples through point shapefiles and a spatial join,
+                     "native" samples the raster cells of every segment directly with NumPy
+    split_engine: "arcpy" splits lines with geoprocessing tools through shapefiles,
+                  "native" splits lines in memory along their vertex arrays
+    """
+
+    print("Processing raster line attributes {0} under mode {1}".format(out_line_attribute, sampling_type))
+    argv = [None] * 10
+    argv[0] = in_line  # input line
+    argv[1] = in_raster  # input raster
+    argv[2] = sampling_type  # sampling type
+    argv[3] = str(sampling_interval)  # sampling interval
+    argv[4] = str(segment_length)  # Segment length
+    argv[5] = str(line_split_tolerance)  # line split tolerance
+    argv[6] = sampling_method  # sampling method
+    argv[7] = out_line_attribute  # Output attributed segments
+    argv[8] = sampling_engine  # raster sampling engine
+    argv[9] = split_engine  # line split engine
+
+    if not os.path.exists(in_line):
+        print("Input line file {} not exists, ignore.".format(in_line))
+        return
+
+    if os.path.exists(out_line_attribute):
+        print("Attribute file {} already exists, ignore.".format(out_line_attribute))
+        return
+
+    FLM_RasterLineAttributes.main(argv)
 
 def FLM_DynamicCanopyThreshold(cl_fc,chm,process_segments,Search_R, Canopy_Percentile,CanopyTh_Percent,
-                             TreeSearchRadius,MaximumLineDistance,  CanopyAvoidance,CostRasterExponent):
+                             TreeSearchRadius,MaximumLineDistance,  CanopyAvoidance,CostRasterExponent,
+                             sampling_engine="arcpy"):
     """
        Generate line attribute
        sampling_type: IN-FEATURES, WHOLE-LINE, LINE-CROSSINGS, ARBITRARY
+       sampling_engine: "arcpy" generates parallel line points and queries them per line,
+                        "native" samples the CHM along the parallel lines of all lines with NumPy
        """
 
     print("Processing dynamic footprint")
     try:
-        argv = [None] * 10
+        argv = [None] * 11
         argv[0] = cl_fc  # input line (output)
         argv[1] = chm  # CHM raster
         argv[2] = str(process_segments)  # process segments
@@ -239,6 +381,7 @@ def FLM_DynamicCanopyThreshold(cl_fc,chm,process_segments,Search_R, Canopy_Perce
         argv[7] = str(MaximumLineDistance)  # Maximum Line Distance
         argv[8] = str(CanopyAvoidance)  # Canopy Avoidance
         argv[9] = str(CostRasterExponent)  # Cost Raster Exponent
+        argv[10] = sampling_engine  # Parallel line sampling engine
 
     except Exception as e:
         print("Error: Please Check the input.")
@@ -41,6 +41,8 @@ from arcpy.sa import *
 # Local imports
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
+import FLM_CenterLine
+import FLM_RasterStore as flmrs
 
 workspaceName = "FLM_VO_output"
 DISTANCE_THRESHOLD = 2  # 1 meter for intersection neighbourhood
@@ -118,15 +120,11 @@ def closestPointToLine(point, line):
     return pt.x, pt.y
 
 
-def appendToGroup(vertex, vertex_grp, UID):
+def addAnchor(vertex, UID):
     """
-    Append new vertex to vertex group, by calculating distance to existing vertices
-    An anchor point will be added together with line
+    Add the anchor point to the line of a new end vertex.
+    The anchor is SEGMENT_LENGTH from the vertex along the first or last segment.
     """
-    pt_added = False
-    global DISTANCE_THRESHOLD
-    global SEGMENT_LENGTH
-
     vertex["lines"][0][2]["UID"] = UID
 
     # Calculate anchor point for each vertex
@@ -148,15 +146,52 @@ def appendToGroup(vertex, vertex_grp, UID):
     Y = pt_1.Y + (pt_2.Y - pt_1.Y) * SEGMENT_LENGTH / dist_pt
     vertex["lines"][0].insert(-1, [X, Y])  # add anchor point to list (the third element)
 
-    for item in vertex_grp:
-        if abs(point.X - item["point"][0]) < DISTANCE_THRESHOLD and abs(
-                point.Y - item["point"][1]) < DISTANCE_THRESHOLD:
-            item["lines"].append(vertex["lines"][0])
-            pt_added = True
 
-    # Add the first vertex or new vertex not found neighbour
-    if not pt_added:
-        vertex_grp.append(vertex)
+def clusterVertices(vertices):
+    """
+    Group end vertices closer than DISTANCE_THRESHOLD in X and Y.
+    Vertices are hashed into grid cells of DISTANCE_THRESHOLD, so only the
+    neighbouring cells are searched, and union-find merges groups linked by
+    near vertices. Run time is near linear in the number of vertices.
+        vertices: list of {"point": [x, y], "lines": [line]}
+        return: groups in order of their first vertex, the group point is that vertex
+    """
+    parent = list(range(len(vertices)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]  # path halving
+            i = parent[i]
+        return i
+
+    grid = {}  # (cell x, cell y) -> vertex indices
+    for i, vertex in enumerate(vertices):
+        x, y = vertex["point"]
+        cell_x = int(math.floor(x / DISTANCE_THRESHOLD))
+        cell_y = int(math.floor(y / DISTANCE_THRESHOLD))
+        for grid_x in (cell_x - 1, cell_x, cell_x + 1):
+            for grid_y in (cell_y - 1, cell_y, cell_y + 1):
+                for j in grid.get((grid_x, grid_y), []):
+                    if abs(x - vertices[j]["point"][0]) < DISTANCE_THRESHOLD and abs(
+                            y - vertices[j]["point"][1]) < DISTANCE_THRESHOLD:
+                        root_i = find(i)
+                        root_j = find(j)
+                        if root_i != root_j:
+                            # The first vertex stays the root of its group
+                            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        grid.setdefault((cell_x, cell_y), []).append(i)
+
+    groups = {}  # root vertex index -> group
+    vertex_grp = []
+    for i, vertex in enumerate(vertices):
+        root = find(i)
+        if root not in groups:
+            groups[root] = {"point": vertices[root]["point"], "lines": []}
+            vertex_grp.append(groups[root])
+        groups[root]["lines"].append(vertex["lines"][0])
+
+    return vertex_grp
 
 
 def ptsInLine(line):
@@ -180,7 +215,7 @@ def groupIntersections(lines):
     Intersection list format: {["point":intersection_pt, "lines":[[line_geom, pt_index, anchor_geom], ...]], ...}
     pt_index: 0 is start vertex, -1 is end vertex
     """
-    vertex_grp = []
+    vertices = []
     try:
         for line in lines:
             point_list = ptsInLine(line[0])
@@ -192,12 +227,14 @@ def groupIntersections(lines):
             # Add line to groups based on proximity of two end points to group
             pt_start = {"point": [point_list[0].X, point_list[0].Y], "lines": [[line[0], 0, {"lineNo": line[1]}]]}
             pt_end = {"point": [point_list[-1].X, point_list[-1].Y], "lines": [[line[0], -1, {"lineNo": line[1]}]]}
-            appendToGroup(pt_start, vertex_grp, line[2]['FID'])
-            appendToGroup(pt_end, vertex_grp, line[2]['FID'])
+            addAnchor(pt_start, line[2]['FID'])
+            addAnchor(pt_end, line[2]['FID'])
+            vertices.append(pt_start)
+            vertices.append(pt_end)
     except Exception as e:
         traceback.print_exc()
 
-    return vertex_grp
+    return clusterVertices(vertices)
 
 
 def getAngle(line, end_index):
@@ -310,18 +347,30 @@ def generateAnchorPairs(vertex):
         return pt_start_1, pt_end_1
 
 
-def leastCostPath(Cost_Raster, anchors, Line_Processing_Radius):
+def leastCostPath(Cost_Raster, anchors, Line_Processing_Radius, Search_Engine="arcpy"):
     """
     Calculate least cost path between two points
         Cost_Raster: cost raster
         anchors: list of two points: start and end points
         Line_Processing_Radius
+        Search_Engine: one of FLM_CenterLine.SEARCH_ENGINES
     """
     if not anchors[0] or not anchors[1]:
         print("Anchor points not valid")
         centerline = [None]
         return centerline
 
+    if Search_Engine != "arcpy":
+        line = arcpy.Polyline(arcpy.Array([arcpy.Point(*anchors[0]), arcpy.Point(*anchors[1])]),
+                              arcpy.SpatialReference(3400))
+        try:
+            centerline = FLM_CenterLine.centerlineNative(line, Cost_Raster, Line_Processing_Radius, Search_Engine)
+        except Exception as e:
+            print(e)
+            centerline = []
+
+        return centerline if centerline else [None]
+
     lineNo = uuid.uuid4().hex  # random line No.
     # lineNo = os.getpid()
 
@@ -395,6 +444,7 @@ def workLinesMem(vertex):
     Forest_Line_Feature_Class = f.readline().strip()
     Cost_Raster = f.readline().strip()
     Line_Processing_Radius = float(f.readline().strip())
+    Search_Engine = f.readline().strip() or "arcpy"
     f.close()
 
     anchors = []
@@ -413,13 +463,13 @@ def workLinesMem(vertex):
 
     try:
         if len(anchors) == 4:
-            centerline_1 = leastCostPath(Cost_Raster, anchors[0:2], Line_Processing_Radius)
-            centerline_2 = leastCostPath(Cost_Raster, anchors[2:4], Line_Processing_Radius)
+            centerline_1 = leastCostPath(Cost_Raster, anchors[0:2], Line_Processing_Radius, Search_Engine)
+            centerline_2 = leastCostPath(Cost_Raster, anchors[2:4], Line_Processing_Radius, Search_Engine)
 
             if centerline_1 and centerline_2:
                 intersection = intersectionOfLines(centerline_1, centerline_2)
         elif len(anchors) == 2:
-            centerline_1 = leastCostPath(Cost_Raster, anchors, Line_Processing_Radius)
+            centerline_1 = leastCostPath(Cost_Raster, anchors, Line_Processing_Radius, Search_Engine)
 
             if centerline_1:
                 intersection = closestPointToLine(vertex["point"], centerline_1)
@@ -465,12 +515,17 @@ def main(argv=None):
     global Line_Processing_Radius
     Line_Processing_Radius = args[2].rstrip()
     Out_Centerline = args[3].rstrip()
+    Search_Engine = args[4].rstrip() if len(args) > 4 else "arcpy"
+    if Search_Engine not in FLM_CenterLine.SEARCH_ENGINES:
+        flmc.log("Search engine {} is not supported, arcpy is used.".format(Search_Engine))
+        Search_Engine = "arcpy"
 
     # write params to text file
     f = open(outWorkspace + "\\params.txt", "w")
     f.write(Forest_Line_Feature_Class + "\n")
     f.write(Cost_Raster + "\n")
     f.write(Line_Processing_Radius + "\n")
+    f.write(Search_Engine + "\n")
     f.close()
 
     # Prepare input lines for multiprocessing
@@ -486,12 +541,18 @@ def main(argv=None):
     except IndexError:
         print(e)
 
-    pool = multiprocessing.Pool(processes=flmc.GetCores())
+    # Native engines read windows from the cost raster in shared memory
+    descriptors = flmrs.publishRasters([Cost_Raster]) if Search_Engine != "arcpy" else []
+
+    pool = multiprocessing.Pool(processes=flmc.GetCores(), initializer=flmc.InitWorker,
+                                initargs=(flmc.StartLogListener(), flmc.LOG_LEVEL, descriptors))
     flmc.log("Multiprocessing center lines...")
     flmc.log("Using {} CPU cores".format(flmc.GetCores()))
-    centerlines = pool.map(workLinesMem, vertex_grp)
+    centerlines = flmc.MapInSpatialOrder(pool, workLinesMem, vertex_grp, lambda grp: grp["point"])
     pool.close()
     pool.join()
+    flmrs.releaseRasters()
+    flmc.StopLogListener()
     flmc.logStep("Center line multiprocessing done.")
 
     # No line generated, exit
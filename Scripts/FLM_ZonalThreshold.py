@@ -27,11 +27,18 @@
 #
 # ---------------------------------------------------------------------------
 
+import os
+import math
 import multiprocessing
+import numpy
 import arcpy
 from arcpy.sa import *
 arcpy.CheckOutExtension("Spatial")
 import FLM_Common as flmc
+import FLM_RasterStore as flmrs
+
+ZONAL_ENGINES = ["arcpy", "native"]
+CHUNK_CELLS = 4000000  # candidate cells tested at a time for a line
 
 # Setup script path and workspace folder
 workspaceName = "FLM_ZT_output"
@@ -51,6 +58,7 @@ Canopy_Search_Radius = float(args[3].rstrip())
 MinValue = float(args[4].rstrip())
 MaxValue = float(args[5].rstrip())
 OutputLines = args[6].rstrip()
+Zonal_Engine = args[7].rstrip() if len(args) > 7 and args[7] else "arcpy"
 
 
 def workLines(lineNo):
@@ -94,12 +102,129 @@ def workLines(lineNo):
 	arcpy.Delete_management(fileBuffer)
 	arcpy.Delete_management(fileZonal)
 
+def bufferCells(vertices, radius, x_min, y_max, cell_size, height, width):
+	"""
+	Raster cells with centres within radius of a line, the cells of its round buffer.
+	The line is cut into pieces no longer than the buffer width, and the cells in the
+	expanded bounding box of every piece are tested against the distance to the piece.
+		vertices: (n, 2) array of the vertices of a line part
+		return: sorted unique cell indices (row * width + col)
+	"""
+	start = vertices[:-1]
+	end = vertices[1:]
+	lengths = numpy.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+	piece = max(2.0 * radius, cell_size)
+	counts = numpy.maximum(numpy.ceil(lengths / piece).astype(numpy.int64), 1)
+
+	# Pieces of the segments
+	segment = numpy.repeat(numpy.arange(len(start)), counts)
+	k = numpy.arange(len(segment)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+	t0 = (k / counts[segment])[:, None]
+	t1 = ((k + 1) / counts[segment])[:, None]
+	a = start[segment] + (end[segment] - start[segment]) * t0
+	b = start[segment] + (end[segment] - start[segment]) * t1
+
+	size = int(math.ceil((piece + 2.0 * radius) / cell_size)) + 2
+	offsets = numpy.arange(size)
+	row_0 = numpy.floor((y_max - numpy.maximum(a[:, 1], b[:, 1]) - radius) / cell_size).astype(numpy.int64)
+	col_0 = numpy.floor((numpy.minimum(a[:, 0], b[:, 0]) - radius - x_min) / cell_size).astype(numpy.int64)
+
+	cells = []
+	step = max(CHUNK_CELLS // (size * size), 1)
+	for i in range(0, len(a), step):
+		rows = row_0[i:i + step, None, None] + offsets[None, :, None]
+		cols = col_0[i:i + step, None, None] + offsets[None, None, :]
+		x = x_min + (cols + 0.5) * cell_size
+		y = y_max - (rows + 0.5) * cell_size
+
+		# Distance of the cell centres to the pieces
+		ax = a[i:i + step, 0, None, None]
+		ay = a[i:i + step, 1, None, None]
+		dx = b[i:i + step, 0, None, None] - ax
+		dy = b[i:i + step, 1, None, None] - ay
+		dd = dx * dx + dy * dy
+		t = numpy.clip(((x - ax) * dx + (y - ay) * dy) / numpy.where(dd > 0, dd, 1.0), 0.0, 1.0)
+		inside = (numpy.hypot(x - ax - t * dx, y - ay - t * dy) <= radius) & \
+				 (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+		cells.append((rows * width + cols)[inside])
+
+	return numpy.unique(numpy.concatenate(cells))
+
+def lineZonalMeans(lines, raster, radius):
+	"""
+	Mean of the raster cells in the round buffer of every line, with all buffers in one pass.
+	Buffers of neighbouring lines overlap, so a cell can belong to several zones. The zones are
+	kept as sparse pairs of cell and zone and reduced by flmrs.zonalStatistics.
+	NoData cells are ignored, as ZonalStatisticsAsTable with DATA.
+		lines: list of polylines
+		return: array of means, NaN for lines without data cells
+	"""
+	grid = flmrs.rasterGrid(raster)
+
+	def zoneCells():
+		for zone, line in enumerate(lines):
+			cells = []
+			for part in line:
+				vertices = numpy.array([[pnt.X, pnt.Y] for pnt in part if pnt], dtype=numpy.float64)
+				if len(vertices) == 0:
+					continue
+				if len(vertices) == 1:
+					vertices = numpy.vstack((vertices, vertices))
+				cells.append(bufferCells(vertices, radius, *grid))
+
+			# Parts of a line may share cells, count them once for the zone
+			if cells:
+				yield zone, numpy.unique(numpy.concatenate(cells))
+
+	count, total = flmrs.zonalStatistics(raster, zoneCells())[0:2]
+	count = numpy.pad(count, (0, len(lines) - len(count)))
+	total = numpy.pad(total, (0, len(lines) - len(total)))
+
+	means = numpy.full(len(lines), numpy.nan)
+	means[count > 0] = total[count > 0] / count[count > 0]
+	return means
+
+def nativeThresholds():
+	"""
+	Assign thresholds to all lines from their canopy zonal means in one pass.
+	OutputLines is a copy of Input_Feature_Class with all its fields, the thresholds
+	are written with one update cursor keyed on OID.
+	"""
+	arcpy.CopyFeatures_management(Input_Feature_Class, OutputLines)
+	if not flmc.HasField(OutputLines, ThresholdField):
+		arcpy.AddField_management(OutputLines, ThresholdField, "DOUBLE")
+
+	with arcpy.da.SearchCursor(OutputLines, ["OID@", "SHAPE@"]) as cursor:
+		rows = [row for row in cursor if row[1] is not None]
+	means = lineZonalMeans([row[1] for row in rows], Canopy_Raster, Canopy_Search_Radius)
+
+	# Lines without canopy cells keep their original values
+	thresholds = {row[0]: [MinValue + (mean * mean) * (MaxValue - MinValue)]
+				  for row, mean in zip(rows, means) if not numpy.isnan(mean)}
+	flmc.UpdateRowsByOID(OutputLines, ["OID@", ThresholdField], thresholds)
+
+	missing = len(rows) - len(thresholds)
+	if missing > 0:
+		arcpy.AddWarning("Warning! " + str(missing) + " lines have no canopy cells in their search radius.")
+		arcpy.AddMessage("The original values will be retained for those records.")
+
 def main():	
-	global outWorkspace
+	global outWorkspace, Zonal_Engine
 	outWorkspace = flmc.SetupWorkspace(workspaceName)
 
+	if Zonal_Engine not in ZONAL_ENGINES:
+		flmc.log("Zonal engine {} is not supported, arcpy is used.".format(Zonal_Engine))
+		Zonal_Engine = "arcpy"
+
+	if Zonal_Engine == "native":
+		flmc.log("Calculating zonal thresholds of all lines...")
+		nativeThresholds()
+		flmc.logStep("Zonal thresholds")
+		return
+
 	# Prepare input lines for multiprocessing
-	numLines = flmc.SplitLines(Input_Feature_Class, outWorkspace, "ZT", False, ThresholdField)
+	segments = flmc.SplitLines(Input_Feature_Class, outWorkspace, "ZT", False, ThresholdField)
+	numLines = len(segments)
 	
 	pool = multiprocessing.Pool(processes=flmc.GetCores())
 	flmc.log("Multiprocessing line zonal thresholds...")
@@ -0,0 +1,126 @@
+#
+#    Copyright (C) 2021  Applied Geospatial Research Group
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, version 3.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://gnu.org/licenses/gpl-3.0>.
+#
+# ---------------------------------------------------------------------------
+#
+# test_FLM_Common_log.py
+#
+# Purpose: Messages logged by concurrent threads are printed and written to
+# the log file whole, one message per line, with and without the log listener.
+#
+# Run from the repository folder:
+#   python -m unittest discover tests
+#
+# ---------------------------------------------------------------------------
+import io
+import os
+import re
+import sys
+import tempfile
+import threading
+import importlib.util
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Scripts"))
+
+THREADS = 8
+MESSAGES = 300
+LINE_PATTERN = re.compile(r"^thread \d+ message \d+ x{80}$")
+
+
+@unittest.skipUnless(importlib.util.find_spec("arcpy"), "FLM_Common requires arcpy")
+class ThreadLoggingTest(unittest.TestCase):
+    def setUp(self):
+        import FLM_Common as flmc
+        self.flmc = flmc
+
+        self.folder = tempfile.TemporaryDirectory()
+        flmc.StopLogListener()
+        flmc.SetRootHandlers([])
+        flmc.logHandler = None
+        flmc.consoleHandler = None
+        flmc.LOG_FILE = os.path.join(self.folder.name, "log.txt")
+        flmc.SetLogLevel("LINE")
+
+        self.stdout = sys.stdout
+        sys.stdout = io.StringIO()
+
+    def tearDown(self):
+        console = sys.stdout
+        sys.stdout = self.stdout
+        console.close()
+
+        self.flmc.SetRootHandlers([])
+        if self.flmc.logHandler is not None:
+            target = self.flmc.logHandler.target
+            self.flmc.logHandler.close()
+            target.close()
+        self.flmc.logHandler = None
+        self.flmc.consoleHandler = None
+        self.folder.cleanup()
+
+    def logFromThreads(self):
+        def work(thread):
+            for i in range(MESSAGES):
+                self.flmc.log("thread {} message {} ".format(thread, i) + "x" * 80, level=self.flmc.LINE)
+
+        threads = [threading.Thread(target=work, args=(thread,)) for thread in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def checkLines(self, text):
+        lines = text.splitlines()
+        self.assertEqual(len(lines), THREADS * MESSAGES)
+        for line in lines:
+            self.assertRegex(line, LINE_PATTERN)
+
+        # Messages of a thread keep their order
+        for thread in range(THREADS):
+            prefix = "thread {} ".format(thread)
+            numbers = [int(line.split()[3]) for line in lines if line.startswith(prefix)]
+            self.assertEqual(numbers, list(range(MESSAGES)))
+
+    def readLog(self):
+        self.flmc.FlushLog()
+        with open(self.flmc.LOG_FILE) as f:
+            return f.read()
+
+    def testThreadsWithListener(self):
+        self.flmc.StartLogListener()
+        self.logFromThreads()
+        self.flmc.StopLogListener()
+
+        self.checkLines(sys.stdout.getvalue())
+        self.checkLines(self.readLog())
+
+    def testThreadsWithoutListener(self):
+        self.logFromThreads()
+
+        self.checkLines(sys.stdout.getvalue())
+        self.checkLines(self.readLog())
+
+    def testOnlyFile(self):
+        self.flmc.StartLogListener()
+        self.flmc.log("file only", onlyFile=True)
+        self.flmc.StopLogListener()
+
+        self.assertEqual(sys.stdout.getvalue(), "")
+        self.assertEqual(self.readLog(), "file only\n")
+
+
+if __name__ == "__main__":
+    unittest.main()